@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark spark_ec2 launches end to end against the simulated EC2 region
+# and nodes in fake_cluster, without touching AWS. For every scenario (one
+# cluster of each size in --slaves, then a batch of --clusters clusters
+# launched through launch_fleet) it reports the wall-clock time until the
+# clusters were ready, the EC2 API calls made (and throttled) and the ssh
+# round trips to the nodes. EC2 calls go through ec2_client, as they do in
+# spark_ec2, unless --raw-client is given.
+#
+# With --failures it also launches into simulated failures (FAILURE_SCENARIOS)
+# and checks that each launch fails and leaves no instances running, exiting
+# non-zero if one doesn't.
+#
+# The simulated delays default to something like real EC2; shrink them
+# (e.g. --boot-delay 5 --setup-delay 1) for a quick run.
+
+from __future__ import with_statement
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import ec2_client
+import ec2_inventory
+import fake_cluster
+import instance_catalog
+import spark_ec2
+
+def parse_args():
+  parser = OptionParser(usage="bench-launch [options]",
+      add_help_option=True)
+  parser.add_option("-s", "--slaves", default="1,10,100",
+      help="Comma-separated cluster sizes to launch one cluster of each " +
+           "(default: 1,10,100)")
+  parser.add_option("-c", "--clusters", type="int", default=4,
+      help="Number of clusters in the multi-cluster batch, 0 to skip it " +
+           "(default: 4)")
+  parser.add_option("--batch-slaves", type="int", default=5,
+      help="Slaves per cluster in the batch (default: 5)")
+  parser.add_option("-p", "--parallel", type="int", default=4,
+      help="Launches in flight at once in the batch (default: 4)")
+  parser.add_option("-t", "--instance-type", default="m1.xlarge",
+      help="Instance type to launch (default: m1.xlarge)")
+  parser.add_option("--spark-ec2-args", default="",
+      help="Extra spark-ec2 options for every launch, e.g. '--pipeline'")
+
+  parser.add_option("--boot-delay", type="float", default=30.0,
+      help="Mean seconds from RunInstances to running (default: 30)")
+  parser.add_option("--boot-jitter", type="float", default=10.0,
+      help="Standard deviation of the boot delay (default: 10)")
+  parser.add_option("--ssh-delay", type="float", default=5.0,
+      help="Seconds from running until sshd answers (default: 5)")
+  parser.add_option("--setup-delay", type="float", default=10.0,
+      help="Seconds setup.sh takes on the master (default: 10)")
+  parser.add_option("--worker-delay", type="float", default=2.0,
+      help="Mean seconds from setup until a worker registers (default: 2)")
+  parser.add_option("--worker-failure-rate", type="float", default=0.0,
+      help="Fraction of workers that only register once restarted " +
+           "(default: 0)")
+  parser.add_option("--zone-capacity", type="int", default=None,
+      help="Instances each zone can launch (default: unlimited)")
+  parser.add_option("--api-rate", type="float", default=20.0,
+      help="EC2 API calls per second before throttling (default: 20)")
+  parser.add_option("--api-burst", type="int", default=100,
+      help="EC2 API calls that may be made in a burst (default: 100)")
+  parser.add_option("--api-latency", type="float", default=0.05,
+      help="Seconds each EC2 API call takes (default: 0.05)")
+  parser.add_option("--client-rate", type="float",
+      default=ec2_client.DEFAULT_RATE,
+      help="EC2 API calls per second ec2_client allows itself (default: %g)"
+           % ec2_client.DEFAULT_RATE)
+  parser.add_option("--client-burst", type="int",
+      default=ec2_client.DEFAULT_BURST,
+      help="EC2 API calls ec2_client allows in a burst (default: %d)"
+           % ec2_client.DEFAULT_BURST)
+  parser.add_option("--raw-client", action="store_true", default=False,
+      help="Call the simulated EC2 directly instead of through ec2_client, " +
+           "i.e. without its rate limiting, retries and coalescing")
+  parser.add_option("--rtt", type="float", default=0.02,
+      help="Seconds each ssh round trip takes (default: 0.02)")
+  parser.add_option("--seed", type="int", default=None,
+      help="Random seed for the simulated delays")
+  parser.add_option("--failures", action="store_true", default=False,
+      help="Also check that launches into spot requests that are never " +
+           "granted and zones without capacity fail cleanly")
+  parser.add_option("--log", default="/tmp/bench-launch.log",
+      help="File the launches' own output goes to " +
+           "(default: /tmp/bench-launch.log)")
+
+  (opts, args) = parser.parse_args()
+  if len(args) != 0:
+    parser.print_help()
+    sys.exit(1)
+  return opts
+
+def main():
+  opts = parse_args()
+  # spark_ec2 finds deploy.generic relative to the working directory
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  # Only to get past spark_ec2's credential check; nothing talks to AWS
+  os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+  os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+
+  scenarios = [("%d slaves" % int(n), int(n), 1)
+               for n in opts.slaves.split(",") if n.strip() != ""]
+  if opts.clusters > 0:
+    scenarios.append(("%dx%d slaves" % (opts.clusters, opts.batch_slaves),
+                      opts.batch_slaves, opts.clusters))
+
+  work_dir = tempfile.mkdtemp(prefix="bench-launch")
+  log = open(opts.log, "w")
+  try:
+    setup_environment(work_dir)
+    results = []
+    for (name, num_slaves, num_clusters) in scenarios:
+      print "Running %s..." % name
+      sys.stdout.flush()
+      result = run_scenario(opts, work_dir, num_slaves, num_clusters, log)
+      result["name"] = name
+      results.append(result)
+    print_results(results)
+    failed_checks = []
+    if opts.failures:
+      failed_checks = check_failures(opts, work_dir, log)
+  finally:
+    log.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+  print "Launch output is in " + opts.log
+  if failed_checks != []:
+    sys.exit(1)
+
+# Point spark_ec2 at scratch caches and a local setup repository, so that
+# nothing is fetched from the network
+def setup_environment(work_dir):
+  spark_ec2.CACHE_DIR = os.path.join(work_dir, "cache")
+  ec2_inventory.CACHE_FILE = os.path.join(work_dir, "inventory.json")
+  instance_catalog.load_catalog()
+
+  repo = os.path.join(work_dir, "spark-ec2")
+  os.makedirs(repo)
+  with open(os.path.join(repo, "setup.sh"), "w") as f:
+    f.write("#!/bin/bash\n")
+  with open(os.devnull, "w") as devnull:
+    for args in [["init", "-q"], ["checkout", "-q", "-b",
+                                  spark_ec2.SETUP_REPO_BRANCH],
+                 ["add", "setup.sh"],
+                 ["-c", "user.name=bench", "-c", "user.email=bench@localhost",
+                  "commit", "-q", "-m", "Fake setup scripts"]]:
+      subprocess.check_call(["git"] + args, cwd=repo, stdout=devnull)
+  spark_ec2.SETUP_REPO_URL = repo
+
+  identity_file = os.path.join(work_dir, "id_rsa")
+  with open(identity_file, "w") as f:
+    f.write("fake key\n")
+
+# Launch num_clusters clusters of num_slaves slaves each in a fresh
+# simulated region and return the measurements. region_args override the
+# simulated region's settings and extra_args are added to the spark-ec2
+# options.
+def run_scenario(opts, work_dir, num_slaves, num_clusters, log,
+                 region_args=None, extra_args=None):
+  settings = {"boot_delay": opts.boot_delay, "boot_jitter": opts.boot_jitter,
+              "zone_capacity": opts.zone_capacity, "api_rate": opts.api_rate,
+              "api_burst": opts.api_burst, "api_latency": opts.api_latency,
+              "seed": opts.seed}
+  settings.update(region_args or {})
+  region = fake_cluster.FakeRegion(**settings)
+  nodes = fake_cluster.FakeNodes(
+      region, rtt=opts.rtt, ssh_delay=opts.ssh_delay,
+      setup_delay=opts.setup_delay, worker_delay=opts.worker_delay,
+      worker_failure_rate=opts.worker_failure_rate, seed=opts.seed)
+  conn = region.connect()
+  ec2_client.stats = ec2_client.ApiStats()
+  if not opts.raw_client:
+    bucket = os.path.join(work_dir, "api-%d.bucket" % time.time())
+    ec2_client.wrap(conn, opts.client_rate, opts.client_burst, bucket)
+  spark_ec2.node_backend = nodes
+  ec2_inventory.invalidate()
+
+  cluster_names = ["bench-%d-%d" % (num_slaves, i)
+                   for i in range(num_clusters)]
+  args = ["-k", "bench", "-i", os.path.join(work_dir, "id_rsa"),
+          "-a", "ami-bench", "-t", opts.instance_type,
+          "-s", str(num_slaves), "-w", "600"]
+  args += shlex.split(opts.spark_ec2_args) + (extra_args or [])
+  (ec2_opts, action, _) = spark_ec2.parse_args(
+      args + ["launch", cluster_names[0]])
+
+  (stdout, stderr) = (sys.stdout, sys.stderr)
+  sys.stdout = sys.stderr = spark_ec2.stderr = log
+  start = time.time()
+  try:
+    if num_clusters == 1 and ec2_opts.zone == "":
+      ec2_opts.zone = region.zones[0]
+      launches = [spark_ec2.launch_and_setup(conn, ec2_opts,
+                                             cluster_names[0])]
+    else:
+      launches = spark_ec2.launch_fleet(conn, ec2_opts, cluster_names,
+                                        opts.parallel, 0)
+  except (Exception, SystemExit) as e:
+    error = "%s: %s" % (e.__class__.__name__,
+                        getattr(e, "error_code", None) or e)
+    launches = [{"success": False, "error": error}] * num_clusters
+  finally:
+    elapsed = time.time() - start
+    (sys.stdout, sys.stderr) = (stdout, stderr)
+    spark_ec2.stderr = stderr
+    spark_ec2.node_backend = None
+
+  return {"slaves": num_slaves, "clusters": num_clusters,
+          "succeeded": len([l for l in launches if l["success"]]),
+          "errors": [l["error"] for l in launches if not l["success"]],
+          "seconds": elapsed, "api_calls": dict(region.calls),
+          "throttled": region.throttled,
+          "retries": sum([op["retries"]
+                          for op in ec2_client.stats.ops.values()]),
+          "coalesced": sum([op["coalesced"]
+                            for op in ec2_client.stats.ops.values()]),
+          "round_trips": dict(nodes.round_trips),
+          "leftovers": [rec["id"] for rec in region.instances.values()
+                        if rec["state"] not in ["shutting-down",
+                                                "terminated"]]}
+
+
+# Launches that must fail: (name, slaves, simulated region settings,
+# spark-ec2 options). Spot requests bid below the market price are never
+# granted.
+FAILURE_SCENARIOS = [
+  ("unfilled spot", 2, {"spot_market_price": 1.0},
+   ["--spot-price", "0.01", "--spot-timeout", "5",
+    "--spot-fallback", "partial"]),
+  ("zones full", 8, {"zone_capacity": 2}, ["-z", "all"])
+]
+
+
+# Run the FAILURE_SCENARIOS and print whether each launch failed and
+# cleaned up after itself.
+# Returns the names of the scenarios that didn't.
+def check_failures(opts, work_dir, log):
+  print ""
+  failed_checks = []
+  for (name, num_slaves, region_args, extra_args) in FAILURE_SCENARIOS:
+    print "Checking %s..." % name,
+    sys.stdout.flush()
+    result = run_scenario(opts, work_dir, num_slaves, 1, log, region_args,
+                          extra_args)
+    if result["succeeded"] != 0:
+      problem = "the launch succeeded"
+    elif result["leftovers"] != []:
+      problem = "left running: " + " ".join(sorted(result["leftovers"]))
+    else:
+      print "OK (%s)" % result["errors"][0]
+      continue
+    print "FAILED, " + problem
+    failed_checks.append(name)
+  return failed_checks
+
+def print_results(results):
+  print ""
+  print "%-16s %7s %9s %4s %9s %10s %10s %8s %10s %8s" % (
+      "SCENARIO", "SLAVES", "CLUSTERS", "OK", "READY", "API CALLS",
+      "THROTTLED", "RETRIES", "COALESCED", "SSH RTs")
+  for r in results:
+    print "%-16s %7d %9d %4d %8.1fs %10d %10d %8d %10d %8d" % (
+        r["name"], r["slaves"], r["clusters"], r["succeeded"], r["seconds"],
+        sum(r["api_calls"].values()), r["throttled"], r["retries"],
+        r["coalesced"], sum(r["round_trips"].values()))
+  for r in results:
+    print ""
+    print r["name"] + ":"
+    print "  API calls: " + ", ".join(["%s %d" % (a, n) for (a, n) in
+        sorted(r["api_calls"].items(), key=lambda an: -an[1])])
+    print "  Round trips: " + ", ".join(["%s %d" % (k, n) for (k, n) in
+                                         sorted(r["round_trips"].items())])
+    for error in r["errors"]:
+      print "  Failed: " + error
+
+if __name__ == "__main__":
+  main()
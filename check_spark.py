@@ -2,51 +2,115 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import httplib
 import json
-import urllib2
+import sys
+import time
 import boto
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from boto import *
 
-def is_active(instance):
-  return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
+import ec2_client
+import ec2_inventory
 
 def main():
   parser = OptionParser(usage="check_spark [spark_master_hostname]",
       add_help_option=True)
+  parser.add_option("--refresh", action="store_true", default=False,
+      help="Rescan EC2 instead of using the cached instance inventory")
+  parser.add_option("-p", "--parallel", type="int", default=32,
+      help="Maximum number of masters probed at the same time (default: 32)")
+  parser.add_option("--connect-timeout", type="float", default=5,
+      help="Seconds to wait for a master to accept the connection (default: 5)")
+  parser.add_option("--read-timeout", type="float", default=10,
+      help="Seconds to wait for a master to answer (default: 10)")
+  parser.add_option("--json", action="store_true", default=False,
+      help="Print one JSON object per cluster instead of plain text")
   (opts, args) = parser.parse_args()
   if len(args) != 1:
-    check_all_masters()
+    check_all_masters(refresh=opts.refresh, parallel=opts.parallel,
+                      connect_timeout=opts.connect_timeout,
+                      read_timeout=opts.read_timeout, as_json=opts.json)
   else:
-    check_spark_master(args[0])
-
-def check_all_masters():
-  conn = connect_ec2()
-  res = conn.get_all_instances()
-  # master reservations have only one node
-  masters = [i for i in res if len(i.instances) == 1]
-  master_instances = [m.instances[0] for m in masters if is_active(m.instances[0])]
-
-  name_host = [(m.tags['cluster'], m.public_dns_name) for m in master_instances if 'cluster' in m.tags]
-  
-  for (name, host) in name_host:
-    print(name + " " + host, end=' ')
+    check_spark_master(args[0], opts.connect_timeout, opts.read_timeout)
+
+def check_all_masters(refresh=False, parallel=32, connect_timeout=5,
+                      read_timeout=10, as_json=False):
+  conn = ec2_client.connect()
+  index = ec2_inventory.load_index(conn, refresh=refresh)
+  name_host = ec2_inventory.get_masters(index)
+  if name_host == []:
+    return
+
+  def probe(name_host):
+    (name, host) = name_host
+    start = time.time()
+    result = {"cluster": name, "master": host}
     try:
-      check_spark_master(host)
-    except Exception:
-      print("Spark master DOWN ")
-
-def check_spark_master(master_hostname):
-  #url = "http://" + master + ":8080"
-  master_url = "http://" + master_hostname + ":8080"
-  url = master_url + "/json"
-  response = urllib2.urlopen(url, timeout=30)
-  if response.code != 200:
-    print("Spark master " + url + " returned " + str(response.code))
+      (status, body) = fetch_master_json(host, connect_timeout, read_timeout)
+      if status != 200:
+        result["error"] = "HTTP " + str(status)
+      else:
+        result.update(summarize_spark_json(body))
+    # Any failure, including an unexpected page shape, only fails this
+    # master's line of the report
+    except Exception as e:
+      result["error"] = str(e) or e.__class__.__name__
+    result["latency"] = round(time.time() - start, 3)
+    return result
+
+  # Report each master as soon as its probe finishes
+  pool = ThreadPool(min(parallel, len(name_host)))
+  for result in pool.imap_unordered(probe, name_host):
+    if as_json:
+      print(json.dumps(result))
+    elif "error" in result:
+      print(result["cluster"] + " " + result["master"] +
+            " Spark master DOWN (" + result["error"] + ")")
+    else:
+      print(result["cluster"] + " " + result["master"] +
+            " Spark master reports %d CPUs, %d MB, %d workers" %
+            (result["cores"], result["memory"], result["workers"]))
+    sys.stdout.flush()
+  pool.close()
+
+# Fetch the /json status page of a Spark master, with separate timeouts for
+# establishing the connection and for reading the response.
+# Returns a tuple of (HTTP status, body).
+def fetch_master_json(master_hostname, connect_timeout=5, read_timeout=10,
+                      port=8080):
+  conn = httplib.HTTPConnection(master_hostname, port,
+                                timeout=connect_timeout)
+  try:
+    conn.connect()
+    conn.sock.settimeout(read_timeout)
+    conn.request("GET", "/json")
+    response = conn.getresponse()
+    return (response.status, response.read())
+  finally:
+    conn.close()
+
+def check_spark_master(master_hostname, connect_timeout=5, read_timeout=10):
+  url = "http://" + master_hostname + ":8080/json"
+  (status, master_json) = fetch_master_json(master_hostname, connect_timeout,
+                                            read_timeout)
+  if status != 200:
+    print("Spark master " + url + " returned " + str(status))
     return -1
-  master_json = response.read()
   return check_spark_json(master_json)
 
+# Summarize a Spark master's /json status page as cores, memory (in MB) and
+# number of alive workers
+def summarize_spark_json(spark_json):
+  json_data = json.loads(spark_json)
+  workers = json_data.get("workers", [])
+  return {
+    "cores": int(json_data.get("cores", 0)),
+    "memory": int(json_data.get("memory", 0)),
+    "workers": len([w for w in workers if w.get("state", "ALIVE") == "ALIVE"])
+  }
+
 def check_spark_json(spark_json):
   json_data = json.loads(spark_json)
   ## Find number of cpus from status page
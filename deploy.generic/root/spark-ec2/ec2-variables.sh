@@ -9,3 +9,12 @@ export MESOS_MAPRED_LOCAL_DIRS="{{mapred_local_dirs}}"
 export MESOS_SPARK_LOCAL_DIRS="{{spark_local_dirs}}"
 export MODULES="{{modules}}"
 export SWAP_MB="{{swap}}"
+
+# Worker resources tuned from the instance catalog, for deploy_templates.py
+# to put into the spark-env.sh it renders (and setup copies to the slaves);
+# left unset for instance types the catalog doesn't know so that Spark uses
+# its own defaults.
+if [ -n "{{spark_worker_cores}}" ]; then
+  export SPARK_WORKER_CORES="{{spark_worker_cores}}"
+  export SPARK_WORKER_MEMORY="{{spark_worker_memory}}"
+fi
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Rate-limit-aware EC2 connections for spark_ec2, get_masters, check_spark
+# and fanout.
+#
+# wrap() hooks a boto EC2 connection's make_request, which every EC2 API
+# call goes through (including those made by instance, image and security
+# group objects), so that each request:
+#   - first takes a token from a bucket shared by all processes on this
+#     host through a locked file, so parallel launches don't together
+#     exceed EC2's request rate;
+#   - is retried with exponential backoff and full jitter if EC2 throttles
+#     it (RequestLimitExceeded), draining the shared bucket so that the
+#     other processes back off as well, or if it is a Describe* call and a
+#     transient server or connection error occurs (other calls, such as
+#     RunInstances, may have taken effect and are not sent twice);
+#   - if it is a Describe* call identical to one already in flight, waits
+#     for that call's response instead of being sent again.
+# Per-operation call, retry and latency counters are kept for the process
+# and can be printed at exit, e.g. by setting SPARK_EC2_API_STATS to a file
+# name (or "-" for stderr).
+
+from __future__ import with_statement
+
+import atexit
+import fcntl
+import httplib
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+import boto
+from boto import ec2
+
+CACHE_DIR = os.getenv("SPARK_EC2_CACHE_DIR",
+                      os.path.expanduser("~/.spark-ec2-cache"))
+
+# Requests per second and burst size allowed by the shared token bucket
+DEFAULT_RATE = float(os.getenv("SPARK_EC2_API_RATE", "10"))
+DEFAULT_BURST = int(os.getenv("SPARK_EC2_API_BURST", "40"))
+
+# Error codes meaning the request was throttled
+THROTTLE_CODES = ["RequestLimitExceeded", "Throttling", "ThrottlingException"]
+
+# Error codes worth retrying because the failure is transient
+TRANSIENT_CODES = ["InternalError", "Unavailable", "ServiceUnavailable"]
+
+
+# Get the first error code from an EC2 error response body
+def get_error_code(body):
+  m = re.search(r"<Code>([^<]*)</Code>", body or "")
+  return m.group(1) if m else None
+
+
+# Raised from inside boto's request loop to leave it without its retry
+# sleep, carrying the 500/503 response or the connection error
+class _SendAborted(Exception):
+  def __init__(self, response=None, error=None):
+    Exception.__init__(self)
+    self.response = response
+    self.error = error
+
+
+# Send a single request on a boto connection the way its make_request does,
+# but bypassing boto's own retries: they ignore the shared rate limit, sleep
+# even when told not to retry and can be re-enabled by the [Boto]
+# num_retries setting. 500 and 503 responses are returned and connection
+# errors raised right away.
+def send_once(conn, action, params=None, path="/", verb="GET"):
+  request = conn.build_base_http_request(verb, path, None, params, {}, "",
+                                         conn.server_name())
+  if action:
+    request.params["Action"] = action
+  if conn.APIVersion:
+    request.params["Version"] = conn.APIVersion
+
+  def sender(http_conn, method, path, body, headers):
+    try:
+      http_conn.request(method, path, body, headers)
+      return http_conn.getresponse()
+    except (socket.error, httplib.HTTPException) as e:
+      raise _SendAborted(error=e)
+
+  def on_response(response, attempt, next_sleep):
+    if response.status in (500, 503):
+      raise _SendAborted(response=response)
+    return None
+
+  try:
+    return conn._mexe(request, sender, override_num_retries=0,
+                      retry_handler=on_response)
+  except _SendAborted as e:
+    if e.error is not None:
+      raise e.error
+    return e.response
+
+
+# A response whose body has already been read, so that it can be inspected
+# here and read again by boto (or by several coalesced callers)
+class BufferedResponse(object):
+  def __init__(self, status, reason, body):
+    self.status = status
+    self.reason = reason
+    self.body = body
+
+  def read(self, amt=None):
+    return self.body
+
+  def getheader(self, name, default=None):
+    return default
+
+
+# Token bucket whose state lives in a file, so that all processes using the
+# same file share one request rate
+class TokenBucket(object):
+  def __init__(self, path, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+    self.path = path
+    self.rate = rate
+    self.burst = burst
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+
+  # Update the bucket under the file lock. update(tokens) returns the new
+  # number of tokens and a result to return.
+  def _update(self, update):
+    with open(self.path, "a+") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      f.seek(0)
+      now = time.time()
+      try:
+        state = json.loads(f.read())
+        tokens = min(self.burst,
+                     state["tokens"] + (now - state["time"]) * self.rate)
+      except (ValueError, KeyError):
+        tokens = self.burst
+      (tokens, result) = update(tokens)
+      f.seek(0)
+      f.truncate()
+      f.write(json.dumps({"tokens": tokens, "time": now}))
+    return result
+
+  # Take a token, sleeping until one is available.
+  # Returns the number of seconds spent waiting.
+  def acquire(self):
+    waited = 0.0
+    while True:
+      def take(tokens):
+        if tokens >= 1:
+          return (tokens - 1, 0)
+        return (tokens, (1 - tokens) / self.rate)
+      wait = self._update(take)
+      if wait == 0:
+        return waited
+      time.sleep(wait)
+      waited += wait
+
+  # Empty the bucket, e.g. after EC2 throttled us
+  def drain(self):
+    self._update(lambda tokens: (min(tokens, 0), None))
+
+
+# Per-operation call, retry and latency counters
+class ApiStats(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.ops = {}
+
+  def record(self, action, secs=0.0, **counts):
+    with self.lock:
+      op = self.ops.setdefault(action, {
+          "calls": 0, "retries": 0, "throttled": 0, "coalesced": 0,
+          "failed": 0, "secs": 0.0, "max_secs": 0.0, "wait_secs": 0.0})
+      for (name, n) in counts.items():
+        op[name] += n
+      op["secs"] += secs
+      op["max_secs"] = max(op["max_secs"], secs)
+
+  def print_stats(self, out=sys.stderr):
+    with self.lock:
+      ops = dict([(a, dict(op)) for (a, op) in self.ops.items()])
+    print >> out, "%-32s %6s %7s %9s %9s %6s %9s %9s %8s" % (
+        "EC2 OPERATION", "CALLS", "RETRIES", "THROTTLED", "COALESCED",
+        "FAILED", "AVG MS", "MAX MS", "WAITED")
+    for action in sorted(ops, key=lambda a: -ops[a]["calls"]):
+      op = ops[action]
+      sent = op["calls"] - op["coalesced"]
+      print >> out, "%-32s %6d %7d %9d %9d %6d %9.0f %9.0f %7.1fs" % (
+          action, op["calls"], op["retries"], op["throttled"],
+          op["coalesced"], op["failed"],
+          1000 * op["secs"] / max(sent + op["retries"], 1),
+          1000 * op["max_secs"], op["wait_secs"])
+
+
+stats = ApiStats()
+
+
+class _InFlight(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.response = None
+    self.error = None
+
+
+# The make_request replacement installed by wrap()
+class RateLimitedClient(object):
+  def __init__(self, send, bucket, max_tries=8, base_delay=0.5,
+               max_delay=20.0):
+    self.send = send
+    self.bucket = bucket
+    self.max_tries = max_tries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.lock = threading.Lock()
+    self.in_flight = {}
+
+  def make_request(self, action, params=None, path="/", verb="GET"):
+    if not action.startswith("Describe"):
+      return self._send_with_retries(action, params, path, verb)
+    key = (action, repr(sorted((params or {}).items())), path, verb)
+    with self.lock:
+      call = self.in_flight.get(key)
+      leader = call is None
+      if leader:
+        call = _InFlight()
+        self.in_flight[key] = call
+    if not leader:
+      call.done.wait()
+      stats.record(action, calls=1, coalesced=1)
+      if call.error is not None:
+        raise call.error
+      return BufferedResponse(call.response.status, call.response.reason,
+                              call.response.body)
+    try:
+      call.response = self._send_with_retries(action, params, path, verb)
+      return call.response
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.in_flight[key]
+      call.done.set()
+
+  def _send_with_retries(self, action, params, path, verb):
+    attempt = 0
+    while True:
+      waited = self.bucket.acquire()
+      start = time.time()
+      error = None
+      response = None
+      try:
+        raw = self.send(action, params, path, verb)
+        response = BufferedResponse(raw.status, raw.reason, raw.read())
+        code = None
+        if response.status >= 400:
+          code = get_error_code(response.body) or str(response.status)
+      except boto.exception.BotoServerError as e:
+        # Connections other than boto's may raise this for 500 and 503
+        # responses, which EC2 also uses for throttling
+        error = e
+        code = e.error_code or get_error_code(e.body) or str(e.status)
+      except (socket.error, httplib.HTTPException) as e:
+        error = e
+        code = e.__class__.__name__
+      secs = time.time() - start
+
+      # 4xx responses are the caller's to handle unless they are throttling.
+      # Server and connection errors are worth another try only for calls
+      # that are safe to repeat, as the first attempt may have taken effect.
+      throttled = code in THROTTLE_CODES
+      retry = throttled or (action.startswith("Describe") and
+                            (code in TRANSIENT_CODES or error is not None))
+      last = attempt + 1 >= self.max_tries
+      stats.record(action, secs, calls=int(attempt == 0),
+                   retries=int(attempt > 0), throttled=int(throttled),
+                   failed=int(code is not None and (last or not retry)),
+                   wait_secs=waited)
+      if not retry or last:
+        if error is not None:
+          raise error
+        return response
+      if throttled:
+        self.bucket.drain()
+      delay = random.uniform(0, min(self.max_delay,
+                                    self.base_delay * 2 ** attempt))
+      boto.log.debug("%s failed with %s, retrying in %.1fs" %
+                     (action, code, delay))
+      time.sleep(delay)
+      attempt += 1
+
+
+# Install rate limiting, retries, coalescing and call accounting on an EC2
+# connection (a boto EC2Connection or anything with the same make_request).
+# Returns the connection.
+def wrap(conn, rate=DEFAULT_RATE, burst=DEFAULT_BURST, bucket_path=None):
+  if bucket_path is None:
+    bucket_path = os.path.join(CACHE_DIR, "ec2-api-%s.bucket" %
+                               conn.region.name)
+  # Our retries replace boto's
+  if hasattr(conn, "_mexe"):
+    send = lambda *args: send_once(conn, *args)
+  else:
+    send = conn.make_request
+  client = RateLimitedClient(send, TokenBucket(bucket_path, rate, burst))
+  conn.make_request = client.make_request
+  return conn
+
+
+_dumping = []
+
+
+# Print the API counters when the process exits, to the given file or to
+# stderr for "-"
+def dump_stats_at_exit(path="-"):
+  if _dumping != []:
+    return
+  _dumping.append(path)
+
+  def dump():
+    if path == "-":
+      stats.print_stats(sys.stderr)
+    else:
+      with open(path, "a") as f:
+        stats.print_stats(f)
+  atexit.register(dump)
+
+
+# Connect to EC2 in the given region (boto's default region if None) and
+# wrap the connection
+def connect(region=None):
+  if region is None:
+    conn = boto.connect_ec2()
+  else:
+    conn = ec2.connect_to_region(region)
+    if conn is None:
+      print >> sys.stderr, "ERROR: Unknown EC2 region " + region
+      sys.exit(1)
+  if os.getenv("SPARK_EC2_API_STATS"):
+    dump_stats_at_exit(os.getenv("SPARK_EC2_API_STATS"))
+  return wrap(conn)
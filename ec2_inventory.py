@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Shared EC2 instance inventory for spark_ec2, get_masters and check_spark.
+#
+# A single paginated scan of the region is turned into an index of
+#   cluster name -> role ('master', 'slave', 'zoo') -> [instance record]
+# which is cached on disk for a short time, so that scripts run across many
+# clusters don't each rescan the whole account. Any action that changes
+# the set of instances (launch, destroy, stop, start) must call invalidate().
+
+from __future__ import with_statement
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from boto.ec2.instance import Reservation
+
+# Instance states we consider active, i.e. not terminating or terminated.
+# We count both stopping and stopped as active since we can restart
+# stopped clusters.
+ACTIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+CACHE_FILE = os.getenv("AMPCAMP_INVENTORY_CACHE",
+                       os.path.expanduser("~/.ampcamp3-inventory.json"))
+
+# Seconds for which a cached index is considered fresh
+DEFAULT_TTL = int(os.getenv("AMPCAMP_INVENTORY_TTL", "60"))
+
+# First EC2 API version whose DescribeInstances accepts MaxResults and
+# NextToken. The bundled boto speaks 2012-03-01 by default, which doesn't.
+PAGING_API_VERSION = "2013-10-15"
+
+# Instance attributes kept in the index
+RECORD_FIELDS = ['id', 'state', 'public_dns_name', 'private_dns_name',
+                 'ip_address', 'instance_type', 'placement', 'launch_time']
+
+
+# Check whether a given EC2 instance object is in a state we consider active
+def is_active(instance):
+  return (instance.state in ACTIVE_STATES)
+
+
+# Iterate over the reservations matching the given EC2 filters, fetching one
+# page of DescribeInstances results at a time so that memory use is bounded
+# by the page size rather than by the number of instances in the account.
+# Connections speaking an API version without paging get everything in one
+# filtered call.
+def iter_reservations(conn, filters, page_size=500):
+  paged = getattr(conn, 'APIVersion', '') >= PAGING_API_VERSION
+  next_token = None
+  while True:
+    params = {}
+    if paged:
+      params['MaxResults'] = str(page_size)
+    conn.build_filter_params(params, filters)
+    if next_token:
+      params['NextToken'] = next_token
+    page = conn.get_list('DescribeInstances', params,
+                         [('item', Reservation)], verb='POST')
+    for res in page:
+      yield res
+    # boto 2.4 doesn't parse EC2's lower-case nextToken into next_token
+    next_token = getattr(page, 'nextToken', None)
+    if not paged or not next_token:
+      return
+
+
+# Work out the role of an instance in its cluster. Instances launched by
+# spark_ec2 carry a 'type' tag; for older clusters we fall back to treating
+# single-instance reservations as masters.
+def get_role(instance, reservation_size):
+  if 'type' in instance.tags:
+    return instance.tags['type']
+  elif reservation_size == 1:
+    return 'master'
+  else:
+    return 'slave'
+
+
+# Turn a boto instance into a JSON-serialisable record
+def instance_record(instance):
+  record = {}
+  for field in RECORD_FIELDS:
+    record[field] = getattr(instance, field, None)
+  record['tags'] = dict(instance.tags)
+  return record
+
+
+# Build the cluster -> role -> instances index with one paginated scan of
+# the active, cluster-tagged instances in the connection's region
+def build_index(conn):
+  index = {}
+  filters = {'tag-key': 'cluster', 'instance-state-name': ACTIVE_STATES}
+  for res in iter_reservations(conn, filters):
+    for instance in res.instances:
+      if 'cluster' not in instance.tags:
+        continue
+      roles = index.setdefault(instance.tags['cluster'], {})
+      role = get_role(instance, len(res.instances))
+      roles.setdefault(role, []).append(instance_record(instance))
+  return index
+
+
+def _read_cache():
+  try:
+    with open(CACHE_FILE) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+# Hold an exclusive lock on the cache while reading, modifying and writing
+# it, so that concurrent processes don't drop each other's regions
+@contextmanager
+def _cache_lock():
+  with open(CACHE_FILE + ".lock", "a") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    yield
+
+
+def _write_cache(cache):
+  # Write to a temp file and rename it so that concurrent readers never
+  # see a partially written cache
+  cache_dir = os.path.dirname(os.path.abspath(CACHE_FILE))
+  (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, prefix=".inventory")
+  with os.fdopen(fd, "w") as f:
+    json.dump(cache, f)
+  os.rename(tmp_path, CACHE_FILE)
+
+
+# Get the index for the connection's region, from the on-disk cache if it
+# is younger than ttl seconds and from a fresh scan otherwise
+def load_index(conn, ttl=DEFAULT_TTL, refresh=False):
+  region = conn.region.name
+  cache = _read_cache()
+  entry = cache.get(region)
+  if not refresh and entry is not None and \
+      time.time() - entry['time'] < ttl:
+    return entry['clusters']
+  index = build_index(conn)
+  with _cache_lock():
+    cache = _read_cache()
+    cache[region] = {'time': time.time(), 'clusters': index}
+    _write_cache(cache)
+  return index
+
+
+# Drop the cached index for a region (or for all regions)
+def invalidate(region=None):
+  with _cache_lock():
+    if region is None:
+      if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
+      return
+    cache = _read_cache()
+    if region in cache:
+      del cache[region]
+      _write_cache(cache)
+
+
+# Read-only stand-in for a boto instance, built from an index record
+class CachedInstance(object):
+  def __init__(self, record):
+    self.__dict__.update(record)
+
+
+# Get the (masters, slaves, zoo nodes) of a cluster from the index
+def get_cluster(index, cluster_name):
+  roles = index.get(cluster_name, {})
+  return tuple([CachedInstance(r) for r in roles.get(role, [])]
+               for role in ['master', 'slave', 'zoo'])
+
+
+# Get (cluster name, master hostname) pairs for all clusters whose name
+# contains prefix, sorted by cluster name
+def get_masters(index, prefix=""):
+  name_host = []
+  for name in sorted(index):
+    if prefix in name:
+      for master in index[name].get('master', []):
+        name_host.append((name, master['public_dns_name']))
+  return name_host
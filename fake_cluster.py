@@ -0,0 +1,784 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-process stand-ins for EC2, ssh and the Spark master's status page, so
+# that spark_ec2's orchestration can be run and timed without an AWS
+# account:
+#
+#   region = FakeRegion(boot_delay=30)
+#   conn = region.connect()          # pass wherever an EC2 connection goes
+#   spark_ec2.node_backend = FakeNodes(region)
+#
+# FakeRegion simulates instance boot times, eventual consistency right
+# after RunInstances, per-zone capacity limits, spot requests and API
+# throttling (RequestLimitExceeded), and counts the API calls made.
+# FakeNodes simulates sshd coming up after boot, the setup scripts, Spark
+# workers registering with the master (or failing to) and counts ssh round
+# trips. All delays are seconds of real time.
+
+from __future__ import with_statement
+
+import json
+import random
+import re
+import tarfile
+import threading
+import time
+from cStringIO import StringIO
+
+from boto.ec2.connection import EC2Connection
+from boto.exception import EC2ResponseError
+
+import instance_catalog
+
+
+# An EC2 error response body
+def error_body(code, message):
+  return ("<Response><Errors><Error><Code>%s</Code><Message>%s</Message>" +
+          "</Error></Errors><RequestID>fake</RequestID></Response>") % (
+          code, message)
+
+
+# Build an EC2ResponseError the way boto does from an EC2 error response
+def make_error(status, code, message):
+  return EC2ResponseError(status, "Fake EC2", error_body(code, message))
+
+
+class FakeResponse(object):
+  def __init__(self, status, reason, body=""):
+    self.status = status
+    self.reason = reason
+    self.body = body
+
+  def read(self, amt=None):
+    return self.body
+
+  def getheader(self, name, default=None):
+    return default
+
+
+class FakeRegion(object):
+  def __init__(self, name="us-east-1",
+               zones=("us-east-1a", "us-east-1b", "us-east-1d"),
+               boot_delay=30.0, boot_jitter=10.0, stop_delay=10.0,
+               visibility_delay=1.0, spot_delay=20.0, spot_market_price=0.1,
+               zone_capacity=None, api_rate=20.0, api_burst=100,
+               api_latency=0.05, seed=None):
+    self.name = name
+    self.zones = list(zones)
+    self.boot_delay = boot_delay
+    self.boot_jitter = boot_jitter
+    self.stop_delay = stop_delay
+    # Seconds after launch before an instance shows up in describe calls
+    # and can be tagged
+    self.visibility_delay = visibility_delay
+    self.spot_delay = spot_delay
+    self.spot_market_price = spot_market_price
+    # Instances each zone can still launch; None means unlimited
+    if zone_capacity is None:
+      self.capacity = dict([(z, None) for z in self.zones])
+    else:
+      self.capacity = dict([(z, zone_capacity) for z in self.zones])
+    self.api_rate = api_rate
+    self.api_burst = api_burst
+    self.api_latency = api_latency
+    self.random = random.Random(seed)
+
+    self.lock = threading.RLock()
+    self.instances = {}
+    self.reservations = {}
+    self.spot_requests = {}
+    self.groups = {}
+    self.hosts = {}
+    self.next_id = 1
+    self.calls = {}
+    self.throttled = 0
+    self.tokens = float(api_burst)
+    self.tokens_at = time.time()
+
+  def connect(self):
+    return FakeEC2Connection(self)
+
+  def new_id(self, prefix):
+    with self.lock:
+      n = self.next_id
+      self.next_id += 1
+    return "%s-%08x" % (prefix, n)
+
+  # Count an API call and apply the token-bucket rate limit to it. Returns
+  # False if the call is throttled.
+  def call(self, action):
+    time.sleep(self.api_latency)
+    with self.lock:
+      self.calls[action] = self.calls.get(action, 0) + 1
+      now = time.time()
+      self.tokens = min(self.api_burst,
+                        self.tokens + (now - self.tokens_at) * self.api_rate)
+      self.tokens_at = now
+      if self.tokens < 1:
+        self.throttled += 1
+        return False
+      self.tokens -= 1
+      return True
+
+  def total_calls(self):
+    with self.lock:
+      return sum(self.calls.values())
+
+  # Move an instance record to the state it should be in by now
+  def advance(self, rec):
+    now = time.time()
+    if rec["state"] == "pending" and now >= rec["running_at"]:
+      rec["state"] = "running"
+      rec["public_dns_name"] = "ec2-%s.compute-1.fake.amazonaws.com" % (
+          rec["ip_address"].replace(".", "-"))
+      rec["private_dns_name"] = "ip-%s.ec2.internal" % (
+          rec["private_ip_address"].replace(".", "-"))
+      self.hosts[rec["public_dns_name"]] = rec["id"]
+      self.hosts[rec["private_dns_name"]] = rec["id"]
+    elif rec["state"] in ["stopping", "shutting-down"] and \
+        now >= rec["transition_at"]:
+      rec["state"] = {"stopping": "stopped",
+                      "shutting-down": "terminated"}[rec["state"]]
+      if rec["state"] == "terminated" and \
+          self.capacity[rec["placement"]] is not None:
+        self.capacity[rec["placement"]] += 1
+
+  def launch(self, image_id, instance_type, zone, count, groups, key_name):
+    with self.lock:
+      if zone is None:
+        zone = self.random.choice(self.zones)
+      if zone not in self.capacity:
+        raise make_error(400, "InvalidParameterValue",
+                         "Invalid availability zone: [%s]" % zone)
+      if self.capacity[zone] is not None:
+        if self.capacity[zone] < count:
+          raise make_error(500, "InsufficientInstanceCapacity",
+                           "Insufficient capacity in %s." % zone)
+        self.capacity[zone] -= count
+      res_id = self.new_id("r")
+      now = time.time()
+      ids = []
+      for i in range(count):
+        n = self.next_id
+        inst_id = self.new_id("i")
+        self.instances[inst_id] = {
+          "id": inst_id, "reservation": res_id, "image_id": image_id,
+          "state": "pending", "instance_type": instance_type,
+          "placement": zone, "key_name": key_name,
+          "groups": [g.name for g in groups], "tags": {},
+          "launch_time": time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                                       time.gmtime(now)),
+          "launched_at": now,
+          "running_at": now + max(0, self.random.gauss(self.boot_delay,
+                                                       self.boot_jitter)),
+          "transition_at": None,
+          "public_dns_name": "", "private_dns_name": "",
+          "ip_address": "54.%d.%d.%d" % (n / 65536 % 256, n / 256 % 256,
+                                         n % 256),
+          "private_ip_address": "10.%d.%d.%d" % (n / 65536 % 256,
+                                                 n / 256 % 256, n % 256)}
+        ids.append(inst_id)
+      self.reservations[res_id] = ids
+      return (res_id, ids)
+
+  # Instance records for the given IDs, failing like EC2 does for IDs it
+  # doesn't know about (or doesn't show yet)
+  def lookup(self, ids):
+    now = time.time()
+    recs = []
+    for inst_id in ids:
+      rec = self.instances.get(inst_id)
+      if rec is None or now < rec["launched_at"] + self.visibility_delay:
+        raise make_error(400, "InvalidInstanceID.NotFound",
+                         "The instance ID '%s' does not exist" % inst_id)
+      self.advance(rec)
+      recs.append(rec)
+    return recs
+
+  # IDs of the instances that describe calls show by now
+  def visible_ids(self):
+    now = time.time()
+    return [i for i in sorted(self.instances)
+            if now >= self.instances[i]["launched_at"] + self.visibility_delay]
+
+  def find_host(self, host):
+    with self.lock:
+      inst_id = self.hosts.get(host)
+      if inst_id is None:
+        return None
+      rec = self.instances[inst_id]
+      self.advance(rec)
+      return rec
+
+  def cluster_records(self, cluster):
+    with self.lock:
+      recs = [r for r in self.instances.values()
+              if r["tags"].get("cluster") == cluster]
+      for rec in recs:
+        self.advance(rec)
+      return recs
+
+
+# Matches a describe filter (name, [values]) against an instance record
+def matches_filter(rec, name, values):
+  if name == "instance-state-name":
+    return rec["state"] in values
+  elif name == "instance-id":
+    return rec["id"] in values
+  elif name == "tag-key":
+    return len([v for v in values if v in rec["tags"]]) > 0
+  elif name.startswith("tag:"):
+    return rec["tags"].get(name[4:]) in values
+  elif name == "availability-zone":
+    return rec["placement"] in values
+  raise make_error(400, "InvalidParameterValue",
+                   "The filter '%s' is invalid" % name)
+
+
+# The values of a list parameter (Name.1, Name.2, ...) of a raw EC2 request,
+# in order
+def list_param(params, name):
+  values = []
+  while "%s.%d" % (name, len(values) + 1) in params:
+    values.append(params["%s.%d" % (name, len(values) + 1)])
+  return values
+
+
+class FakeRegionInfo(object):
+  def __init__(self, name):
+    self.name = name
+
+
+class FakeZone(object):
+  def __init__(self, name):
+    self.name = name
+    self.state = "available"
+
+
+class FakeReservation(object):
+  def __init__(self, res_id, instances):
+    self.id = res_id
+    self.instances = instances
+
+
+class FakeInstance(object):
+  def __init__(self, conn, rec):
+    self.connection = conn
+    self._set(rec)
+
+  def _set(self, rec):
+    for field in ["id", "state", "instance_type", "placement", "image_id",
+                  "key_name", "launch_time", "public_dns_name",
+                  "private_dns_name", "ip_address", "private_ip_address"]:
+      setattr(self, field, rec[field])
+    self.dns_name = self.public_dns_name
+    self.tags = dict(rec["tags"])
+    self.groups = list(rec["groups"])
+
+  def __repr__(self):
+    return "Instance:%s" % self.id
+
+  def _update(self, other):
+    self.__dict__.update(other.__dict__)
+
+  def update(self, validate=False):
+    reservations = self.connection.get_all_instances([self.id])
+    self._update(reservations[0].instances[0])
+    return self.state
+
+  def start(self):
+    self.connection.start_instances([self.id])
+
+  def stop(self, force=False):
+    self.connection.stop_instances([self.id])
+
+  def terminate(self):
+    self.connection.terminate_instances([self.id])
+
+  def add_tag(self, key, value=""):
+    self.connection.create_tags([self.id], {key: value})
+    self.tags[key] = value
+
+
+class FakeImage(object):
+  def __init__(self, conn, image_id):
+    self.connection = conn
+    self.id = image_id
+
+  def run(self, min_count=1, max_count=1, key_name=None,
+          security_groups=None, instance_type="m1.small", placement=None,
+          block_device_map=None, **kwargs):
+    return self.connection.run_instances(
+        self.id, min_count, max_count, key_name, security_groups,
+        instance_type=instance_type, placement=placement,
+        block_device_map=block_device_map)
+
+
+class FakeGrant(object):
+  def __init__(self, name=None, cidr_ip=None):
+    self.name = name
+    self.group_id = name
+    self.owner_id = "fake"
+    self.cidr_ip = cidr_ip
+
+
+class FakeRule(object):
+  def __init__(self, ip_protocol, from_port, to_port):
+    self.ip_protocol = ip_protocol
+    self.from_port = from_port
+    self.to_port = to_port
+    self.grants = []
+
+
+class FakeSecurityGroup(object):
+  def __init__(self, conn, name, description):
+    self.connection = conn
+    self.name = name
+    self.id = "sg-" + name
+    self.description = description
+    self.rules = []
+
+  def authorize(self, ip_protocol=None, from_port=None, to_port=None,
+                cidr_ip=None, src_group=None):
+    self.connection._request("AuthorizeSecurityGroupIngress",
+                             {"GroupName": self.name})
+    if src_group is not None:
+      protocols = [("tcp", 0, 65535), ("udp", 0, 65535), ("icmp", -1, -1)]
+    else:
+      protocols = [(ip_protocol, from_port, to_port)]
+    for (proto, low, high) in protocols:
+      rule = FakeRule(proto, low, high)
+      if src_group is not None:
+        rule.grants.append(FakeGrant(name=src_group.name))
+      else:
+        rule.grants.append(FakeGrant(cidr_ip=cidr_ip))
+      self.rules.append(rule)
+    return True
+
+  def revoke(self, ip_protocol=None, from_port=None, to_port=None,
+             cidr_ip=None, src_group=None):
+    self.connection._request("RevokeSecurityGroupIngress",
+                             {"GroupName": self.name})
+    for rule in list(self.rules):
+      if (rule.ip_protocol, rule.from_port, rule.to_port) == \
+          (ip_protocol, from_port, to_port):
+        self.rules.remove(rule)
+    return True
+
+
+class FakeSpotRequest(object):
+  def __init__(self, req):
+    self.id = req["id"]
+    self.state = req["state"]
+    self.instance_id = req["instance_id"]
+    self.price = req["price"]
+
+
+# Implements the part of boto's EC2Connection that the scripts use
+class FakeEC2Connection(object):
+  # Same API version as the bundled boto, which decides e.g. whether
+  # DescribeInstances is paged
+  APIVersion = EC2Connection.APIVersion
+
+  def __init__(self, region):
+    self.region = FakeRegionInfo(region.name)
+    self.fake = region
+
+  # Every API call goes through here, like boto's AWSQueryConnection, so
+  # that the connection can be wrapped the same way (see ec2_client)
+  def make_request(self, action, params=None, path="/", verb="GET"):
+    if not self.fake.call(action):
+      return FakeResponse(503, "Service Unavailable",
+                          error_body("RequestLimitExceeded",
+                                     "Request limit exceeded."))
+    return FakeResponse(200, "OK")
+
+  # Make the request and raise EC2ResponseError if it failed. The params
+  # only matter to wrappers of make_request, e.g. to tell calls apart.
+  def _request(self, action, params=None):
+    response = self.make_request(action, params)
+    if response.status != 200:
+      raise EC2ResponseError(response.status, response.reason,
+                             response.read())
+
+  def _instances(self, recs):
+    return [FakeInstance(self, rec) for rec in recs]
+
+  def _reservations(self, recs):
+    by_res = {}
+    order = []
+    for rec in recs:
+      if rec["reservation"] not in by_res:
+        order.append(rec["reservation"])
+      by_res.setdefault(rec["reservation"], []).append(rec)
+    return [FakeReservation(r, self._instances(by_res[r])) for r in order]
+
+  def get_all_zones(self, zones=None, filters=None):
+    self._request("DescribeAvailabilityZones", {"ZoneName": zones})
+    return [FakeZone(z) for z in self.fake.zones]
+
+  def get_all_images(self, image_ids=None, owners=None, filters=None):
+    self._request("DescribeImages", {"ImageId": image_ids})
+    return [FakeImage(self, i) for i in (image_ids or [])]
+
+  def get_all_security_groups(self, groupnames=None, filters=None):
+    self._request("DescribeSecurityGroups", {"GroupName": groupnames})
+    with self.fake.lock:
+      return [g for (name, g) in sorted(self.fake.groups.items())
+              if groupnames is None or name in groupnames]
+
+  def create_security_group(self, name, description):
+    self._request("CreateSecurityGroup", {"GroupName": name})
+    with self.fake.lock:
+      if name in self.fake.groups:
+        raise make_error(400, "InvalidGroup.Duplicate",
+                         "The security group '%s' already exists" % name)
+      group = FakeSecurityGroup(self, name, description)
+      self.fake.groups[name] = group
+      return group
+
+  def delete_security_group(self, name=None, group_id=None):
+    self._request("DeleteSecurityGroup", {"GroupName": name})
+    with self.fake.lock:
+      in_use = [r for r in self.fake.instances.values()
+                if name in r["groups"] and r["state"] != "terminated"]
+      for rec in in_use:
+        self.fake.advance(rec)
+      if [r for r in in_use if r["state"] != "terminated"] != []:
+        raise make_error(400, "InvalidGroup.InUse",
+                         "There are active instances using security group " +
+                         "'%s'" % name)
+      if name not in self.fake.groups:
+        raise make_error(400, "InvalidGroup.NotFound",
+                         "The security group '%s' does not exist" % name)
+      del self.fake.groups[name]
+      return True
+
+  def run_instances(self, image_id, min_count=1, max_count=1, key_name=None,
+                    security_groups=None, instance_type="m1.small",
+                    placement=None, block_device_map=None, **kwargs):
+    self._request("RunInstances")
+    (res_id, ids) = self.fake.launch(image_id, instance_type, placement,
+                                     max_count, security_groups or [],
+                                     key_name)
+    with self.fake.lock:
+      recs = [self.fake.instances[i] for i in ids]
+      return FakeReservation(res_id, self._instances(recs))
+
+  def get_all_instances(self, instance_ids=None, filters=None):
+    self._request("DescribeInstances",
+                  {"InstanceId": instance_ids,
+                   "Filter": sorted((filters or {}).items())})
+    with self.fake.lock:
+      if instance_ids:
+        recs = self.fake.lookup(instance_ids)
+      else:
+        recs = self.fake.lookup(self.fake.visible_ids())
+      for (name, values) in (filters or {}).items():
+        if not isinstance(values, list):
+          values = [values]
+        recs = [r for r in recs if matches_filter(r, name, values)]
+      return self._reservations(recs)
+
+  # Same encoding as boto's EC2Connection.build_filter_params
+  def build_filter_params(self, params, filters):
+    i = 1
+    for name in filters:
+      values = filters[name]
+      if not isinstance(values, list):
+        values = [values]
+      params["Filter.%d.Name" % i] = name
+      for (j, value) in enumerate(values):
+        params["Filter.%d.Value.%d" % (i, j + 1)] = value
+      i += 1
+
+  # Raw Describe* calls: DescribeInstances with filters and MaxResults /
+  # NextToken paging, as used by ec2_inventory.iter_reservations, and the
+  # other Describe* calls spark_ec2 makes, by their ID lists only. Anything
+  # else isn't simulated and fails loudly rather than returning nonsense.
+  def get_list(self, action, params, markers, path="/", parent=None,
+               verb="GET"):
+    describe = {
+      "DescribeAvailabilityZones": (self.get_all_zones, "ZoneName"),
+      "DescribeImages": (self.get_all_images, "ImageId"),
+      "DescribeSecurityGroups": (self.get_all_security_groups, "GroupName"),
+      "DescribeSpotInstanceRequests": (self.get_all_spot_instance_requests,
+                                       "SpotInstanceRequestId")}
+    if action in describe:
+      (method, id_param) = describe[action]
+      return FakePage(method(list_param(params, id_param) or None))
+    assert action == "DescribeInstances", \
+        "FakeEC2Connection.get_list does not simulate %s" % action
+    self._request(action, params)
+    filters = {}
+    for key in params:
+      m = re.match(r"Filter\.(\d+)\.Name$", key)
+      if m:
+        filters[params[key]] = list_param(params,
+                                          "Filter.%s.Value" % m.group(1))
+    with self.fake.lock:
+      recs = [r for r in self.fake.lookup(self.fake.visible_ids())
+              if len([f for f in filters
+                      if not matches_filter(r, f, filters[f])]) == 0]
+      reservations = self._reservations(recs)
+    start = int(params.get("NextToken", 0))
+    size = int(params.get("MaxResults", len(reservations) or 1))
+    page = FakePage(reservations[start:start + size])
+    if start + size < len(reservations):
+      page.nextToken = str(start + size)
+    return page
+
+  def create_tags(self, resource_ids, tags):
+    self._request("CreateTags")
+    with self.fake.lock:
+      recs = self.fake.lookup(resource_ids)
+      for rec in recs:
+        rec["tags"].update(tags)
+    return True
+
+  def _transition(self, action, instance_ids, from_states, state, delay):
+    self._request(action)
+    with self.fake.lock:
+      recs = self.fake.lookup(instance_ids)
+      for rec in recs:
+        if rec["state"] in from_states:
+          rec["state"] = state
+          rec["transition_at"] = time.time() + delay
+          if state == "pending":
+            rec["running_at"] = time.time() + max(0, self.fake.random.gauss(
+                self.fake.boot_delay, self.fake.boot_jitter))
+      return self._instances(recs)
+
+  def terminate_instances(self, instance_ids=None):
+    return self._transition("TerminateInstances", instance_ids,
+                            ["pending", "running", "stopping", "stopped"],
+                            "shutting-down", self.fake.stop_delay)
+
+  def stop_instances(self, instance_ids=None, force=False):
+    return self._transition("StopInstances", instance_ids,
+                            ["pending", "running"], "stopping",
+                            self.fake.stop_delay)
+
+  def start_instances(self, instance_ids=None):
+    return self._transition("StartInstances", instance_ids, ["stopped"],
+                            "pending", 0)
+
+  def request_spot_instances(self, price, image_id, count=1,
+                             launch_group=None, placement=None,
+                             key_name=None, security_groups=None,
+                             instance_type="m1.small", block_device_map=None,
+                             **kwargs):
+    self._request("RequestSpotInstances")
+    reqs = []
+    with self.fake.lock:
+      for i in range(count):
+        req = {"id": self.fake.new_id("sir"), "state": "open",
+               "instance_id": None, "price": price, "image_id": image_id,
+               "placement": placement, "key_name": key_name,
+               "groups": security_groups or [],
+               "instance_type": instance_type,
+               "grant_at": time.time() + self.fake.random.uniform(
+                   0.5, 1.5) * self.fake.spot_delay}
+        self.fake.spot_requests[req["id"]] = req
+        reqs.append(FakeSpotRequest(req))
+    return reqs
+
+  def get_all_spot_instance_requests(self, request_ids=None, filters=None):
+    self._request("DescribeSpotInstanceRequests",
+                  {"SpotInstanceRequestId": request_ids})
+    with self.fake.lock:
+      reqs = []
+      for req_id in request_ids or sorted(self.fake.spot_requests):
+        req = self.fake.spot_requests.get(req_id)
+        if req is None:
+          raise make_error(400, "InvalidSpotInstanceRequestID.NotFound",
+                           "The spot instance request ID '%s' does not "
+                           "exist" % req_id)
+        if req["state"] == "open" and time.time() >= req["grant_at"] and \
+            req["price"] >= self.fake.spot_market_price:
+          try:
+            (res_id, ids) = self.fake.launch(
+                req["image_id"], req["instance_type"], req["placement"], 1,
+                req["groups"], req["key_name"])
+            req["state"] = "active"
+            req["instance_id"] = ids[0]
+          except EC2ResponseError:
+            pass
+        reqs.append(FakeSpotRequest(req))
+      return reqs
+
+  def cancel_spot_instance_requests(self, request_ids):
+    self._request("CancelSpotInstanceRequests")
+    with self.fake.lock:
+      for req_id in request_ids:
+        req = self.fake.spot_requests.get(req_id)
+        if req is not None and req["state"] == "open":
+          req["state"] = "cancelled"
+    return True
+
+
+class FakePage(list):
+  nextToken = None
+
+
+# Stands in for ssh, scp and the Spark master's web UI on the instances of
+# a FakeRegion; install it as spark_ec2.node_backend
+class FakeNodes(object):
+  def __init__(self, region, rtt=0.02, ssh_delay=5.0, setup_delay=10.0,
+               worker_delay=2.0, worker_failure_rate=0.0, seed=None):
+    self.region = region
+    self.rtt = rtt
+    # Seconds after an instance starts running before sshd answers
+    self.ssh_delay = ssh_delay
+    self.setup_delay = setup_delay
+    self.worker_delay = worker_delay
+    # Fraction of workers that don't register until they are restarted
+    self.worker_failure_rate = worker_failure_rate
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.files = {}
+    # cluster -> host -> time its worker registers (None if it never does)
+    self.workers = {}
+    self.round_trips = {}
+
+  def count(self, kind):
+    with self.lock:
+      self.round_trips[kind] = self.round_trips.get(kind, 0) + 1
+    time.sleep(self.rtt)
+
+  def total_round_trips(self):
+    with self.lock:
+      return sum(self.round_trips.values())
+
+  def _ready(self, host):
+    rec = self.region.find_host(host)
+    return rec is not None and rec["state"] == "running" and \
+        time.time() >= rec["running_at"] + self.ssh_delay
+
+  def is_ssh_ready(self, host):
+    self.count("ssh")
+    return self._ready(host)
+
+  def run(self, host, command, data=None):
+    self.count("ssh")
+    if not self._ready(host):
+      return (255, "")
+    return self._execute(host, command, data)
+
+  def run_script(self, host, steps, stop_on_error=True):
+    self.count("ssh")
+    results = []
+    for (name, command) in steps:
+      start = time.time()
+      if self._ready(host):
+        status = self._execute(host, command, None)[0]
+      else:
+        status = 255
+      results.append((name, status, time.time() - start))
+      if status != 0 and stop_on_error:
+        break
+    return results
+
+  def copy(self, host, local_file, dest_file):
+    self.count("scp")
+    if not self._ready(host):
+      return 1
+    with open(local_file) as f:
+      self._store(host, dest_file, f.read())
+    return 0
+
+  def _store(self, host, path, data):
+    with self.lock:
+      self.files.setdefault(host, {})[path] = data
+
+  # Crude interpretation of the commands spark_ec2 sends: file writes and
+  # reads, and starting or stopping Spark
+  def _execute(self, host, command, data):
+    out = []
+    if data is not None and "tar xzf -" in command:
+      tar = tarfile.open(fileobj=StringIO(data), mode="r:gz")
+      for member in tar.getmembers():
+        if member.isfile():
+          self._store(host, member.name, tar.extractfile(member).read())
+    for m in re.finditer(r"echo (\S+) > (\S+)", command):
+      self._store(host, m.group(2).lstrip("/"), m.group(1) + "\n")
+    for m in re.finditer(r"\bcat (\S+)", command):
+      with self.lock:
+        path = m.group(1).lstrip("/")
+        out.append(self.files.get(host, {}).get(path, ""))
+    rec = self.region.find_host(host)
+    cluster = rec["tags"].get("cluster") if rec is not None else None
+    if "spark-ec2/setup.sh" in command and "chmod" not in command:
+      time.sleep(self.setup_delay)
+      self._start_workers(cluster, None)
+    elif "start-all.sh" in command:
+      self._start_workers(cluster, None)
+    elif "start-slave.sh" in command or \
+        ("spark.deploy.worker.Worker" in command and "start" in command):
+      # Hosts the command starts a worker on, other than the master it
+      # points the worker at
+      targets = [h for h in re.findall(r"[\w.-]+\.(?:amazonaws\.com|internal)",
+                                       re.sub(r"spark://\S+", "", command))
+                 if h != host]
+      self._start_workers(cluster, targets or [host], restart=True)
+    elif "pkill -f spark.deploy.worker.Worker" in command:
+      with self.lock:
+        self.workers.get(cluster, {}).pop(host, None)
+    return (0, "".join(out))
+
+  # Start the workers of the cluster's slaves (or just of the given hosts);
+  # they register after about worker_delay seconds, except that on first
+  # start worker_failure_rate of them never do
+  def _start_workers(self, cluster, hosts, restart=False):
+    if cluster is None:
+      return
+    if hosts is None:
+      hosts = [r["public_dns_name"] for r in self.region.cluster_records(cluster)
+               if r["tags"].get("type") == "slave" and r["state"] == "running"]
+    now = time.time()
+    with self.lock:
+      workers = self.workers.setdefault(cluster, {})
+      for host in hosts:
+        if not restart and self.random.random() < self.worker_failure_rate:
+          workers[host] = None
+        else:
+          workers[host] = now + self.random.uniform(0.5, 1.5) * \
+              self.worker_delay
+
+  def get_spark_json(self, master):
+    self.count("http")
+    rec = self.region.find_host(master)
+    if rec is None or not self._ready(master):
+      return None
+    cluster = rec["tags"].get("cluster")
+    with self.lock:
+      if cluster not in self.workers:
+        return None
+      registered = [(h, at) for (h, at) in
+                    sorted(self.workers[cluster].items())
+                    if at is not None and at <= time.time()]
+    workers = []
+    for (host, at) in registered:
+      slave = self.region.find_host(host)
+      # Registrations from before a stop and start are gone with the worker
+      if slave is None or slave["state"] != "running" or \
+          at < slave["running_at"]:
+        continue
+      info = instance_catalog.get_instance_type(slave["instance_type"]) or \
+          {"vcpus": 2, "memory_mb": 4096}
+      memory = info["memory_mb"]
+      memory = memory - 15 * 1024 if memory > 20 * 1024 else \
+          max(512, memory - 1300)
+      workers.append({"id": "worker-" + slave["id"],
+                      "host": slave["private_dns_name"], "port": 7078,
+                      "webuiaddress": "http://%s:8081" % host,
+                      "cores": info["vcpus"], "coresused": 0,
+                      "memory": memory, "memoryused": 0, "state": "ALIVE"})
+    return json.dumps({"url": "spark://%s:7077" % master,
+                       "workers": workers,
+                       "cores": sum([w["cores"] for w in workers]),
+                       "coresused": 0,
+                       "memory": sum([w["memory"] for w in workers]),
+                       "memoryused": 0, "activeapps": [],
+                       "completedapps": []})
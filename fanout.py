@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run a command over ssh on many hosts at once, e.g. on the masters of all
+# clusters whose name contains a given prefix (the same lookup get_masters
+# uses). Output is streamed with a host prefix on every line, and a per-host
+# exit code and latency summary is printed at the end.
+
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+import ec2_client
+import ec2_inventory
+
+def parse_args():
+  parser = OptionParser(usage="fanout [options] <cluster_prefix> <command>\n" +
+      "       fanout [options] -f <file-with-hostnames> <command>",
+      add_help_option=True)
+  parser.add_option("-i", "--identity-file",
+      help="SSH private key file to use for logging into instances")
+  parser.add_option("-l", "--user", default="root",
+      help="The ssh user you want to connect as (default: root)")
+  parser.add_option("-f", "--host-file",
+      help="Read hostnames from this file instead of looking up masters")
+  parser.add_option("-p", "--parallel", type="int", default=32,
+      help="Maximum number of hosts to run on at the same time (default: 32)")
+  parser.add_option("-t", "--timeout", type="int", default=60,
+      help="Seconds after which the command is killed on a host (default: 60)")
+  parser.add_option("--refresh", action="store_true", default=False,
+      help="Rescan EC2 instead of using the cached instance inventory")
+  (opts, args) = parser.parse_args()
+  if opts.host_file is None and len(args) < 2 or len(args) < 1:
+    parser.print_help()
+    sys.exit(1)
+  if opts.host_file is not None:
+    prefix = None
+  else:
+    prefix = args.pop(0)
+  return (opts, prefix, " ".join(args))
+
+def main():
+  (opts, prefix, command) = parse_args()
+  if opts.host_file is not None:
+    hosts = read_host_file(opts.host_file)
+  else:
+    index = ec2_inventory.load_index(ec2_client.connect(), refresh=opts.refresh)
+    hosts = [host for (name, host) in ec2_inventory.get_masters(index, prefix)]
+  if hosts == []:
+    print("No hosts found", file=sys.stderr)
+    sys.exit(1)
+  results = run_on_hosts(hosts, command, opts.identity_file, opts.user,
+                         opts.parallel, opts.timeout)
+  print_summary(results)
+  if [r for r in results if r[1] != 0]:
+    sys.exit(1)
+
+def read_host_file(path):
+  with open(path) as f:
+    return [line.strip() for line in f
+            if line.strip() != "" and not line.startswith("#")]
+
+# Run command on every host with at most `parallel` ssh sessions in flight.
+# Lines of output are printed as they arrive, prefixed with the host name.
+# Returns a list of (host, exit code, seconds) tuples in completion order;
+# the exit code is None for hosts where the command timed out.
+def run_on_hosts(hosts, command, identity_file=None, user="root",
+                 parallel=32, timeout=60, out=sys.stdout):
+  lock = threading.Lock()
+
+  def run(host):
+    start = time.time()
+    args = ["ssh", "-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=%d" % min(timeout, 10)]
+    if identity_file is not None:
+      args += ["-i", identity_file]
+    args += ["%s@%s" % (user, host), command]
+    with open(os.devnull) as devnull:
+      proc = subprocess.Popen(args, stdin=devnull, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    timed_out = []
+    def kill():
+      timed_out.append(True)
+      proc.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    for line in iter(proc.stdout.readline, b""):
+      with lock:
+        out.write("[%s] %s" % (host, line))
+        out.flush()
+    code = proc.wait()
+    timer.cancel()
+    if timed_out:
+      with lock:
+        out.write("[%s] timed out after %ds\n" % (host, timeout))
+      code = None
+    return (host, code, time.time() - start)
+
+  pool = ThreadPool(max(1, min(parallel, len(hosts))))
+  try:
+    return list(pool.imap_unordered(run, hosts))
+  finally:
+    pool.close()
+
+def print_summary(results):
+  print("")
+  print("%-50s %8s %10s" % ("HOST", "EXIT", "SECONDS"))
+  for (host, code, secs) in sorted(results):
+    print("%-50s %8s %10.2f" % (host, "timeout" if code is None else code,
+                                secs))
+  failed = len([r for r in results if r[1] != 0])
+  print("%d hosts, %d succeeded, %d failed" % (len(results),
+                                               len(results) - failed, failed))
+
+if __name__ == "__main__":
+  main()
@@ -8,30 +8,25 @@ import boto
 from optparse import OptionParser
 from boto import *
 
-def is_active(instance):
-  return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
+import ec2_client
+import ec2_inventory
 
 def main():
   parser = OptionParser(usage="get_masters [cluster_prefix]",
       add_help_option=True)
+  parser.add_option("--refresh", action="store_true", default=False,
+      help="Rescan EC2 instead of using the cached instance inventory")
   (opts, args) = parser.parse_args()
   if len(args) != 1:
-    get_cluster_masters()
+    get_cluster_masters(refresh=opts.refresh)
   else:
-    get_cluster_masters(args[0])
+    get_cluster_masters(args[0], refresh=opts.refresh)
 
-def get_cluster_masters(prefix=""):
-  conn = connect_ec2()
-  res = conn.get_all_instances()
-  # master reservations have only one node
-  masters = [i for i in res if len(i.instances) == 1]
-  master_instances = [m.instances[0] for m in masters if is_active(m.instances[0])]
-
-  name_host = [(m.tags['cluster'], m.public_dns_name) for m in master_instances if 'cluster' in m.tags]
-
-  for (name, host) in name_host:
-    if prefix in name:
-      print(name + " " + host)
+def get_cluster_masters(prefix="", refresh=False):
+  conn = ec2_client.connect()
+  index = ec2_inventory.load_index(conn, refresh=refresh)
+  for (name, host) in ec2_inventory.get_masters(index, prefix):
+    print(name + " " + host)
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Catalog of EC2 instance types and the hardware they give a Spark worker:
+# vCPUs, memory, number / size / type of local disks and network class.
+#
+# The catalog ships with the scripts as instance_types.json. Another catalog
+# can be loaded from a local path or an http(s) URL with load_catalog();
+# remote catalogs are cached on disk for CATALOG_TTL seconds and the cached
+# copy (or the bundled one) is used when the URL can't be fetched.
+
+from __future__ import with_statement
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib2
+
+BUNDLED_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "instance_types.json")
+
+CACHE_DIR = os.getenv("SPARK_EC2_CACHE_DIR",
+                      os.path.expanduser("~/.spark-ec2-cache"))
+
+# Seconds for which a downloaded catalog is used without refetching it
+CATALOG_TTL = 24 * 3600
+
+# Fields every catalog entry must have
+REQUIRED_FIELDS = ['vcpus', 'memory_mb', 'disks', 'disk_gb', 'disk_type',
+                   'network']
+
+# Catalogs loaded so far, by source, and the one lookups go to
+_catalogs = {}
+_active = None
+
+
+def _validate(catalog, source):
+  if not isinstance(catalog, dict):
+    raise ValueError("Instance catalog %s is not a JSON object" % source)
+  for (name, entry) in catalog.items():
+    missing = [f for f in REQUIRED_FIELDS if f not in entry]
+    if missing:
+      raise ValueError("Instance type %s in %s is missing %s" %
+                       (name, source, ", ".join(missing)))
+  return catalog
+
+
+def _read_catalog(path):
+  with open(path) as f:
+    return _validate(json.load(f), path)
+
+
+def _fetch_catalog(url, ttl):
+  if not os.path.isdir(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+  cache_file = os.path.join(CACHE_DIR, "instance-types-%s.json" %
+                            hashlib.sha1(url).hexdigest()[:12])
+  if os.path.exists(cache_file) and \
+      time.time() - os.path.getmtime(cache_file) < ttl:
+    return _read_catalog(cache_file)
+  try:
+    text = urllib2.urlopen(url, timeout=30).read()
+    catalog = _validate(json.loads(text), url)
+  except (IOError, ValueError) as e:
+    if os.path.exists(cache_file):
+      print >> sys.stderr, ("WARNING: Could not fetch instance catalog %s " +
+                            "(%s); using the cached copy") % (url, e)
+      return _read_catalog(cache_file)
+    print >> sys.stderr, ("WARNING: Could not fetch instance catalog %s " +
+                          "(%s); using the bundled catalog") % (url, e)
+    return _read_catalog(BUNDLED_CATALOG)
+  (fd, tmp_path) = tempfile.mkstemp(dir=CACHE_DIR, prefix=".instance-types")
+  with os.fdopen(fd, "w") as f:
+    f.write(text)
+  os.rename(tmp_path, cache_file)
+  return catalog
+
+
+# Load the catalog from source (a path or URL; the bundled catalog if None)
+# and make it the one get_instance_type() looks types up in
+def load_catalog(source=None, ttl=CATALOG_TTL):
+  global _active
+  if source not in _catalogs:
+    if source is None:
+      _catalogs[source] = _read_catalog(BUNDLED_CATALOG)
+    elif source.startswith("http://") or source.startswith("https://"):
+      _catalogs[source] = _fetch_catalog(source, ttl)
+    else:
+      _catalogs[source] = _read_catalog(source)
+  _active = _catalogs[source]
+  return _active
+
+
+# Get the catalog entry for an instance type, or None if it isn't listed
+def get_instance_type(instance_type):
+  if _active is None:
+    load_catalog()
+  return _active.get(instance_type)
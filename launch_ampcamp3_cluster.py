@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 import subprocess
 import sys
 import time
@@ -44,6 +45,14 @@ def parse_args():
       help="Action to be used while calling spark-ec2 (default: launch)")
   parser.add_option("--copy", action="store_true", default=False,
       help="Copy AMP Camp data to ephemeral HDFS after launching the cluster (default: false)")
+  parser.add_option("--in-process", action="store_true", default=False,
+      help="Run all launches inside this process instead of one spark-ec2 " +
+           "process per cluster, sharing one EC2 connection, AMI lookup " +
+           "and set of security groups (launch and destroy actions only)")
+  parser.add_option("--trace-file", default=None,
+      help="Write a Chrome trace-event timeline of the launches to this " +
+           "file; without --in-process each cluster gets its own " +
+           "<name>-<cluster>.json file")
 
   (opts, args) = parser.parse_args()
   if len(args) != 1:
@@ -55,88 +64,162 @@ def parse_args():
 def main():
   (opts, spark_script_path) = parse_args()
   availability_zones = ["us-east-1b", "us-east-1d", "us-east-1a"]
-  subprocesses = []
-  cluster_names = []
-
-  for cluster in range(opts.start_clusters, opts.start_clusters + opts.clusters):
-    # Sleep for `stagger` seconds
-    time.sleep(opts.stagger)
-
-    # Launch a cluster
-    args = []
-    args.append(spark_script_path)
-
-    args.append('-a')
-    args.append(opts.ami)
-    args.append('-k')
-    args.append(opts.key_pair)
-    args.append('-i')
-    args.append(opts.identity_file)
-    args.append('-s')
-    args.append(str(opts.slaves))
-    args.append('-t')
-    args.append(opts.instance_type)
-    args.append('-w')
-    args.append(opts.wait)
+  pending = ['ampcamp3-dryrun' + str(cluster) for cluster in
+             range(opts.start_clusters, opts.start_clusters + opts.clusters)]
+  if opts.in_process:
+    launch_in_process(spark_script_path, pending, opts)
+    return
+
+  # (process, cluster name) of the launches currently in flight
+  running = []
+  last_start = 0
+  num_success = 0
+  num_failed = 0
+
+  # Keep `parallel` launches in flight, starting the next cluster as soon
+  # as any launch finishes. `stagger` only rate-limits launch starts.
+  while running != [] or (pending != [] and num_failed == 0):
+    if pending != [] and len(running) < opts.parallel and num_failed == 0:
+      delay = last_start + opts.stagger - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      cluster_name = pending.pop(0)
+      running.append((start_launch(spark_script_path, cluster_name, opts),
+                      cluster_name))
+      last_start = time.time()
+      continue
+
+    finished = [(proc, name) for (proc, name) in running
+                if proc.poll() is not None]
+    if finished == []:
+      time.sleep(1)
+      continue
+    for (proc, name) in finished:
+      running.remove((proc, name))
+      if check_launch(name, opts):
+        num_success = num_success + 1
+      else:
+        num_failed = num_failed + 1
+        if pending != []:
+          print >> stderr, ("ERROR: Launch of " + name + " failed; " +
+                            "waiting for running launches and exiting")
+
+  if num_failed != 0:
+    print "ERROR: Failed to launch %d of %d clusters" % (
+        num_failed, num_success + num_failed)
+    sys.exit(-1)
+
+# Launch all clusters through spark_ec2.launch_fleet (or destroy them),
+# using the spark_ec2.py and boto found next to the given spark-ec2 script
+def launch_in_process(spark_script_path, cluster_names, opts):
+  if opts.action not in ["launch", "destroy"]:
+    print >> stderr, ("ERROR: --in-process only supports the launch and " +
+                      "destroy actions")
+    sys.exit(1)
+  spark_dir = os.path.dirname(os.path.abspath(spark_script_path))
+  sys.path.insert(0, spark_dir)
+  sys.path.insert(0, os.path.join(spark_dir,
+                                  "third_party/boto-2.4.1.zip/boto-2.4.1"))
+  import spark_ec2
+
+  # The cluster name is only a placeholder to satisfy spark_ec2's parser
+  (ec2_opts, action, _) = spark_ec2.parse_args(
+      get_spark_ec2_args(cluster_names[0], opts))
+  if opts.trace_file is not None:
+    spark_ec2.timeline.enable()
+  conn = spark_ec2.timeline.trace_connection(
+      spark_ec2.ec2_client.connect(ec2_opts.region))
+  try:
+    if opts.action == "destroy":
+      destroy_in_process(spark_ec2, conn, ec2_opts, cluster_names, opts)
+      return
+    results = spark_ec2.launch_fleet(conn, ec2_opts, cluster_names,
+                                     opts.parallel, opts.stagger)
+  finally:
+    spark_ec2.close_ssh_connections()
+    if opts.trace_file is not None:
+      spark_ec2.timeline.finish(opts.trace_file)
+
+  num_failed = 0
+  for result in results:
+    if result["success"]:
+      print "INFO: Cluster %s %s (%.0fs)" % (result["cluster"],
+                                             result["master"],
+                                             result["seconds"])
+    else:
+      num_failed = num_failed + 1
+      print "ERROR: Cluster %s: %s" % (result["cluster"], result["error"])
+  if num_failed != 0:
+    print "ERROR: Failed to launch %d of %d clusters" % (num_failed,
+                                                         len(results))
+    sys.exit(-1)
+
+# Terminate all clusters with batched calls, without prompting
+def destroy_in_process(spark_ec2, conn, ec2_opts, cluster_names, opts):
+  clusters = spark_ec2.find_clusters(conn, cluster_names)
+  if clusters == {}:
+    print "INFO: No clusters to destroy"
+    return
+  spark_ec2.destroy_clusters(conn, ec2_opts, clusters, parallel=opts.parallel)
+  for name in sorted(clusters):
+    print "INFO: Cluster %s destroyed (%d instances)" % (name,
+                                                        len(clusters[name]))
+
+def start_launch(spark_script_path, cluster_name, opts):
+  args = [spark_script_path] + get_spark_ec2_args(cluster_name, opts)
+  if opts.trace_file is not None:
+    args[1:1] = ['--trace-file', "%s-%s.json" % (
+        os.path.splitext(opts.trace_file)[0], cluster_name)]
+  print "Launching " + cluster_name
+  print  args
+  return subprocess.Popen(args, stdout=open("/tmp/" + cluster_name + "-" + opts.action + ".out", "w"),
+                          stderr=open("/tmp/" + cluster_name + "-" + opts.action + ".err", "w"))
+
+# Get the spark-ec2 command-line arguments for one cluster
+def get_spark_ec2_args(cluster_name, opts):
+  args = []
+
+  args.append('-a')
+  args.append(opts.ami)
+  args.append('-k')
+  args.append(opts.key_pair)
+  args.append('-i')
+  args.append(opts.identity_file)
+  args.append('-s')
+  args.append(str(opts.slaves))
+  args.append('-t')
+  args.append(opts.instance_type)
+  args.append('-w')
+  args.append(str(opts.wait))
 
 #   NOTE(shivaram): Don't pass availability zone as EC2 will pick one on its own
 #   args.append('-z')
 #   args.append(availability_zones[cluster % len(availability_zones)])
 
-    if opts.copy:
-      args.append('--copy')
-
-    args.append(opts.action)
-
-    cluster_name = 'ampcamp3-dryrun' + str(cluster)
-    args.append(cluster_name)
-
-    print "Launching " + cluster_name
-    print  args
-    proc = subprocess.Popen(args, stdout=open("/tmp/" + cluster_name + "-" + opts.action + ".out", "w"),
-                            stderr=open("/tmp/" + cluster_name + "-" + opts.action + ".err", "w"))
-    subprocesses.append(proc)
-    cluster_names.append(cluster_name)
-
-    # Wait for all the parallel launches to finish
-    if (len(subprocesses) == opts.parallel):
-      ret = wait_and_check(subprocesses, cluster_names, opts)
-      subprocesses = []
-      cluster_names = []
-      if ret != 0:
-        print >> stderr, ("ERROR: Wait and check failed. Exiting")
-        sys.exit(-1)
-
-  if (len(subprocesses) != 0):
-    wait_and_check(subprocesses, cluster_names, opts)
-
-def wait_and_check(subprocesses, cluster_names, opts):
-  num_success = 0
-  num_spark_failed = 0
-  print "Waiting for parallel launches to finish...."
-  # Print out details about clusters we launched 
-  for p in range(0, len(subprocesses)):
-    subprocesses[p].wait()
-    p_stderr = open("/tmp/" + cluster_names[p] + "-" + opts.action + ".err")
-    p_stdout = open("/tmp/" + cluster_names[p] + "-" + opts.action + ".out")
-    errs = p_stderr.readlines()
-    for err in errs:
-      if "SUCCESS:" in err:
-        num_success = num_success + 1
-        parts = err.split()
-        master_name = parts[len(parts) - 1]
-        master_name = master_name.replace('\r', '' )
-        print "INFO: Cluster " + cluster_names[p] + " " + master_name.strip() + "\n"
-        break
-      elif "ERROR: spark-check" in err:
-        num_spark_failed = num_spark_failed + 1
-        break
-
-  if (num_success != len(subprocesses)):
-    print "ERROR: Failed to launch all clusters " + str(num_spark_failed) + " failed spark check"
-    return -1
-  else:
-    return 0
+  if opts.copy:
+    args.append('--copy')
+
+  args.append(opts.action)
+  args.append(cluster_name)
+  return args
+
+# Print out details about a cluster whose launch finished.
+# Returns True if the launch succeeded.
+def check_launch(cluster_name, opts):
+  p_stderr = open("/tmp/" + cluster_name + "-" + opts.action + ".err")
+  errs = p_stderr.readlines()
+  for err in errs:
+    if "SUCCESS:" in err:
+      parts = err.split()
+      master_name = parts[len(parts) - 1]
+      master_name = master_name.replace('\r', '' )
+      print "INFO: Cluster " + cluster_name + " " + master_name.strip() + "\n"
+      return True
+    elif "ERROR: spark-check" in err:
+      print "ERROR: Cluster " + cluster_name + " failed spark check"
+      return False
+  print "ERROR: Cluster " + cluster_name + " failed to launch"
+  return False
 
 if __name__ == "__main__":
   logging.basicConfig()
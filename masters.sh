@@ -13,4 +13,4 @@ MASTERS_FILE=$2
 shift
 shift
 
-pssh -i -x "-i $KEY_FILE" -l root -h $MASTERS_FILE "$@"
+"`dirname $0`/fanout" -i $KEY_FILE -f $MASTERS_FILE "$@"
@@ -19,37 +19,103 @@
 
 from __future__ import with_statement
 
+import atexit
+import copy
+import fcntl
+import hashlib
+import httplib
 import logging
+import math
 import os
+import pipes
+import Queue
 import random
+import re
 import shutil
+import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import urllib2
 import json
+from cStringIO import StringIO
 from optparse import OptionParser
 from sys import stderr
 import boto
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType
-from boto import ec2
+from multiprocessing.pool import ThreadPool
+
+import ec2_client
+import ec2_inventory
+import instance_catalog
+import timeline
+from ec2_inventory import ACTIVE_STATES, iter_reservations
 
 # A static URL from which to figure out the latest Mesos EC2 AMI
 LATEST_AMI_URL = "http://s3.amazonaws.com/ampcamp-amis/latest-ampcamp3"
 
+# Repository and branch holding the setup scripts run on the master
+SETUP_REPO_URL = "https://github.com/mesos/spark-ec2.git"
+SETUP_REPO_BRANCH = "ampcamp3"
+
+# Local directory for cached setup scripts and other launch data
+CACHE_DIR = os.getenv("SPARK_EC2_CACHE_DIR",
+                      os.path.expanduser("~/.spark-ec2-cache"))
+
+# Seconds before the cached setup repository is refreshed from GitHub
+SETUP_REPO_TTL = 3600
+
+# Fraction of the expected worker memory below which a worker is flagged
+MEMORY_TOLERANCE = 0.9
+
+# A worker whose probe is this many times slower than the median is flagged
+STRAGGLER_FACTOR = 2.0
+
+# Most instance IDs sent in one EC2 call (TerminateInstances, StopInstances,
+# StartInstances or an ID-filtered DescribeInstances)
+INSTANCE_BATCH_SIZE = 500
+
+# Seconds EC2 gets to report started instances as pending before start gives
+# up on those still stopped (EC2 puts them back for lack of capacity)
+START_GRACE = 60
+
+# File on the master recording the hashes of the files deploy_files rendered
+DEPLOY_MANIFEST = "/root/.spark-ec2-deploy-manifest"
+
+# File on the master's root volume recording the setup key (see
+# get_setup_key) of the last complete setup, so that start can skip setup
+SETUP_MARKER = "/root/.spark-ec2-setup-done"
+
+# Template placeholders, e.g. {{slave_list}}
+TEMPLATE_PATTERN = re.compile(r"\{\{([^{}]*)\}\}")
+
 
 # Configure and parse our command-line arguments
-def parse_args():
+def parse_args(argv=None):
   parser = OptionParser(usage="spark-ec2 [options] <action> <cluster_name>"
-      + "\n\n<action> can be: launch, destroy, login, stop, start, get-master",
+      + "\n\n<action> can be: launch, destroy, login, stop, start, get-master,\n" +
+      "diagnose",
       add_help_option=False)
   parser.add_option("-h", "--help", action="help",
                     help="Show this help message and exit")
   parser.add_option("-s", "--slaves", type="int", default=5,
       help="Number of slaves to launch (default: 1)")
   parser.add_option("-w", "--wait", type="int", default=120,
-      help="Seconds to wait for nodes to start (default: 120)")
+      help="Maximum seconds to wait for nodes to accept SSH after they " +
+           "start running (default: 120)")
+  parser.add_option("--ssh-quorum", type="float", default=1.0,
+      help="Fraction of slaves that must accept SSH before setup starts; " +
+           "the master is always required (default: 1.0)")
+  parser.add_option("--pipeline", action="store_true", default=False,
+      help="Prepare each node as soon as it accepts SSH and start the " +
+           "cluster setup once the master and --pipeline-fraction of the " +
+           "slaves are ready; later slaves join afterwards (launch only)")
+  parser.add_option("--pipeline-fraction", type="float", default=0.8,
+      help="Fraction of slaves that must be prepared before setup starts " +
+           "in --pipeline mode (default: 0.8)")
   parser.add_option("-k", "--key-pair",
       help="Key pair to use on instances")
   parser.add_option("-i", "--identity-file",
@@ -83,6 +149,14 @@ def parse_args():
   parser.add_option("--spot-price", metavar="PRICE", type="float",
       help="If specified, launch slaves as spot instances with the given " +
             "maximum price (in dollars)")
+  parser.add_option("--spot-timeout", type="int", default=0,
+      help="Seconds to wait for spot requests to be granted before applying " +
+           "--spot-fallback (default: 0, wait forever)")
+  parser.add_option("--spot-fallback", type="choice",
+      choices=["on-demand", "partial"], default="on-demand",
+      help="What to do with the slaves not granted by --spot-timeout: " +
+           "'on-demand' launches them as on-demand instances, 'partial' " +
+           "continues with the granted slaves only (default: on-demand)")
   parser.add_option("-g", "--ganglia", action="store_true", default=True,
       help="Setup ganglia monitoring for the cluster. NOTE: The ganglia " +
       "monitoring page will be publicly accessible")
@@ -90,10 +164,36 @@ def parse_args():
       help="The ssh user you want to connect as (default: root)")
   parser.add_option("--delete-groups", action="store_true", default=False,
       help="When destroying a cluster, also destroy the security groups that were created")
+  parser.add_option("--prefix", action="store_true", default=False,
+      help="Destroy, stop or start every cluster whose name starts with " +
+           "the given cluster name (or with one of several comma-separated " +
+           "ones)")
+  parser.add_option("--full-setup", action="store_true", default=False,
+      help="On start, run the complete setup again even if it already " +
+           "completed on the master's root volume")
 
   parser.add_option("--copy", action="store_true", default=False,
       help="Copy AMP Camp data from S3 to ephemeral HDFS after " +
            "launching the cluster (default: false)")
+  parser.add_option("--spark-timeout", type="int", default=300,
+      help="Seconds to wait for all Spark workers to register with the " +
+           "master before giving up (default: 300)")
+  parser.add_option("--probe", action="store_true", default=False,
+      help="With diagnose, also time a disk write and a CPU loop on every " +
+           "slave to find slow nodes")
+  parser.add_option("--trace-file", default=None,
+      help="Record how long each phase and each ssh and EC2 call took, " +
+           "write it to this file in Chrome trace-event format and print " +
+           "a summary at exit")
+  parser.add_option("--api-stats", default=None,
+      help="Print per-operation EC2 API call, retry and latency counts at " +
+           "exit to this file, or to stderr for '-'")
+  parser.add_option("--instance-catalog", default=None,
+      help="Path or http(s) URL of a JSON instance type catalog to use " +
+           "instead of the bundled instance_types.json")
+  parser.add_option("--copy-parallel", type="int", default=3,
+      help="Number of AMP Camp datasets copied into HDFS at the same " +
+           "time (default: 3)")
 
   parser.add_option("--s3-stats-bucket", default="default",
       help="S3 bucket to copy ampcamp data  from (default: ampcamp-data/wikistats_20090505-01)")
@@ -111,7 +211,7 @@ def parse_args():
            "are sure you want to destroy a cluster (default: false)")
 
 
-  (opts, args) = parser.parse_args()
+  (opts, args) = parser.parse_args(argv)
   if len(args) != 2:
     parser.print_help()
     sys.exit(1)
@@ -120,6 +220,15 @@ def parse_args():
     print >> stderr, ("ERROR: The -i or --identity-file argument is " +
                       "required for " + action)
     sys.exit(1)
+  if not 0 < opts.ssh_quorum <= 1:
+    print >> stderr, "ERROR: --ssh-quorum must be above 0 and at most 1"
+    sys.exit(1)
+  if not 0 < opts.pipeline_fraction <= 1:
+    print >> stderr, "ERROR: --pipeline-fraction must be above 0 and at most 1"
+    sys.exit(1)
+  if opts.copy_parallel < 1:
+    print >> stderr, "ERROR: --copy-parallel must be at least 1"
+    sys.exit(1)
 
   # Boto config check
   # http://boto.cloudhackers.com/en/latest/boto_config_tut.html
@@ -137,9 +246,11 @@ def parse_args():
   return (opts, action, cluster_name)
 
 
-# Get the EC2 security group of the given name, creating it if it doesn't exist
-def get_or_make_group(conn, name):
-  groups = conn.get_all_security_groups()
+# Get the EC2 security group of the given name, creating it if it doesn't exist.
+# `groups` may be passed in to avoid listing all security groups again.
+def get_or_make_group(conn, name, groups=None):
+  if groups is None:
+    groups = conn.get_all_security_groups()
   group = [g for g in groups if g.name == name]
   if len(group) > 0:
     return group[0]
@@ -148,35 +259,88 @@ def get_or_make_group(conn, name):
     return conn.create_security_group(name, "Spark EC2 group")
 
 
+# Refresh the state of a set of instances with one ID-filtered
+# DescribeInstances call per INSTANCE_BATCH_SIZE instances, instead of one
+# i.update() call per instance. Instances that EC2 doesn't know about yet
+# (eventual consistency right after RunInstances) keep their previous state.
+def refresh_instances(conn, instances):
+  ids = [i.id for i in instances]
+  by_id = {}
+  for start in range(0, len(ids), INSTANCE_BATCH_SIZE):
+    try:
+      reservations = conn.get_all_instances(
+          instance_ids=ids[start:start + INSTANCE_BATCH_SIZE])
+    except boto.exception.EC2ResponseError as e:
+      if e.error_code == "InvalidInstanceID.NotFound":
+        continue
+      raise
+    for res in reservations:
+      for i in res.instances:
+        by_id[i.id] = i
+  for i in instances:
+    if i.id in by_id:
+      i._update(by_id[i.id])
+
+
+# Count how many of the given instances are in each state
+def count_states(instances):
+  counts = {}
+  for i in instances:
+    counts[i.state] = counts.get(i.state, 0) + 1
+  return counts
+
+
 # Wait for a set of launched instances to exit the "pending" state
-# (i.e. either to start running or to fail and be terminated)
-def wait_for_instances(conn, instances):
+# (i.e. either to start running or to fail and be terminated), or more
+# generally to leave all of wait_states, for at most timeout seconds if
+# given. The whole set is polled in one call per tick; the poll interval
+# doubles (up to max_interval) while nothing changes and resets on any
+# transition.
+# Returns the instances still in one of wait_states.
+@timeline.traced("phase")
+def wait_for_instances(conn, instances, wait_states=None,
+                       min_interval=2, max_interval=30, timeout=None):
+  if wait_states is None:
+    wait_states = ['pending']
+  if timeout is not None:
+    deadline = time.time() + timeout
+  interval = min_interval
+  last_counts = None
   while True:
-    for i in instances:
-      i.update()
-    if len([i for i in instances if i.state == 'pending']) > 0:
-      time.sleep(5)
+    refresh_instances(conn, instances)
+    counts = count_states(instances)
+    if counts != last_counts:
+      print "Instance states: " + ", ".join(
+          ["%d %s" % (counts[s], s) for s in sorted(counts)])
+      interval = min_interval
     else:
-      return
-
-
-# Check whether a given EC2 instance object is in a state we consider active,
-# i.e. not terminating or terminated. We count both stopping and stopped as
-# active since we can restart stopped clusters.
-def is_active(instance):
-  return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
-
-
-# Launch a cluster of the given name, by setting up its security groups,
-# and then starting new instances in them.
-# Returns a tuple of EC2 reservation objects for the master, slave
-# and zookeeper instances (in that order).
-# Fails if there already instances running in the cluster's groups.
-def launch_cluster(conn, opts, cluster_name):
+      interval = min(interval * 2, max_interval)
+    last_counts = counts
+    waiting = [i for i in instances if i.state in wait_states]
+    if waiting == [] or (timeout is not None and time.time() >= deadline):
+      return waiting
+    if timeout is not None:
+      interval = min(interval, max(0, deadline - time.time()))
+    time.sleep(interval)
+
+
+# Iterate over the instances matching the given EC2 filters, one page of
+# DescribeInstances results at a time
+def iter_instances(conn, filters):
+  for res in iter_reservations(conn, filters):
+    for instance in res.instances:
+      yield instance
+
+
+# Get (creating and authorizing them if needed) the master, slave and
+# zookeeper security groups shared by all AMP Camp clusters
+@timeline.traced("phase")
+def setup_security_groups(conn, opts):
   print "Setting up security groups..."
-  master_group = get_or_make_group(conn, "ampcamp3-master")
-  slave_group = get_or_make_group(conn, "ampcamp3-slaves")
-  zoo_group = get_or_make_group(conn, "ampcamp3-zoo")
+  groups = conn.get_all_security_groups()
+  master_group = get_or_make_group(conn, "ampcamp3-master", groups)
+  slave_group = get_or_make_group(conn, "ampcamp3-slaves", groups)
+  zoo_group = get_or_make_group(conn, "ampcamp3-zoo", groups)
   if master_group.rules == []: # Group was just now created
     master_group.authorize(src_group=master_group)
     master_group.authorize(src_group=slave_group)
@@ -211,15 +375,13 @@ def launch_cluster(conn, opts, cluster_name):
     zoo_group.authorize('tcp', 2181, 2181, '0.0.0.0/0')
     zoo_group.authorize('tcp', 2888, 2888, '0.0.0.0/0')
     zoo_group.authorize('tcp', 3888, 3888, '0.0.0.0/0')
+  return (master_group, slave_group, zoo_group)
 
-  # Check if instances are already running in our groups
-  active_nodes = get_existing_cluster(conn, opts, cluster_name,
-                                      die_on_error=False)
-  if any(active_nodes):
-    print >> stderr, ("ERROR: There are already instances running in " +
-        "group %s, %s or %s" % (master_group.name, slave_group.name, zoo_group.name))
-    sys.exit(1)
 
+# Resolve opts.ami, following the 'latest' pointer if needed, and return the
+# corresponding EC2 image. Exits if the AMI can't be found.
+@timeline.traced("phase")
+def resolve_ami(conn, opts):
   # Figure out the latest AMI from our static URL
   if opts.ami == "latest":
     try:
@@ -229,14 +391,39 @@ def launch_cluster(conn, opts, cluster_name):
       print >> stderr, "Could not read " + LATEST_AMI_URL
       sys.exit(1)
 
-  print "Launching instances..."
-
   try:
-    image = conn.get_all_images(image_ids=[opts.ami])[0]
+    return conn.get_all_images(image_ids=[opts.ami])[0]
   except:
     print >> stderr, "Could not find AMI " + opts.ami
     sys.exit(1)
 
+
+# Launch a cluster of the given name, by setting up its security groups,
+# and then starting new instances in them.
+# Returns a tuple of EC2 reservation objects for the master, slave
+# and zookeeper instances (in that order).
+# Fails if there already instances running in the cluster's groups.
+# The security groups and image can be passed in when launching several
+# clusters so that they are only looked up once.
+@timeline.traced("phase")
+def launch_cluster(conn, opts, cluster_name, groups=None, image=None):
+  if groups is None:
+    groups = setup_security_groups(conn, opts)
+  (master_group, slave_group, zoo_group) = groups
+
+  # Check if instances are already running in our groups
+  active_nodes = get_existing_cluster(conn, opts, cluster_name,
+                                      die_on_error=False)
+  if any(active_nodes):
+    print >> stderr, ("ERROR: There are already instances running in " +
+        "group %s, %s or %s" % (master_group.name, slave_group.name, zoo_group.name))
+    sys.exit(1)
+
+  if image is None:
+    image = resolve_ami(conn, opts)
+
+  print "Launching instances..."
+
   # Create block device mapping so that we can add an EBS volume if asked to
   block_map = BlockDeviceMapping()
   if opts.ebs_vol_size > 0:
@@ -245,12 +432,39 @@ def launch_cluster(conn, opts, cluster_name):
     device.delete_on_termination = True
     block_map["/dev/sdv"] = device
 
+  # Launch the master in the background so that it doesn't wait behind the
+  # slave launches. It is tagged right away so that it can be found (and
+  # cleaned up) even if launching the slaves fails.
+  slave_zones = get_zones(conn, opts)
+  master_type = opts.master_instance_type
+  if master_type == "":
+    master_type = opts.instance_type
+  if opts.zone == 'all':
+    opts.zone = random.choice(slave_zones)
+
+  def launch_master():
+    master_res = image.run(key_name = opts.key_pair,
+                           security_groups = [master_group],
+                           instance_type = master_type,
+                           placement = opts.zone,
+                           min_count = 1,
+                           max_count = 1,
+                           block_device_map = block_map)
+    print "Launched master in %s, regid = %s" % (opts.zone, master_res.id)
+    tag_instances(conn, master_res.instances,
+                  {'cluster': cluster_name, 'type': 'master'})
+    return master_res.instances
+
+  master_pool = ThreadPool(1)
+  master_launch = master_pool.apply_async(launch_master)
+  master_pool.close()
+
   # Launch slaves
   if opts.spot_price != None:
     # Launch spot instances with the requested price
     print ("Requesting %d slaves as spot instances with price $%.3f" %
            (opts.slaves, opts.spot_price))
-    zones = get_zones(conn, opts)
+    zones = slave_zones
     num_zones = len(zones)
     i = 0
     my_req_ids = []
@@ -271,86 +485,49 @@ def launch_cluster(conn, opts, cluster_name):
 
     print "Waiting for spot instances to be granted..."
     try:
-      while True:
-        time.sleep(10)
-        reqs = conn.get_all_spot_instance_requests()
-        id_to_req = {}
-        for r in reqs:
-          id_to_req[r.id] = r
-        active_instance_ids = []
-        for i in my_req_ids:
-          if i in id_to_req and id_to_req[i].state == "active":
-            active_instance_ids.append(id_to_req[i].instance_id)
-        if len(active_instance_ids) == opts.slaves:
-          print "All %d slaves granted" % opts.slaves
-          reservations = conn.get_all_instances(active_instance_ids)
-          slave_nodes = []
-          for r in reservations:
-            slave_nodes += r.instances
-          break
-        else:
-          print "%d of %d slaves granted, waiting longer" % (
-            len(active_instance_ids), opts.slaves)
+      active_instance_ids = wait_for_spot_requests(conn, opts, my_req_ids)
+      slave_nodes = []
+      if active_instance_ids != []:
+        for r in conn.get_all_instances(active_instance_ids):
+          slave_nodes += r.instances
+      shortfall = opts.slaves - len(slave_nodes)
+      if shortfall > 0 and opts.spot_fallback == "on-demand":
+        print "Launching the remaining %d slaves as on-demand instances" % (
+            shortfall)
+        slave_nodes += launch_slaves(conn, opts, image, slave_group,
+                                     block_map, shortfall, slave_zones)
+      elif shortfall > 0:
+        # A cluster without slaves is a failed launch, cleaned up below
+        if slave_nodes == []:
+          print >> stderr, "ERROR: No spot instances were granted"
+          raise Exception("No spot instances were granted")
+        print "Continuing with %d of %d slaves" % (len(slave_nodes),
+                                                    opts.slaves)
+        # The Spark health check expects opts.slaves workers
+        opts.slaves = len(slave_nodes)
     except:
       print "Canceling spot instance requests"
       conn.cancel_spot_instance_requests(my_req_ids)
-      # Log a warning if any of these requests actually launched instances:
-      (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-          conn, opts, cluster_name, die_on_error=False)
-      running = len(master_nodes) + len(slave_nodes) + len(zoo_nodes)
-      if running:
-        print >> stderr, ("WARNING: %d instances are still running" % running)
-      sys.exit(0)
+      # Requests granted before the cancellation have launched instances
+      reqs = conn.get_all_spot_instance_requests(request_ids=my_req_ids)
+      abandon_launch(conn, master_pool, master_launch,
+                     [r.instance_id for r in reqs if r.instance_id])
+      raise
   else:
     # Launch non-spot instances
-    zones = get_zones(conn, opts)
-    num_zones = len(zones)
-    i = 0
-    slave_nodes = []
-    for zone in zones:
-      num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-      if num_slaves_this_zone > 0:
-        slave_res = image.run(key_name = opts.key_pair,
-                              security_groups = [slave_group],
-                              instance_type = opts.instance_type,
-                              placement = zone,
-                              min_count = num_slaves_this_zone,
-                              max_count = num_slaves_this_zone,
-                              block_device_map = block_map)
-        slave_nodes += slave_res.instances
-        print "Launched %d slaves in %s, regid = %s" % (num_slaves_this_zone,
-                                                        zone, slave_res.id)
-      i += 1
+    try:
+      slave_nodes = launch_slaves(conn, opts, image, slave_group, block_map,
+                                  opts.slaves, slave_zones)
+    except:
+      # Don't leave the master running without any slaves
+      abandon_launch(conn, master_pool, master_launch, [])
+      raise
 
-  # Launch masters
-  master_type = opts.master_instance_type
-  if master_type == "":
-    master_type = opts.instance_type
-  if opts.zone == 'all':
-    opts.zone = random.choice(conn.get_all_zones()).name
-  master_res = image.run(key_name = opts.key_pair,
-                         security_groups = [master_group],
-                         instance_type = master_type,
-                         placement = opts.zone,
-                         min_count = 1,
-                         max_count = 1,
-                         block_device_map = block_map)
-  master_nodes = master_res.instances
-  print "Launched master in %s, regid = %s" % (zone, master_res.id)
-
-  time.sleep(20)
-
-  # Create the right tags
-  tags = {}
-  tags['cluster'] = cluster_name
-
-  tags['type'] = 'slave'
-  for node in slave_nodes:
-    conn.create_tags([node.id], tags)
-
-  tags['type'] = 'master'
-  for node in master_nodes:
-    conn.create_tags([node.id], tags)
+  # Create the right tags, with one call per role; the slaves are tagged
+  # while the master may still be launching
+  tag_instances(conn, slave_nodes, {'cluster': cluster_name, 'type': 'slave'})
+
+  master_nodes = master_launch.get()
 
   zoo_nodes = []
 
@@ -358,28 +535,215 @@ def launch_cluster(conn, opts, cluster_name):
   return (master_nodes, slave_nodes, zoo_nodes)
 
 
+# Clean up after launch_cluster failed: wait for the background master
+# launch and terminate the master along with the given instance IDs, so that
+# nothing is left running (untagged slaves can't even be found by destroy)
+def abandon_launch(conn, master_pool, master_launch, instance_ids):
+  master_pool.join()
+  if master_launch.successful():
+    instance_ids = [i.id for i in master_launch.get()] + instance_ids
+  terminate_leftovers(conn, instance_ids)
+
+
+# Terminate instances left over from a failed launch. Freshly launched
+# instances may not be visible yet, so this retries like tag_instances.
+# Failures are only reported, with the instance IDs, so that the caller
+# can go on to raise the launch's own error.
+def terminate_leftovers(conn, instance_ids, max_tries=8):
+  if instance_ids == []:
+    return
+  print >> stderr, "Terminating %d instances of the failed launch: %s" % (
+      len(instance_ids), " ".join(instance_ids))
+  delay = 1
+  tries = 0
+  for start in range(0, len(instance_ids), INSTANCE_BATCH_SIZE):
+    while True:
+      try:
+        conn.terminate_instances(
+            instance_ids[start:start + INSTANCE_BATCH_SIZE])
+        break
+      except boto.exception.EC2ResponseError as e:
+        tries = tries + 1
+        if e.error_code != "InvalidInstanceID.NotFound" or tries >= max_tries:
+          print >> stderr, ("WARNING: Could not terminate %s: %s" %
+                            (" ".join(instance_ids), e))
+          return
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+
+
+# EC2 error codes meaning that a zone can't run our instances right now
+ZONE_CAPACITY_ERRORS = ["InsufficientInstanceCapacity", "Unsupported"]
+
+
+# Launch num_slaves on-demand slaves spread over the given zones, with the
+# RunInstances calls for different zones sent concurrently (at most
+# `parallel` at a time). If a zone has no capacity, its share is spread
+# over the remaining zones. If the launch fails, the slaves launched so far
+# are terminated.
+# Returns the list of launched instances.
+@timeline.traced("phase")
+def launch_slaves(conn, opts, image, slave_group, block_map, num_slaves,
+                  zones=None, parallel=4):
+  if zones is None:
+    zones = get_zones(conn, opts)
+  zones = list(zones)
+
+  def launch_in_zone(zone_share):
+    (zone, num_slaves_this_zone) = zone_share
+    try:
+      slave_res = image.run(key_name = opts.key_pair,
+                            security_groups = [slave_group],
+                            instance_type = opts.instance_type,
+                            placement = zone,
+                            min_count = num_slaves_this_zone,
+                            max_count = num_slaves_this_zone,
+                            block_device_map = block_map)
+    except Exception as e:
+      return (zone, num_slaves_this_zone, None, e)
+    print "Launched %d slaves in %s, regid = %s" % (num_slaves_this_zone,
+                                                    zone, slave_res.id)
+    return (zone, num_slaves_this_zone, slave_res.instances, None)
+
+  slave_nodes = []
+  remaining = num_slaves
+  try:
+    while remaining > 0:
+      if zones == []:
+        print >> stderr, ("ERROR: No zone has capacity for the remaining " +
+                          "%d slaves") % remaining
+        raise Exception("Not enough capacity for %d slaves" % remaining)
+      shares = [(zone, get_partition(remaining, len(zones), i))
+                for (i, zone) in enumerate(zones)]
+      shares = [(zone, n) for (zone, n) in shares if n > 0]
+      pool = ThreadPool(min(parallel, len(shares)))
+      try:
+        results = pool.map(launch_in_zone, shares)
+      finally:
+        pool.close()
+      # Keep what was launched before looking at the errors, so that it is
+      # terminated if one of them fails the launch
+      for (zone, num_slaves_this_zone, instances, error) in results:
+        if error is None:
+          slave_nodes += instances
+          remaining -= num_slaves_this_zone
+      for (zone, num_slaves_this_zone, instances, error) in results:
+        if error is None:
+          continue
+        if getattr(error, "error_code", None) not in ZONE_CAPACITY_ERRORS:
+          raise error
+        print "No capacity for %d slaves in %s (%s), redistributing" % (
+            num_slaves_this_zone, zone, error.error_code)
+        zones.remove(zone)
+  except:
+    # The slaves aren't tagged yet, so nothing else could find them
+    terminate_leftovers(conn, [i.id for i in slave_nodes])
+    raise
+  return slave_nodes
+
+
+# Wait for our spot instance requests to be fulfilled, polling only those
+# request IDs. The poll interval grows while nothing changes and resets
+# when more requests are granted. If opts.spot_timeout passes (or no request
+# can be granted any more) the still-open requests are cancelled.
+# Prints the granted-versus-requested timeline and returns the IDs of the
+# instances granted so far.
+@timeline.traced("phase")
+def wait_for_spot_requests(conn, opts, req_ids, min_interval=5,
+                           max_interval=30):
+  start = time.time()
+  interval = min_interval
+  granted = []
+  active_instance_ids = []
+  while True:
+    time.sleep(interval)
+    try:
+      reqs = conn.get_all_spot_instance_requests(request_ids=req_ids)
+    except boto.exception.EC2ResponseError as e:
+      # New requests may not be visible yet
+      if e.error_code == "InvalidSpotInstanceRequestID.NotFound":
+        continue
+      raise
+    active_instance_ids = [r.instance_id for r in reqs if r.state == "active"]
+    open_ids = [r.id for r in reqs if r.state == "open"]
+    elapsed = time.time() - start
+    if granted == [] or granted[-1][1] != len(active_instance_ids):
+      granted.append((elapsed, len(active_instance_ids)))
+      interval = min_interval
+    else:
+      interval = min(interval * 2, max_interval)
+
+    if len(active_instance_ids) == len(req_ids):
+      print "All %d slaves granted" % len(req_ids)
+      break
+    elif open_ids == []:
+      print "%d of %d slaves granted, no open requests left" % (
+          len(active_instance_ids), len(req_ids))
+      break
+    elif opts.spot_timeout > 0 and elapsed >= opts.spot_timeout:
+      print "%d of %d slaves granted after %d seconds, giving up on the rest" % (
+          len(active_instance_ids), len(req_ids), opts.spot_timeout)
+      conn.cancel_spot_instance_requests(open_ids)
+      # Keep instances from requests fulfilled just before the cancellation
+      reqs = conn.get_all_spot_instance_requests(request_ids=req_ids)
+      active_instance_ids = [r.instance_id for r in reqs if r.instance_id]
+      break
+    else:
+      print "%d of %d slaves granted, waiting longer" % (
+          len(active_instance_ids), len(req_ids))
+  print "Spot fulfilment timeline: " + ", ".join(
+      ["%ds %d/%d" % (t, n, len(req_ids)) for (t, n) in granted])
+  return active_instance_ids
+
+
+# Tag a set of instances with a single CreateTags call. Freshly launched
+# instances may not be visible to CreateTags yet (EC2 is eventually
+# consistent), so retry with a short exponential backoff in that case.
+@timeline.traced("phase")
+def tag_instances(conn, instances, tags, max_tries=8):
+  if instances == []:
+    return
+  ids = [i.id for i in instances]
+  delay = 1
+  tries = 0
+  while True:
+    try:
+      conn.create_tags(ids, tags)
+      return
+    except boto.exception.EC2ResponseError as e:
+      tries = tries + 1
+      if e.error_code != "InvalidInstanceID.NotFound" or tries >= max_tries:
+        raise
+      time.sleep(delay)
+      delay = min(delay * 2, 10)
+
+
 # Get the EC2 instances in an existing cluster if available.
 # Returns a tuple of lists of EC2 instance objects for the masters,
 # slaves and zookeeper nodes (in that order).
-def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
+# With cached=True the (possibly slightly stale) shared inventory index is
+# used and read-only instance records are returned instead; only use this
+# for actions that don't modify the instances.
+def get_existing_cluster(conn, opts, cluster_name, die_on_error=True,
+                         cached=False):
   print "Searching for existing cluster " + cluster_name + "..."
-  reservations = conn.get_all_instances()
-  master_nodes = []
-  slave_nodes = []
-  zoo_nodes = []
-  for res in reservations:
-    active = [i for i in res.instances if is_active(i)]
-    if len(active) > 0:
-      for instance in res.instances:
-        if 'tags' in instance.__dict__ and 'cluster' in instance.tags \
-          and 'type' in instance.tags:
-            if instance.tags['cluster'] == cluster_name:
-              if instance.tags['type'] == 'master':
-                master_nodes.append(instance)
-              elif instance.tags['type'] == 'slave':
-                slave_nodes.append(instance)
-              elif instance.tags['type'] == 'zoo':
-                zoo_nodes.append(instance)
+  if cached:
+    (master_nodes, slave_nodes, zoo_nodes) = ec2_inventory.get_cluster(
+        ec2_inventory.load_index(conn), cluster_name)
+  else:
+    master_nodes = []
+    slave_nodes = []
+    zoo_nodes = []
+    filters = {'tag:cluster': cluster_name,
+               'instance-state-name': ACTIVE_STATES}
+    for instance in iter_instances(conn, filters):
+      node_type = instance.tags.get('type')
+      if node_type == 'master':
+        master_nodes.append(instance)
+      elif node_type == 'slave':
+        slave_nodes.append(instance)
+      elif node_type == 'zoo':
+        zoo_nodes.append(instance)
 
   if any((master_nodes, slave_nodes, zoo_nodes)):
     print ("Found %d master(s), %d slaves, %d ZooKeeper nodes" %
@@ -396,25 +760,165 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     sys.exit(1)
 
 
+# Get the active instances of the clusters named in cluster_names or, with
+# prefix=True, of every cluster whose name starts with one of them, with a
+# single scan of the region.
+# Returns a dict of cluster name -> list of instances.
+def find_clusters(conn, cluster_names, prefix=False):
+  filters = {'instance-state-name': ACTIVE_STATES}
+  if prefix:
+    filters['tag-key'] = 'cluster'
+  else:
+    filters['tag:cluster'] = cluster_names
+  clusters = {}
+  for instance in iter_instances(conn, filters):
+    name = instance.tags.get('cluster')
+    if name is None or (prefix and not any(
+        [name.startswith(p) for p in cluster_names])):
+      continue
+    clusters.setdefault(name, []).append(instance)
+  return clusters
+
+
+# Make an EC2 call that takes a list of instance IDs (e.g.
+# conn.terminate_instances) once per INSTANCE_BATCH_SIZE of the given
+# instances instead of once per instance, leaving out instances that are
+# shutting down or terminated.
+# Returns the IDs the call was made for.
+def call_in_batches(call, instances):
+  ids = [i.id for i in instances
+         if i.state not in ["shutting-down", "terminated"]]
+  for start in range(0, len(ids), INSTANCE_BATCH_SIZE):
+    call(ids[start:start + INSTANCE_BATCH_SIZE])
+  return ids
+
+
+# Poll until none of the given instances is still shutting down (or in any
+# other non-terminated state), for at most timeout seconds.
+# Returns True if they all terminated.
+def wait_for_termination(conn, instance_ids, timeout=600, min_interval=2,
+                         max_interval=15):
+  deadline = time.time() + timeout
+  interval = min_interval
+  while instance_ids != []:
+    for start in range(0, len(instance_ids), INSTANCE_BATCH_SIZE):
+      batch = instance_ids[start:start + INSTANCE_BATCH_SIZE]
+      done = set([i.id for i in iter_instances(
+          conn, {'instance-id': batch, 'instance-state-name': 'terminated'})])
+      instance_ids = [i for i in instance_ids if i not in done]
+    if instance_ids == [] or time.time() >= deadline:
+      break
+    time.sleep(min(interval, max(0, deadline - time.time())))
+    interval = min(interval * 2, max_interval)
+  return instance_ids == []
+
+
+# Delete the named security groups, first revoking the rules through which
+# they reference each other. Deletion is retried with backoff for as long
+# as EC2 still reports the groups in use (e.g. by instances it hasn't
+# finished terminating), for at most timeout seconds.
+# Returns True if none of the groups is left.
+def delete_security_groups(conn, group_names, timeout=300, min_interval=1,
+                           max_interval=10):
+  deadline = time.time() + timeout
+  interval = min_interval
+  revoked = False
+  while True:
+    groups = [g for g in conn.get_all_security_groups()
+              if g.name in group_names]
+    if groups == []:
+      return True
+    if not revoked:
+      for group in groups:
+        print "Deleting rules in security group " + group.name
+        for rule in group.rules:
+          for grant in rule.grants:
+            if grant.name not in group_names:
+              continue
+            try:
+              group.revoke(ip_protocol=rule.ip_protocol,
+                           from_port=rule.from_port, to_port=rule.to_port,
+                           src_group=grant)
+            except boto.exception.EC2ResponseError as e:
+              # Already revoked, e.g. on an earlier pass
+              if e.error_code != "InvalidPermission.NotFound":
+                raise
+      revoked = True
+    in_use = False
+    for group in groups:
+      try:
+        conn.delete_security_group(group.name)
+        print "Deleted security group " + group.name
+      except boto.exception.EC2ResponseError as e:
+        if e.error_code == "InvalidGroup.NotFound":
+          continue
+        if e.error_code not in ["InvalidGroup.InUse", "DependencyViolation"]:
+          raise
+        if time.time() >= deadline:
+          print "Failed to delete security group %s: %s" % (group.name,
+                                                            e.error_code)
+          return False
+        # EC2 sometimes still sees a dependency on a group we just revoked
+        # the rules of, so revoke whatever is left again
+        in_use = True
+        if e.error_code == "DependencyViolation":
+          revoked = False
+    if not in_use:
+      return True
+    time.sleep(min(interval, max(0, deadline - time.time())))
+    interval = min(interval * 2, max_interval)
+
+
+# Destroy clusters found with find_clusters: all their instances are
+# terminated with batched calls, then, with delete_groups, each cluster's
+# own security groups are deleted once its instances have terminated, with
+# up to `parallel` clusters handled at a time.
+# Returns a dict of cluster name -> True if it was completely torn down.
+@timeline.traced("phase")
+def destroy_clusters(conn, opts, clusters, delete_groups=False, parallel=16):
+  instances = sum(clusters.values(), [])
+  print "Terminating %d instances in %d cluster(s)..." % (len(instances),
+                                                         len(clusters))
+  call_in_batches(conn.terminate_instances, instances)
+  ec2_inventory.invalidate(opts.region)
+  if not delete_groups:
+    return dict([(name, True) for name in clusters])
+
+  # A failure only fails this cluster, not the other clusters' deletions
+  def destroy_groups(name):
+    ids = [i.id for i in clusters[name]]
+    try:
+      if not wait_for_termination(conn, ids):
+        print >> stderr, "Instances of %s did not terminate in time" % name
+        return (name, False)
+      group_names = [name + "-master", name + "-slaves", name + "-zoo"]
+      return (name, delete_security_groups(conn, group_names))
+    except Exception as e:
+      print >> stderr, "Could not delete the security groups of %s: %s" % (
+          name, e)
+      return (name, False)
+
+  print "Deleting security groups..."
+  pool = ThreadPool(max(1, min(parallel, len(clusters))))
+  try:
+    return dict(pool.map(destroy_groups, sorted(clusters), chunksize=1))
+  finally:
+    pool.close()
+
+
 # Deploy configuration files and run setup scripts on a newly launched
 # or started EC2 cluster.
+@timeline.traced("phase")
 def setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, deploy_ssh_key):
   master = master_nodes[0].public_dns_name
   if deploy_ssh_key:
-    print "Copying SSH key %s to master..." % opts.identity_file
-    ssh(master, opts, 'mkdir -p ~/.ssh')
-    scp(master, opts, opts.identity_file, '~/.ssh/id_rsa')
-    ssh(master, opts, 'chmod 600 ~/.ssh/id_rsa')
+    copy_ssh_key(master, opts)
 
-  modules = ['ephemeral-hdfs', 'persistent-hdfs', 'mesos', 'spark-standalone', 'training']
-
-  if opts.ganglia:
-    modules.append('ganglia')
+  modules = get_modules(opts)
 
-  # NOTE: We should clone the repository before running deploy_files to
-  # prevent ec2-variables.sh from being overwritten
-  ssh(master, opts,
-      "rm -rf spark-ec2 && git clone -b ampcamp3 https://github.com/mesos/spark-ec2.git")
+  # NOTE: We should install the setup scripts before running deploy_files
+  # to prevent ec2-variables.sh from being overwritten
+  tree_hash = install_setup_scripts(master, opts)
 
   print "Deploying files to master..."
   deploy_files(conn, "deploy.generic", opts, master_nodes, slave_nodes,
@@ -422,69 +926,595 @@ def setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, deploy_ssh_k
 
   print "Running setup on master..."
   setup_spark_cluster(master, opts)
+  if tree_hash is not None:
+    ssh(master, opts, "echo %s > %s" % (get_setup_key(tree_hash, modules),
+                                        SETUP_MARKER))
   print "Done!"
 
-def setup_spark_cluster(master, opts):
-  ssh(master, opts, "chmod u+x spark-ec2/setup.sh")
-  ssh(master, opts, "spark-ec2/setup.sh")
 
-def check_spark_json(spark_json, opts):
+# The setup modules to install on a cluster
+def get_modules(opts):
+  modules = ['ephemeral-hdfs', 'persistent-hdfs', 'mesos', 'spark-standalone', 'training']
+
+  if opts.ganglia:
+    modules.append('ganglia')
+  return modules
+
+
+# Identifies a complete run of setup.sh: the setup scripts it ran and the
+# modules it set up
+def get_setup_key(tree_hash, modules):
+  return hashlib.sha1(tree_hash + "\n" + "\n".join(modules)).hexdigest()
+
+
+# Returns True if setup.sh last completed on the master with the current
+# setup scripts and modules, so that a restarted cluster only needs its
+# services brought back (see fast_restart_cluster)
+def is_setup_done(master, opts, modules):
+  snapshot = get_setup_snapshot()
+  if snapshot is None:
+    return False
+  marker = ssh_read(master, opts,
+      "cat %s 2>/dev/null; true" % SETUP_MARKER).strip()
+  return marker == get_setup_key(snapshot[0], modules)
+
+
+# Shell command that runs command (which may use $h for the slave's host
+# name) for every slave in /root/spark-ec2/slaves in parallel and fails if
+# it failed for any of them. A bare wait always succeeds, so the exit status
+# of each background job is collected by its PID.
+def on_all_slaves(command):
+  return ("pids=; for h in $(cat /root/spark-ec2/slaves); do " + command +
+          " & pids=\"$pids $!\"; done; " +
+          "failed=0; for p in $pids; do wait $p || failed=1; done; " +
+          "[ $failed = 0 ]")
+
+
+# What a restart needs for each module whose setup survives a stop on the
+# root volumes, in setup.sh's terms: the configuration directories to copy
+# to the slaves (their slaves files are replaced with the new host names)
+# and the steps that bring the module's services back. Modules missing here
+# need setup.sh to run again.
+RESTART_MODULES = {
+  # The ephemeral disks were wiped, so the namenode is formatted again
+  "ephemeral-hdfs": (["/root/ephemeral-hdfs/conf"], [
+    ("format ephemeral-hdfs",
+     "echo Y | /root/ephemeral-hdfs/bin/hadoop namenode -format"),
+    ("start ephemeral-hdfs", "/root/ephemeral-hdfs/bin/start-dfs.sh")]),
+  # Its data is on EBS, and setup.sh doesn't start it either
+  "persistent-hdfs": (["/root/persistent-hdfs/conf"], []),
+  "mesos": ([], [("start mesos", "/root/spark-ec2/mesos/start-mesos")]),
+  "spark-standalone": (["/root/spark/conf"], [
+    ("start spark", "/root/spark/bin/start-all.sh")]),
+  # Only installs files on the root volume
+  "training": ([], []),
+  # The round-robin databases live on the wiped /mnt
+  "ganglia": (["/etc/ganglia"], [
+    ("start ganglia",
+     "mkdir -p /mnt/ganglia/rrds && chown -R nobody:nobody /mnt/ganglia/rrds " +
+     "&& /etc/init.d/gmond restart && " +
+     on_all_slaves("ssh -o StrictHostKeyChecking=no $h " +
+                   "/etc/init.d/gmond restart") +
+     " && /etc/init.d/gmetad restart && apachectl -k restart")])
+}
+
+
+# Returns the modules that a fast restart can't bring back (see
+# RESTART_MODULES)
+def get_unrestartable_modules(modules):
+  return [m for m in modules if m not in RESTART_MODULES]
+
+
+# Remote steps that bring back a stopped cluster whose setup is still on the
+# root volumes: the configuration is rendered again for the new host names
+# and copied to the slaves, then each module's services are started in
+# module order. All modules must be in RESTART_MODULES.
+def get_restart_steps(modules):
+  remote_copy = "rsync -azR -e 'ssh -o StrictHostKeyChecking=no'"
+  conf_dirs = sum([RESTART_MODULES[m][0] for m in modules], [])
+  steps = [
+    ("render config",
+     "cd /root/spark-ec2 && source ec2-variables.sh && " +
+     "echo \"$MESOS_MASTERS\" > masters && echo \"$MESOS_SLAVES\" > slaves " +
+     "&& ./deploy_templates.py"),
+    ("copy config to slaves",
+     "for d in %s; do " % " ".join(conf_dirs) +
+     "[ -e $d/slaves ] && cp /root/spark-ec2/slaves $d/slaves; done; " +
+     on_all_slaves("%s /root/spark-ec2 %s $h:/" %
+                   (remote_copy, " ".join(conf_dirs))))]
+  for module in modules:
+    steps += RESTART_MODULES[module][1]
+  return steps
+
+
+# Restart a stopped cluster without running setup.sh again: prepare the
+# ephemeral disks (local directories and swap) on every node, deploy the configuration files that
+# changed (the host names do) and run the restart steps on the master.
+# Returns the slaves that are part of the cluster again.
+@timeline.traced("phase")
+def fast_restart_cluster(conn, opts, master_nodes, slave_nodes, zoo_nodes,
+                         modules):
+  master = master_nodes[0].public_dns_name
+  pool = ThreadPool(min(len(slave_nodes + zoo_nodes) + 1, 32))
+  try:
+    ready = pool.map(lambda i: prepare_node(i, opts, False),
+                     master_nodes[:1] + slave_nodes + zoo_nodes)
+  finally:
+    pool.close()
+  if not ready[0]:
+    raise Exception("Master " + master_nodes[0].id + " could not be prepared")
+  slave_nodes = [i for (i, ok) in zip(slave_nodes, ready[1:]) if ok]
+  print "Deploying files to master..."
+  deploy_files(conn, "deploy.generic", opts, master_nodes, slave_nodes,
+               zoo_nodes, modules)
+  print "Restarting services..."
+  ssh_script(master, opts, get_restart_steps(modules))
+  return slave_nodes
+
+# Get a content-addressed snapshot of the setup scripts, keeping a local
+# clone of SETUP_REPO_URL in CACHE_DIR that is refreshed at most every
+# SETUP_REPO_TTL seconds. The snapshot is identified by the hash of the git
+# tree, so identical scripts always get the same hash.
+# Returns a tuple of (hash, path of a .tar.gz with a spark-ec2/ directory),
+# or None if no snapshot could be made.
+@timeline.traced("phase")
+def get_setup_snapshot():
+  repo_dir = os.path.join(CACHE_DIR, "spark-ec2.git")
+  if not os.path.isdir(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+  # Serialize parallel launches on this host while updating the cache
+  with open(os.path.join(CACHE_DIR, "setup-repo.lock"), "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    with open(os.devnull, "w") as devnull:
+      try:
+        if not os.path.isdir(repo_dir):
+          subprocess.check_call(["git", "clone", "-q", "--bare", "-b",
+                                 SETUP_REPO_BRANCH, SETUP_REPO_URL, repo_dir],
+                                stdout=devnull)
+        elif time.time() - os.path.getmtime(repo_dir) > SETUP_REPO_TTL:
+          subprocess.check_call(["git", "--git-dir", repo_dir, "fetch", "-q",
+                                 SETUP_REPO_URL, "+%s:%s" %
+                                 (SETUP_REPO_BRANCH, SETUP_REPO_BRANCH)],
+                                stdout=devnull)
+          os.utime(repo_dir, None)
+      except (OSError, subprocess.CalledProcessError) as e:
+        print >> stderr, "WARNING: Could not update %s: %s" % (repo_dir, e)
+        if not os.path.isdir(repo_dir):
+          return None
+      try:
+        tree_hash = subprocess.Popen(
+            ["git", "--git-dir", repo_dir, "rev-parse",
+             SETUP_REPO_BRANCH + "^{tree}"],
+            stdout=subprocess.PIPE).communicate()[0].strip()
+        if tree_hash == "":
+          return None
+        tarball = os.path.join(CACHE_DIR, "spark-ec2-%s.tar.gz" % tree_hash)
+        if not os.path.exists(tarball):
+          subprocess.check_call(["git", "--git-dir", repo_dir, "archive",
+                                 "--format=tar.gz", "--prefix=spark-ec2/",
+                                 "-o", tarball + ".tmp", tree_hash])
+          os.rename(tarball + ".tmp", tarball)
+      except (OSError, subprocess.CalledProcessError) as e:
+        print >> stderr, "WARNING: Could not snapshot %s: %s" % (repo_dir, e)
+        return None
+  return (tree_hash, tarball)
+
+
+# Install the setup scripts into ~/spark-ec2 on the master from the local
+# snapshot, skipping the transfer if the master already has the same hash
+# (e.g. on start or --resume). Falls back to cloning on the master if no
+# local snapshot is available.
+# Returns the hash of the installed scripts, or None if they were cloned.
+@timeline.traced("phase")
+def install_setup_scripts(master, opts):
+  snapshot = get_setup_snapshot()
+  if snapshot is None:
+    # As below, the fresh clone has no ec2-variables.sh yet
+    ssh(master, opts, "rm -rf spark-ec2 %s && git clone -b %s %s" %
+                      (DEPLOY_MANIFEST, SETUP_REPO_BRANCH, SETUP_REPO_URL))
+    return None
+  (tree_hash, tarball) = snapshot
+  remote_hash = ssh_read(master, opts,
+      "cat spark-ec2/.snapshot-hash 2>/dev/null; true").strip()
+  if remote_hash == tree_hash:
+    print "Setup scripts %s already on master" % tree_hash[:12]
+    return tree_hash
+  print "Copying setup scripts %s to master..." % tree_hash[:12]
+  # Replacing ~/spark-ec2 also removes the deployed ec2-variables.sh, so
+  # the deploy manifest is dropped to force deploy_files to send it again
+  with open(tarball, "rb") as data:
+    ssh_pipe(master, opts, "rm -rf spark-ec2 %s && tar xzf - && " %
+             DEPLOY_MANIFEST + "echo %s > spark-ec2/.snapshot-hash" % tree_hash,
+             data.read())
+  return tree_hash
+
+
+def copy_ssh_key(master, opts):
+  print "Copying SSH key %s to master..." % opts.identity_file
+  ssh(master, opts, 'mkdir -p ~/.ssh')
+  scp(master, opts, opts.identity_file, '~/.ssh/id_rsa')
+  ssh(master, opts, 'chmod 600 ~/.ssh/id_rsa')
+
+@timeline.traced("phase")
+def setup_spark_cluster(master, opts):
+  ssh_script(master, opts, [
+    ("chmod setup.sh", "chmod u+x spark-ec2/setup.sh"),
+    ("setup.sh", "spark-ec2/setup.sh")])
+
+# Compare the cores (and memory) the Spark master reports with what the
+# slaves' instance types provide. Without slave_nodes, opts.slaves slaves
+# of opts.instance_type are expected.
+def check_spark_json(spark_json, opts, slave_nodes=None):
   json_data = json.loads(spark_json)
   ## Find number of cpus from status page
   got_num_cpus = int(json_data.get("cores"))
 
   ## Find expected number of CPUs
-  num_cpus_per_slave = get_num_cpus(opts.instance_type)
-  expected_num_cpus = num_cpus_per_slave * opts.slaves
+  if slave_nodes is None:
+    slave_types = [opts.instance_type] * opts.slaves
+  else:
+    slave_types = [i.instance_type for i in slave_nodes]
+  expected_num_cpus = sum([get_num_cpus(t) for t in slave_types])
 
   print "Spark master reports " + str(got_num_cpus) + " CPUs, expected " + str(expected_num_cpus)
 
-  # TODO(shivaram): Should we check amount of memory as well ?
+  ## Memory is only warned about: the setup scripts may size the workers
+  ## from /proc/meminfo, which is a little below the catalog's figure
+  worker_memory_mb = [get_worker_memory_mb(t) for t in slave_types]
+  if None not in worker_memory_mb:
+    got_memory = int(json_data.get("memory", 0))
+    expected_memory = sum(worker_memory_mb)
+    print "Spark master reports %d MB of memory, expected %d MB" % (
+        got_memory, expected_memory)
+    if got_memory < MEMORY_TOLERANCE * expected_memory:
+      print >> stderr, "WARNING: Spark workers have less memory than expected"
 
   if int(got_num_cpus) == int(expected_num_cpus):
     return 0
   else:
     return -1
 
-def check_spark_cluster(master_nodes, opts):
-  master = master_nodes[0].public_dns_name
+# Fetch the Spark master's /json status page, giving up on connecting after
+# connect_timeout seconds and on each read after read_timeout seconds.
+# Returns the page, or None if the master couldn't be reached or didn't
+# answer with a 200.
+def get_spark_json(master, connect_timeout=5, read_timeout=10):
+  if node_backend is not None:
+    return node_backend.get_spark_json(master)
   url = "http://" + master + ":8080/json"
+  conn = httplib.HTTPConnection(master, 8080, timeout=connect_timeout)
   try:
-    response = urllib2.urlopen(url)
-    if response.code != 200:
-      print "Spark master " + url + " returned " + str(response.code)
-      return -1
-    master_html = response.read()
-    return check_spark_json(master_html, opts)
-  except NameError as e:
-    # If we get an exception, return error
-    print "Exception in opening the url " + url
+    conn.connect()
+    conn.sock.settimeout(read_timeout)
+    conn.request("GET", "/json")
+    response = conn.getresponse()
+    if response.status != 200:
+      print "Spark master " + url + " returned " + str(response.status)
+      return None
+    return response.read()
+  except (socket.error, httplib.HTTPException) as e:
+    print "Could not open the url %s: %s" % (url, e)
+    return None
+  finally:
+    conn.close()
+
+def check_spark_cluster(master_nodes, opts):
+  spark_json = get_spark_json(master_nodes[0].public_dns_name)
+  if spark_json is None:
+    return -1
+  try:
+    return check_spark_json(spark_json, opts)
+  except ValueError as e:
+    print "Could not parse the Spark master's status page: %s" % e
     return -1
 
-def copy_ampcamp_data_from_ebs(master_nodes, opts):
+# Hostnames and addresses a Spark worker on the given instance may have
+# registered with the master under
+def get_instance_names(instance):
+  names = set()
+  for attr in ['public_dns_name', 'private_dns_name']:
+    name = getattr(instance, attr, None)
+    if name:
+      names.add(name)
+      names.add(name.split(".")[0])
+  for attr in ['ip_address', 'private_ip_address']:
+    name = getattr(instance, attr, None)
+    if name:
+      names.add(name)
+  return names
+
+# Split slave_nodes into those with an ALIVE worker in the master's parsed
+# /json status page and those without one (missing or dead).
+# Returns a tuple of (registered, missing) instance lists.
+def get_worker_status(status, slave_nodes):
+  alive_names = set()
+  for worker in status.get("workers", []):
+    if worker.get("state", "ALIVE") != "ALIVE":
+      continue
+    alive_names.add(worker.get("host"))
+    # e.g. http://ec2-1-2-3-4.compute-1.amazonaws.com:8081
+    webui = worker.get("webuiaddress", "")
+    alive_names.add(webui.split("//")[-1].split(":")[0])
+  registered = []
+  missing = []
+  for instance in slave_nodes:
+    if get_instance_names(instance) & alive_names:
+      registered.append(instance)
+    else:
+      missing.append(instance)
+  return (registered, missing)
+
+# Shell command that starts a Spark worker registering with master_url
+def get_worker_start_command(master_url):
+  return ("/root/spark/bin/spark-daemon.sh start spark.deploy.worker.Worker " +
+          master_url)
+
+# Restart the Spark worker on each of the given slaves, pointing it at
+# master_url. Failures are reported but don't stop the other restarts.
+@timeline.traced("phase")
+def restart_spark_workers(slave_nodes, master_url, opts):
+  def restart(instance):
+    host = instance.public_dns_name
+    try:
+      ssh_script(host, opts, [
+        ("stop worker", "pkill -f spark.deploy.worker.Worker; sleep 1; true"),
+        ("start worker", get_worker_start_command(master_url))])
+    except subprocess.CalledProcessError:
+      print >> stderr, "WARNING: Could not restart the Spark worker on " + host
+
+  print "Restarting Spark workers on %d slaves: %s" % (len(slave_nodes),
+      " ".join([i.public_dns_name for i in slave_nodes]))
+  pool = ThreadPool(min(len(slave_nodes), 16))
+  try:
+    pool.map(restart, slave_nodes)
+  finally:
+    pool.close()
+
+# Compare each slave's Spark worker in the master's parsed /json status page
+# against what its instance type should provide.
+# Returns a list of dicts with the slave's host and instance type, its
+# worker's state, cores and memory (MB) and a list of problems, one per
+# slave.
+def diagnose_workers(status, slave_nodes, opts):
+  workers = {}
+  for worker in status.get("workers", []):
+    webui = worker.get("webuiaddress", "")
+    for name in [worker.get("host"), webui.split("//")[-1].split(":")[0]]:
+      # Prefer an ALIVE entry when a worker registered more than once
+      if name not in workers or worker.get("state") == "ALIVE":
+        workers[name] = worker
+
+  report = []
+  for instance in slave_nodes:
+    entry = {"host": instance.public_dns_name,
+             "instance_type": instance.instance_type, "state": "MISSING",
+             "cores": 0, "memory": 0, "problems": []}
+    expected_cores = get_num_cpus(instance.instance_type)
+    expected_memory = get_worker_memory_mb(instance.instance_type)
+    matches = [workers[n] for n in get_instance_names(instance)
+               if n in workers]
+    if matches == []:
+      entry["problems"].append("no worker registered")
+    else:
+      worker = matches[0]
+      entry["state"] = worker.get("state", "ALIVE")
+      entry["cores"] = int(worker.get("cores", 0))
+      entry["memory"] = int(worker.get("memory", 0))
+      if entry["state"] != "ALIVE":
+        entry["problems"].append("worker is " + entry["state"])
+      if entry["cores"] < expected_cores:
+        entry["problems"].append("%d of %d cores" % (entry["cores"],
+                                                     expected_cores))
+      if expected_memory is not None and \
+          entry["memory"] < MEMORY_TOLERANCE * expected_memory:
+        entry["problems"].append("%d of %d MB memory" % (entry["memory"],
+                                                         expected_memory))
+    report.append(entry)
+  return report
+
+# Shell script that times writing probe_mb MB to each local disk mount and
+# a fixed CPU-bound loop, printing "disk <mount> <secs>", "missing <mount>"
+# and "cpu <secs>" lines
+def get_probe_script(instance_type, probe_mb=256):
+  lines = ["now() { date +%s.%N; }"]
+  for mount in get_local_mounts(instance_type):
+    lines.append(
+        ("if [ %s = /mnt ] || mountpoint -q %s; then s=$(now); " +
+         "dd if=/dev/zero of=%s/.probe bs=1M count=%d conv=fdatasync " +
+         "2>/dev/null; e=$(now); rm -f %s/.probe; " +
+         "echo disk %s $(awk \"BEGIN { print $e - $s }\"); " +
+         "else echo missing %s; fi") %
+        (mount, mount, mount, probe_mb, mount, mount, mount))
+  lines.append("s=$(now); i=0; while [ $i -lt 300000 ]; do i=$((i+1)); done; " +
+               "e=$(now); echo cpu $(awk \"BEGIN { print $e - $s }\")")
+  return "\n".join(lines)
+
+# Run the probe script on every slave in parallel, killing it after
+# timeout seconds, and add the results to the matching report entries:
+# "disk_secs" (mount -> seconds), "cpu_secs", and problems for missing
+# disks, failed probes and nodes over STRAGGLER_FACTOR times the median
+@timeline.traced("phase")
+def probe_workers(report, opts, timeout=120, parallel=32):
+  def probe(entry):
+    script = get_probe_script(entry["instance_type"])
+    command = "timeout %d bash -c %s" % (timeout, pipes.quote(script))
+    entry["disk_secs"] = {}
+    entry["cpu_secs"] = None
+    try:
+      out = ssh_read(entry["host"], opts, command)
+    except subprocess.CalledProcessError:
+      entry["problems"].append("probe failed or timed out")
+      return
+    for line in out.splitlines():
+      fields = line.split()
+      if len(fields) == 3 and fields[0] == "disk":
+        entry["disk_secs"][fields[1]] = float(fields[2])
+      elif len(fields) == 2 and fields[0] == "missing":
+        entry["problems"].append("disk %s not mounted" % fields[1])
+      elif len(fields) == 2 and fields[0] == "cpu":
+        entry["cpu_secs"] = float(fields[1])
+
+  pool = ThreadPool(max(1, min(len(report), parallel)))
+  try:
+    pool.map(probe, report)
+  finally:
+    pool.close()
+
+  def median(values):
+    values = sorted(values)
+    return values[len(values) / 2] if values != [] else None
+
+  cpu_median = median([e["cpu_secs"] for e in report
+                       if e["cpu_secs"] is not None])
+  disk_median = median([secs for e in report
+                        for secs in e["disk_secs"].values()])
+  for entry in report:
+    if cpu_median and entry["cpu_secs"] > STRAGGLER_FACTOR * cpu_median:
+      entry["problems"].append("slow CPU (%.1fs, median %.1fs)" %
+                               (entry["cpu_secs"], cpu_median))
+    for (mount, secs) in sorted(entry["disk_secs"].items()):
+      if disk_median and secs > STRAGGLER_FACTOR * disk_median:
+        entry["problems"].append("slow disk %s (%.1fs, median %.1fs)" %
+                                 (mount, secs, disk_median))
+
+# Print the worker report, listing flagged workers first.
+# Returns the number of flagged workers.
+def print_diagnostics(report):
+  print "%-50s %-8s %6s %9s  %s" % ("WORKER", "STATE", "CORES", "MEMORY",
+                                    "PROBLEMS")
+  flagged = [e for e in report if e["problems"] != []]
+  for entry in flagged + [e for e in report if e["problems"] == []]:
+    print "%-50s %-8s %6d %9d  %s" % (entry["host"], entry["state"],
+        entry["cores"], entry["memory"], "; ".join(entry["problems"]) or "ok")
+  print "%d workers, %d flagged" % (len(report), len(flagged))
+  return len(flagged)
+
+# Report on every worker of the cluster, optionally running the timed disk
+# and CPU probe on each slave as well.
+# Returns the number of flagged workers, or -1 if the master didn't answer.
+@timeline.traced("phase")
+def diagnose_cluster(master_nodes, slave_nodes, opts, probe=False):
+  spark_json = get_spark_json(master_nodes[0].public_dns_name)
+  if spark_json is None:
+    return -1
+  try:
+    status = json.loads(spark_json)
+  except ValueError as e:
+    print "Could not parse the Spark master's status page: %s" % e
+    return -1
+  report = diagnose_workers(status, slave_nodes, opts)
+  if probe:
+    print "Probing disks and CPU on %d slaves..." % len(report)
+    probe_workers(report, opts)
+  return print_diagnostics(report)
+
+# AMP Camp datasets on the AMI's local data volume, as
+# (name, local path, HDFS path) tuples
+AMPCAMP_EBS_DATASETS = [
+  ("pagecounts", "/ampcamp-data/pagecounts", "/wiki/pagecounts"),
+  ("wikistats_featurized", "/ampcamp-data/wikistats_featurized",
+   "/wikistats_featurized"),
+  ("enwiki_txt", "/ampcamp-data/enwiki_txt", "/enwiki_txt")
+]
+
+# Copy the AMP Camp datasets from the master's local data volume into
+# ephemeral HDFS, opts.copy_parallel datasets at a time, while a monitor
+# thread reports throughput and ETA.
+# Returns a dict mapping each dataset name to the seconds its copy took.
+@timeline.traced("phase")
+def copy_ampcamp_data_from_ebs(master_nodes, opts, monitor_interval=15):
   master = master_nodes[0].public_dns_name
 
-  print "Copying AMP Camp Wikipedia pagecount data..."
-  ssh(master, opts,
-      "/root/ephemeral-hdfs/bin/hadoop fs -copyFromLocal /ampcamp-data/pagecounts /wiki/pagecounts")
-  print "Copying AMP Camp Wikipedia featurized data..."
-  ssh(master, opts,
-      "/root/ephemeral-hdfs/bin/hadoop fs -copyFromLocal /ampcamp-data/wikistats_featurized /")
-  print "Copying AMP Camp Wikipedia articles data..."
-  ssh(master, opts,
-      "/root/ephemeral-hdfs/bin/hadoop fs -copyFromLocal /ampcamp-data/enwiki_txt /")
+  sizes = get_local_sizes(master, opts,
+                          [local for (_, local, _) in AMPCAMP_EBS_DATASETS])
+  targets = dict([(hdfs, sizes.get(local, 0))
+                  for (_, local, hdfs) in AMPCAMP_EBS_DATASETS])
+  print "Copying %d AMP Camp datasets (%.0f MB), %d at a time..." % (
+      len(AMPCAMP_EBS_DATASETS), sum(targets.values()) / 1e6,
+      opts.copy_parallel)
+
+  done = threading.Event()
+  monitor = threading.Thread(target=monitor_hdfs_copy,
+      args=(master, opts, targets, done, monitor_interval))
+  monitor.daemon = True
+  monitor.start()
+
+  def copy_dataset(dataset):
+    (name, local, hdfs) = dataset
+    start = time.time()
+    ssh(master, opts, "/root/ephemeral-hdfs/bin/hadoop fs -copyFromLocal " +
+                      local + " " + hdfs)
+    secs = time.time() - start
+    print "Copied %s in %.1fs (%.1f MB/s)" % (
+        name, secs, sizes.get(local, 0) / 1e6 / max(secs, 0.001))
+    return (name, secs)
+
+  pool = ThreadPool(max(1, opts.copy_parallel))
+  try:
+    timings = dict(pool.map(copy_dataset, AMPCAMP_EBS_DATASETS))
+  finally:
+    pool.close()
+    done.set()
+    monitor.join()
+  return timings
+
+# Get the sizes in bytes of the given paths on a host's local disk
+def get_local_sizes(host, opts, paths):
+  out = ssh_read(host, opts, "du -sb " + " ".join(paths) + " 2>/dev/null")
+  sizes = {}
+  for line in out.splitlines():
+    parts = line.split()
+    if len(parts) == 2 and parts[0].isdigit():
+      sizes[parts[1]] = int(parts[0])
+  return sizes
+
+# Get the sizes in bytes of the given HDFS paths (0 for paths that don't
+# exist yet) with a single ssh call
+def get_hdfs_sizes(host, opts, paths):
+  out = ssh_read(host, opts, "for p in " + " ".join(paths) + "; do " +
+      "echo $p $(/root/ephemeral-hdfs/bin/hadoop fs -dus $p 2>/dev/null " +
+      "| awk '{print $NF}'); done")
+  sizes = dict([(p, 0) for p in paths])
+  for line in out.splitlines():
+    parts = line.split()
+    if len(parts) == 2 and parts[0] in sizes and parts[1].isdigit():
+      sizes[parts[0]] = int(parts[1])
+  return sizes
+
+# Periodically sample HDFS usage of the copy targets (a dict of HDFS path to
+# expected size in bytes) and print throughput and ETA until done is set
+def monitor_hdfs_copy(master, opts, targets, done, interval):
+  start = time.time()
+  last = (start, 0)
+  total = sum(targets.values())
+  while not done.wait(interval):
+    try:
+      sizes = get_hdfs_sizes(master, opts, sorted(targets))
+    except (OSError, subprocess.CalledProcessError):
+      continue
+    now = time.time()
+    copied = sum(sizes.values())
+    rate = (copied - last[1]) / max(now - last[0], 0.001)
+    last = (now, copied)
+    if copied >= total:
+      eta = "0s"
+    elif rate > 0:
+      eta = "%ds" % ((total - copied) / rate)
+    else:
+      eta = "unknown"
+    print "HDFS copy: %.0f/%.0f MB, %.1f MB/s, ETA %s (%s)" % (
+        copied / 1e6, total / 1e6, rate / 1e6, eta,
+        ", ".join(["%s %.0f%%" % (p, 100.0 * sizes[p] / targets[p])
+                   for p in sorted(targets) if targets[p] > 0]))
 
+def print_copy_timings(timings):
+  for name in sorted(timings):
+    print "  %-25s %.1fs" % (name, timings[name])
+
+@timeline.traced("phase")
 def copy_ampcamp_data_from_s3(master_nodes, opts):
   master = master_nodes[0].public_dns_name
 
-  ssh(master, opts, "/root/ephemeral-hdfs/bin/stop-mapred.sh")
-  # Wait for mapred to stop
-  time.sleep(10)
-
-  ssh(master, opts, "/root/ephemeral-hdfs/bin/start-mapred.sh")
-  # Wait for mapred to start
-  time.sleep(10)
-
   (s3_access_key, s3_secret_key) = get_s3_keys()
 
   # Escape '/' in S3-keys
@@ -515,31 +1545,50 @@ def copy_ampcamp_data_from_s3(master_nodes, opts):
     opts.s3_features_bucket = "ampcamp-data/wikistats_featurized-0" + \
         str(random.choice(s3_buckets_range))
 
-  set_s3_keys_in_hdfs(master, opts, s3_access_key, s3_secret_key)
+  steps = [
+    ("stop mapred", "/root/ephemeral-hdfs/bin/stop-mapred.sh"),
+    # Wait for mapred to stop
+    ("wait for mapred to stop", "sleep 10"),
+    ("start mapred", "/root/ephemeral-hdfs/bin/start-mapred.sh"),
+    # Wait for mapred to start
+    ("wait for mapred to start", "sleep 10")]
 
-  ssh(master, opts, "/root/ephemeral-hdfs/bin/hadoop distcp " +
-                    "s3n://" + opts.s3_stats_bucket + " " +
-                    "hdfs://`hostname`:9000/wiki/pagecounts")
+  steps += get_s3_keys_steps(s3_access_key, s3_secret_key)
 
-  # ssh(master, opts, "/root/ephemeral-hdfs/bin/hadoop fs -rmr /wikistats_20090505-07_restricted")
+  # ("remove restricted data", "/root/ephemeral-hdfs/bin/hadoop fs -rmr /wikistats_20090505-07_restricted")
 
-  ssh(master, opts, "/root/ephemeral-hdfs/bin/hadoop distcp " +
-                    "s3n://" + opts.s3_small_bucket + " " +
-                    "hdfs://`hostname`:9000/wikistats_20090505-07_restricted")
+  steps += [
+    ("distcp pagecounts", "/root/ephemeral-hdfs/bin/hadoop distcp " +
+        "s3n://" + opts.s3_stats_bucket + " " +
+        "hdfs://`hostname`:9000/wiki/pagecounts"),
+    ("distcp restricted", "/root/ephemeral-hdfs/bin/hadoop distcp " +
+        "s3n://" + opts.s3_small_bucket + " " +
+        "hdfs://`hostname`:9000/wikistats_20090505-07_restricted"),
+    ("distcp featurized", "/root/ephemeral-hdfs/bin/hadoop distcp " +
+        "s3n://" + opts.s3_features_bucket + " " +
+        "hdfs://`hostname`:9000/wikistats_featurized")]
 
-  ssh(master, opts, "/root/ephemeral-hdfs/bin/hadoop distcp " +
-                    "s3n://" + opts.s3_features_bucket + " " +
-                    "hdfs://`hostname`:9000/wikistats_featurized")
+  return ssh_script(master, opts, steps)
 
 def set_s3_keys_in_hdfs(master, opts, s3_access_key, s3_secret_key):
-  ssh(master, opts, "cd ephemeral-hdfs/conf; sed -i \"s/\!-- p/p/g\" core-site.xml")
-  ssh(master, opts, "cd ephemeral-hdfs/conf; sed -i \"s/y --/y/g\" core-site.xml")
-  ssh(master, opts, "cd ephemeral-hdfs/conf; " + \
-      "sed -i \"/fs.s3n.awsAccessKeyId/{N; s/value>.*<\/value/value>" + \
-      s3_access_key.replace("/", "\/") + "<\/value/g }\" core-site.xml")
-  ssh(master, opts, "cd ephemeral-hdfs/conf; " + \
-      "sed -i \"/fs.s3n.awsSecretAccessKey/{N; s/value>.*<\/value/value>" + \
-      s3_secret_key.replace("/", "\/") + "<\/value/g }\" core-site.xml")
+  return ssh_script(master, opts,
+                    get_s3_keys_steps(s3_access_key, s3_secret_key))
+
+# Remote steps that uncomment the S3 credential properties in the ephemeral
+# HDFS core-site.xml and fill in the given keys
+def get_s3_keys_steps(s3_access_key, s3_secret_key):
+  def sed_value(value):
+    return value.replace("\\", "\\\\").replace("/", "\\/").replace("&", "\\&")
+  conf = "/root/ephemeral-hdfs/conf/core-site.xml"
+  return [
+    ("uncomment s3 properties",
+     "sed -i -e 's/!-- p/p/g' -e 's/y --/y/g' " + conf),
+    ("set s3 access key",
+     "sed -i " + pipes.quote("/fs.s3n.awsAccessKeyId/{N; s/value>.*<\\/value/value>" +
+         sed_value(s3_access_key) + "<\\/value/g }") + " " + conf),
+    ("set s3 secret key",
+     "sed -i " + pipes.quote("/fs.s3n.awsSecretAccessKey/{N; s/value>.*<\\/value/value>" +
+         sed_value(s3_secret_key) + "<\\/value/g }") + " " + conf)]
 
 def get_s3_keys():
   if os.getenv('S3_AWS_ACCESS_KEY_ID') != None:
@@ -553,38 +1602,284 @@ def get_s3_keys():
   return (s3_access_key, s3_secret_key)
 
 
+# Check whether a host accepts TCP connections on the given port
+def is_port_open(host, port=22, timeout=5):
+  try:
+    sock = socket.create_connection((host, port), timeout)
+    sock.close()
+    return True
+  except socket.error:
+    return False
+
+
+# Check whether we can log into a host and run a trivial command on it
+@timeline.traced("ssh", host=0)
+def is_ssh_ready(host, opts):
+  if node_backend is not None:
+    return node_backend.is_ssh_ready(host)
+  if not is_port_open(host):
+    return False
+  # This also opens the multiplexed connection later ssh calls will reuse
+  with open(os.devnull, "w") as devnull:
+    return subprocess.call(
+        "ssh %s -o BatchMode=yes -o ConnectTimeout=5 %s@%s true" %
+        (ssh_args(opts), opts.user, host),
+        shell=True, stdout=devnull, stderr=devnull) == 0
+
+
+# Probe all hosts concurrently until every master and at least `quorum` of
+# the slaves accept SSH, or until wait_secs have passed.
+# Returns the list of hosts that answered.
+@timeline.traced("phase")
+def wait_for_ssh(opts, wait_secs, master_hosts, slave_hosts, quorum=1.0,
+                 interval=5):
+  deadline = time.time() + wait_secs
+  needed_slaves = min(len(slave_hosts),
+                      int(math.ceil(quorum * len(slave_hosts))))
+  ready = set()
+  while True:
+    pending = [h for h in master_hosts + slave_hosts if h not in ready]
+    if pending != []:
+      pool = ThreadPool(min(len(pending), 32))
+      results = pool.map(lambda h: is_ssh_ready(h, opts), pending)
+      pool.close()
+      ready.update([h for (h, ok) in zip(pending, results) if ok])
+    masters_up = len([h for h in master_hosts if h in ready])
+    slaves_up = len([h for h in slave_hosts if h in ready])
+    print "SSH ready on %d/%d master(s), %d/%d slaves" % (
+        masters_up, len(master_hosts), slaves_up, len(slave_hosts))
+    if masters_up == len(master_hosts) and slaves_up >= needed_slaves:
+      return [h for h in master_hosts + slave_hosts if h in ready]
+    if time.time() >= deadline:
+      print >> stderr, ("WARNING: Not all nodes accept SSH after %d seconds; " +
+                        "continuing anyway") % wait_secs
+      return [h for h in master_hosts + slave_hosts if h in ready]
+    time.sleep(min(interval, max(0, deadline - time.time())))
+
+
 # Wait for a whole cluster (masters, slaves and ZooKeeper) to start up
-def wait_for_cluster(conn, wait_secs, master_nodes, slave_nodes, zoo_nodes):
+# and accept SSH connections. With opts.ssh_quorum below 1, the slaves that
+# don't accept SSH in time are left out of the cluster (and of opts.slaves,
+# so the Spark health check expects the right size).
+# Returns the slaves that are ready.
+@timeline.traced("phase")
+def wait_for_cluster(conn, opts, master_nodes, slave_nodes, zoo_nodes):
   print "Waiting for instances to start up..."
   time.sleep(5)
-  wait_for_instances(conn, master_nodes)
-  wait_for_instances(conn, slave_nodes)
-  if zoo_nodes != []:
-    wait_for_instances(conn, zoo_nodes)
-  print "Waiting %d more seconds..." % wait_secs
-  time.sleep(wait_secs)
+  wait_for_instances(conn, master_nodes + slave_nodes + zoo_nodes)
+  print "Waiting up to %d seconds for SSH..." % opts.wait
+  ready = wait_for_ssh(opts, opts.wait,
+                       [i.public_dns_name for i in master_nodes],
+                       [i.public_dns_name for i in slave_nodes + zoo_nodes],
+                       opts.ssh_quorum)
+  not_ready = [i for i in master_nodes if i.public_dns_name not in ready]
+  if not_ready != []:
+    raise Exception("Master %s does not accept SSH" % not_ready[0].id)
+  ready_slaves = [i for i in slave_nodes if i.public_dns_name in ready]
+  if len(ready_slaves) < len(slave_nodes):
+    print >> stderr, ("WARNING: Continuing with the %d of %d slaves that " +
+                      "accept SSH") % (len(ready_slaves), len(slave_nodes))
+  opts.slaves = len(ready_slaves)
+  return ready_slaves
+
+
+# Remote steps that prepare a single node before the cluster setup runs
+# (or when a stopped cluster is restarted, see fast_restart_cluster):
+# create the local directories on every ephemeral disk and the swap file,
+# and enable the swap unless it already is
+def get_node_prep_steps(opts):
+  mounts = get_local_mounts(opts.instance_type)
+  steps = [("create local dirs", "mkdir -p " + " ".join(
+      ["%s/spark %s/ephemeral-hdfs/data %s/hadoop/mrlocal" % (m, m, m)
+       for m in mounts]))]
+  swap_mb = get_swap_mb(opts)
+  if swap_mb > 0:
+    steps.append(("create swap file",
+        ("([ -e /mnt/swap ] || (dd if=/dev/zero of=/mnt/swap bs=1M " +
+         "count=%d && mkswap /mnt/swap)) && " +
+         "(swapon -s | grep -q '^/mnt/swap[[:space:]]' || swapon /mnt/swap)") % swap_mb))
+  return steps
+
+
+# Wait until a single node accepts SSH (for at most opts.wait seconds) and
+# run its preparation steps; the master also gets our SSH key.
+# Returns True if the node is ready to join the cluster.
+@timeline.traced("node", instance=0)
+def prepare_node(instance, opts, is_master):
+  host = instance.public_dns_name
+  deadline = time.time() + opts.wait
+  while not is_ssh_ready(host, opts):
+    if time.time() >= deadline:
+      print >> stderr, "WARNING: %s does not accept SSH, leaving it out" % host
+      return False
+    time.sleep(5)
+  try:
+    ssh_script(host, opts, get_node_prep_steps(opts))
+    if is_master:
+      copy_ssh_key(host, opts)
+  except subprocess.CalledProcessError:
+    print >> stderr, "WARNING: Preparing %s failed, leaving it out" % host
+    return False
+  return True
+
+
+# Seconds a node may take to run its preparation steps once it accepts SSH
+NODE_PREP_TIMEOUT = 600
+
+
+# Launch-time setup that treats every node as an independent stream event
+# instead of waiting for the whole cluster at each phase. Each instance is
+# prepared as soon as it is running and accepts SSH. The master-driven
+# setup starts once the master and opts.pipeline_fraction of the slaves are
+# prepared, and slaves that become ready later join the running cluster.
+# Slaves that never become ready are dropped from the cluster (and from
+# opts.slaves, so the Spark health check expects the right size).
+@timeline.traced("phase")
+def pipelined_setup(conn, opts, master_nodes, slave_nodes, zoo_nodes):
+  all_nodes = master_nodes + slave_nodes + zoo_nodes
+  master_ids = set([i.id for i in master_nodes])
+  needed_slaves = min(len(slave_nodes),
+                      int(math.ceil(opts.pipeline_fraction * len(slave_nodes))))
+  # (instance, prepared?) events, one per node
+  events = Queue.Queue()
+  pool = ThreadPool(min(len(all_nodes), 32))
+
+  def prepare(instance):
+    try:
+      ok = prepare_node(instance, opts, instance.id in master_ids)
+    except Exception as e:
+      print >> stderr, "WARNING: Preparing %s failed: %s" % (instance.id, e)
+      ok = False
+    events.put((instance, ok))
+
+  # Hand each instance to the pool as soon as it leaves the pending state,
+  # polling all of them in one call per tick
+  def watch():
+    submitted = set()
+    interval = 2
+    while len(submitted) < len(all_nodes):
+      time.sleep(interval)
+      try:
+        refresh_instances(conn, all_nodes)
+      except boto.exception.EC2ResponseError as e:
+        print >> stderr, "WARNING: Could not refresh instances: %s" % e
+        continue
+      new = [i for i in all_nodes
+             if i.id not in submitted and i.state != 'pending']
+      for i in new:
+        submitted.add(i.id)
+        if i.state == 'running':
+          pool.apply_async(prepare, (i,))
+        else:
+          events.put((i, False))
+      interval = 2 if new != [] else min(interval * 2, 15)
+
+  # Wait for the next node event, or return None if no node has reported
+  # for longer than any single node can take to come up and be prepared
+  def next_event():
+    try:
+      return events.get(timeout=opts.wait + NODE_PREP_TIMEOUT)
+    except Queue.Empty:
+      return None
+
+  print "Waiting for nodes to come up (pipelined)..."
+  watcher = threading.Thread(target=watch)
+  watcher.daemon = True
+  watcher.start()
+
+  ready_slaves = []
+  ready_zoo = []
+  master_ready = None
+  reported = 0
+  while master_ready is None or len(ready_slaves) < needed_slaves or \
+      len(ready_zoo) < len(zoo_nodes):
+    if reported == len(all_nodes):
+      break
+    event = next_event()
+    if event is None:
+      pool.close()
+      raise Exception("No node became ready or failed for %d seconds" %
+                      (opts.wait + NODE_PREP_TIMEOUT))
+    (instance, ok) = event
+    reported += 1
+    if instance.id in master_ids:
+      master_ready = ok
+      if not ok:
+        break
+    elif ok and instance in zoo_nodes:
+      ready_zoo.append(instance)
+    elif ok:
+      ready_slaves.append(instance)
+  if not master_ready:
+    pool.close()
+    raise Exception("Master " + master_nodes[0].id + " did not become ready")
+  print "Master and %d of %d slaves ready, starting setup" % (
+      len(ready_slaves), len(slave_nodes))
+
+  setup_cluster(conn, master_nodes, list(ready_slaves), zoo_nodes, opts,
+                False)
+
+  # Add the slaves that became ready while the setup was running
+  late_slaves = []
+  while reported < len(all_nodes):
+    event = next_event()
+    if event is None:
+      print >> stderr, ("WARNING: Giving up on %d slaves that did not " +
+                        "become ready") % (len(all_nodes) - reported)
+      break
+    (instance, ok) = event
+    reported += 1
+    if ok and instance in slave_nodes:
+      late_slaves.append(instance)
+  pool.close()
+  if late_slaves != []:
+    print "Adding %d late slaves to the cluster..." % len(late_slaves)
+    joined = join_late_slaves(master_nodes[0].public_dns_name, opts,
+                              [i.public_dns_name for i in late_slaves])
+    ready_slaves += [i for i in late_slaves if i.public_dns_name in joined]
+
+  if len(ready_slaves) < len(slave_nodes):
+    print >> stderr, ("WARNING: Continuing with %d of %d slaves" %
+                      (len(ready_slaves), len(slave_nodes)))
+  opts.slaves = len(ready_slaves)
+  return ready_slaves
+
+
+# Add slaves that became ready after setup.sh ran on the master: register
+# them in the slaves files, copy the configured software from the master and
+# start their HDFS datanode and Spark worker.
+# Returns the hosts that joined successfully.
+@timeline.traced("phase")
+def join_late_slaves(master, opts, hosts):
+  remote_ssh = "ssh -o StrictHostKeyChecking=no"
+  joined = []
+  for host in hosts:
+    steps = []
+    steps.append(("register " + host,
+        "for f in /root/spark-ec2/slaves /root/spark/conf/slaves " +
+        "/root/ephemeral-hdfs/conf/slaves; do " +
+        "[ -e $f ] && echo %s >> $f; done; true" % host))
+    steps.append(("copy software to " + host,
+        "rsync -az -e '%s' /root/spark /root/spark-ec2 " % remote_ssh +
+        "/root/ephemeral-hdfs %s:/root/" % host))
+    steps.append(("start " + host,
+        "%s %s '[ -x /root/spark-ec2/setup-slave.sh ] && " % (remote_ssh, host) +
+        "/root/spark-ec2/setup-slave.sh; " +
+        "/root/ephemeral-hdfs/bin/hadoop-daemon.sh start datanode; " +
+        get_worker_start_command("spark://%s:7077" % master) + "'"))
+    try:
+      ssh_script(master, opts, steps)
+      joined.append(host)
+    except subprocess.CalledProcessError:
+      print >> stderr, "WARNING: Could not add %s to the cluster" % host
+  return joined
 
 
 # Get number of local disks available for a given EC2 instance type.
 def get_num_disks(instance_type):
-  # From http://docs.amazonwebservices.com/AWSEC2/latest/UserGuide/index.html?InstanceStorage.html
-  disks_by_instance = {
-    "m1.small":    1,
-    "m1.medium":   1,
-    "m1.large":    2,
-    "m1.xlarge":   4,
-    "t1.micro":    1,
-    "c1.medium":   1,
-    "c1.xlarge":   4,
-    "m2.xlarge":   1,
-    "m2.2xlarge":  1,
-    "m2.4xlarge":  2,
-    "cc1.4xlarge": 2,
-    "cc2.8xlarge": 4,
-    "cg1.4xlarge": 2
-  }
-  if instance_type in disks_by_instance:
-    return disks_by_instance[instance_type]
+  info = instance_catalog.get_instance_type(instance_type)
+  if info is not None:
+    return info['disks']
   else:
     print >> stderr, ("WARNING: Don't know number of disks on instance type %s; assuming 1"
                       % instance_type)
@@ -592,33 +1887,48 @@ def get_num_disks(instance_type):
 
 # Get number of CPUs available for a given EC2 instance type.
 def get_num_cpus(instance_type):
-  # From http://aws.amazon.com/ec2/instance-types/
-  cpus_by_instance = {
-    "m1.small":    1,
-    "m1.large":    2,
-    "m1.xlarge":   4,
-    "t1.micro":    1,
-    "c1.medium":   2,
-    "c1.xlarge":   8,
-    "m2.xlarge":   2,
-    "m2.2xlarge":  4,
-    "m2.4xlarge":  8,
-    "cc1.4xlarge": 8,
-    "cc2.8xlarge": 16,
-    "cg1.4xlarge": 8
-  }
-  if instance_type in cpus_by_instance:
-    return cpus_by_instance[instance_type]
+  info = instance_catalog.get_instance_type(instance_type)
+  if info is not None:
+    return info['vcpus']
   else:
     print >> stderr, ("WARNING: Don't know number of cpus on instance type %s; assuming 2"
                       % instance_type)
     return 2
 
+# Get the mount points of the local disks of a given EC2 instance type; the
+# first disk (or the root volume) is at /mnt and the others at /mnt2, /mnt3...
+def get_local_mounts(instance_type):
+  return ["/mnt"] + ["/mnt%d" % i for i in
+                     range(2, get_num_disks(instance_type) + 1)]
+
+# Get the memory in MB a Spark worker should use on a given EC2 instance
+# type, leaving room for the OS and the HDFS daemons, or None if the type
+# isn't in the catalog
+def get_worker_memory_mb(instance_type):
+  info = instance_catalog.get_instance_type(instance_type)
+  if info is None:
+    return None
+  system_mb = info['memory_mb']
+  if system_mb > 20 * 1024:
+    return system_mb - 15 * 1024
+  else:
+    return max(512, system_mb - 1300)
+
+# Get the swap file size in MB for the cluster's nodes. Instance types
+# without local disks would put the swap file on the EBS root volume, so
+# they get none.
+def get_swap_mb(opts):
+  info = instance_catalog.get_instance_type(opts.instance_type)
+  if info is not None and info['disks'] == 0:
+    return 0
+  return opts.swap
+
 # Deploy the configuration file templates in a given local directory to
 # a cluster, filling in any template parameters with information about the
 # cluster (e.g. lists of masters and slaves). Files are only deployed to
 # the first master instance in the cluster, and we expect the setup
 # script to be run on that instance to copy them to other nodes.
+@timeline.traced("phase")
 def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, zoo_nodes,
         modules):
   active_master = master_nodes[0].public_dns_name
@@ -633,6 +1943,15 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, zoo_nodes,
       mapred_local_dirs += ",/mnt%d/hadoop/mrlocal" % i
       spark_local_dirs += ",/mnt%d/spark" % i
 
+  # Leave these empty for types missing from the catalog so that Spark
+  # picks its own defaults instead of our fallback guesses
+  if instance_catalog.get_instance_type(opts.instance_type) is not None:
+    spark_worker_cores = str(get_num_cpus(opts.instance_type))
+    spark_worker_memory = "%dm" % get_worker_memory_mb(opts.instance_type)
+  else:
+    spark_worker_cores = ""
+    spark_worker_memory = ""
+
   if zoo_nodes != []:
     zoo_list = '\n'.join([i.public_dns_name for i in zoo_nodes])
     cluster_url = "zoo://" + ",".join(
@@ -650,53 +1969,168 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, zoo_nodes,
     "hdfs_data_dirs": hdfs_data_dirs,
     "mapred_local_dirs": mapred_local_dirs,
     "spark_local_dirs": spark_local_dirs,
-    "swap": str(opts.swap),
+    "spark_worker_cores": spark_worker_cores,
+    "spark_worker_memory": spark_worker_memory,
+    "swap": str(get_swap_mb(opts)),
     "modules": '\n'.join(modules)
   }
 
-  # Create a temp directory in which we will place all the files to be
-  # deployed after we substitue template parameters in them
-  tmp_dir = tempfile.mkdtemp()
-  for path, dirs, files in os.walk(root_dir):
+  # Render all templates in memory
+  files = {}
+  for path, dirs, filenames in os.walk(root_dir):
     if path.find(".svn") == -1:
       dest_dir = os.path.join('/', path[len(root_dir):])
-      local_dir = tmp_dir + dest_dir
-      if not os.path.exists(local_dir):
-        os.makedirs(local_dir)
-      for filename in files:
+      for filename in filenames:
         if filename[0] not in '#.~' and filename[-1] != '~':
-          dest_file = os.path.join(dest_dir, filename)
-          local_file = tmp_dir + dest_file
-          with open(os.path.join(path, filename)) as src:
-            with open(local_file, "w") as dest:
-              text = src.read()
-              for key in template_vars:
-                text = text.replace("{{" + key + "}}", template_vars[key])
-              dest.write(text)
-              dest.close()
-  # rsync the whole directory over to the master machine
-  command = (("rsync -rv -e 'ssh -o StrictHostKeyChecking=no -i %s' " +
-      "'%s/' '%s@%s:/'") % (opts.identity_file, tmp_dir, opts.user, active_master))
-  subprocess.check_call(command, shell=True)
-  # Remove the temp directory we created above
-  shutil.rmtree(tmp_dir)
+          local_file = os.path.join(path, filename)
+          unknown = set()
+          text = render_template(compile_template(local_file), template_vars,
+                                 unknown)
+          if unknown:
+            print >> stderr, ("WARNING: Unknown template variables in %s: %s" %
+                              (local_file, ", ".join(sorted(unknown))))
+          files[os.path.join(dest_dir, filename)] = (
+              text, os.stat(local_file).st_mode & 0777)
+
+  # Only send the files whose rendered contents differ from what the
+  # master's manifest says was deployed last time
+  manifest = {}
+  for dest_file in files:
+    manifest[dest_file] = hashlib.sha1(files[dest_file][0]).hexdigest()
+  try:
+    old_manifest = json.loads(ssh_read(active_master, opts,
+        "cat %s 2>/dev/null; true" % DEPLOY_MANIFEST) or "{}")
+  except ValueError:
+    old_manifest = {}
+  changed = sorted([f for f in files if old_manifest.get(f) != manifest[f]])
+  if changed == []:
+    print "All %d files are up to date on the master" % len(files)
+    return
+  print "Sending %d of %d files: %s" % (len(changed), len(files),
+                                       " ".join(changed))
+
+  # Stream the changed files and the new manifest as an in-memory archive
+  # over the existing ssh connection
+  archive = StringIO()
+  tar = tarfile.open(fileobj=archive, mode="w:gz")
+  now = time.time()
+  for (dest_file, text, mode) in \
+      [(f, files[f][0], files[f][1]) for f in changed] + \
+      [(DEPLOY_MANIFEST, json.dumps(manifest), 0644)]:
+    info = tarfile.TarInfo(dest_file.lstrip('/'))
+    info.size = len(text)
+    info.mode = mode
+    info.mtime = now
+    tar.addfile(info, StringIO(text))
+  tar.close()
+  ssh_pipe(active_master, opts, "tar xzf - -C /", archive.getvalue())
+
+
+# Parsed templates, keyed by path, with the mtime they were parsed at
+template_cache = {}
+
+
+# Split a template file into literal text and placeholder names, once per
+# file version: the result alternates literal text (even indices) and
+# placeholder names (odd indices)
+def compile_template(path):
+  mtime = os.path.getmtime(path)
+  if path not in template_cache or template_cache[path][0] != mtime:
+    with open(path) as src:
+      template_cache[path] = (mtime, TEMPLATE_PATTERN.split(src.read()))
+  return template_cache[path][1]
+
+
+# Fill in a compiled template in a single pass. Placeholders with no value
+# in template_vars are left as they are and added to `unknown`.
+def render_template(parts, template_vars, unknown):
+  out = []
+  for (i, part) in enumerate(parts):
+    if i % 2 == 0:
+      out.append(part)
+    elif part in template_vars:
+      out.append(template_vars[part])
+    else:
+      unknown.add(part)
+      out.append("{{" + part + "}}")
+  return "".join(out)
+
+
+# Directory holding the ControlMaster sockets opened by this process.
+# Created on first use and removed by close_ssh_connections(). It lives
+# directly under /tmp rather than under $TMPDIR, which is long on Mac OS X,
+# because socket paths (including the host name) are limited to 104 bytes.
+ssh_control_dir = None
+ssh_control_lock = threading.Lock()
+
+
+# Common options for ssh, scp and rsync. All connections to the same host
+# share one persistent, multiplexed ssh connection (ControlMaster), so only
+# the first remote call to a host pays for the TCP and key exchange.
+def ssh_args(opts):
+  global ssh_control_dir
+  with ssh_control_lock:
+    if ssh_control_dir is None:
+      ssh_control_dir = tempfile.mkdtemp(prefix="sec2-", dir="/tmp")
+  return ("-o StrictHostKeyChecking=no -i %s -o ControlMaster=auto " +
+          "-o ControlPath=%s/%%r@%%h:%%p -o ControlPersist=600") % (
+          opts.identity_file, ssh_control_dir)
+
+
+# Backend that takes the place of ssh, scp and the Spark master's web UI
+# when set, e.g. fake_cluster.FakeNodes for benchmarks. It must provide
+#   is_ssh_ready(host) -> bool
+#   run(host, command, data=None) -> (exit status, output)
+#   run_script(host, steps, stop_on_error) -> [(name, exit status, secs)]
+#   copy(host, local_file, dest_file) -> exit status
+#   get_spark_json(master) -> status page, or None if it can't be fetched
+# None (the default) means the real network is used.
+node_backend = None
+
+
+# Shut down all multiplexed ssh connections opened by this process
+def close_ssh_connections():
+  global ssh_control_dir
+  with ssh_control_lock:
+    if ssh_control_dir is None:
+      return
+    with open(os.devnull, "w") as devnull:
+      for socket_name in os.listdir(ssh_control_dir):
+        subprocess.call(["ssh", "-o", "ControlPath=" +
+                         os.path.join(ssh_control_dir, socket_name),
+                         "-O", "exit", "localhost"],
+                        stdout=devnull, stderr=devnull)
+    shutil.rmtree(ssh_control_dir, ignore_errors=True)
+    ssh_control_dir = None
 
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
+@timeline.traced("ssh", host=0)
 def scp(host, opts, local_file, dest_file):
+  if node_backend is not None:
+    status = node_backend.copy(host, local_file, dest_file)
+    if status != 0:
+      raise subprocess.CalledProcessError(status, "scp to " + host)
+    return
   subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s' '%s@%s:%s'" %
-      (opts.identity_file, local_file, opts.user, host, dest_file), shell=True)
+      "scp -q %s '%s' '%s@%s:%s'" %
+      (ssh_args(opts), local_file, opts.user, host, dest_file), shell=True)
 
 
 # Run a command on a host through ssh, throwing an exception if ssh fails
+@timeline.traced("ssh", host=0)
 def ssh(host, opts, command):
   tries = 0
   while True:
     try:
+      if node_backend is not None:
+        status = node_backend.run(host, command)[0]
+        if status != 0:
+          raise subprocess.CalledProcessError(status, command)
+        return 0
       return subprocess.check_call(
-        "ssh -t -o StrictHostKeyChecking=no -i %s %s@%s '%s'" %
-        (opts.identity_file, opts.user, host, command), shell=True)
+        "ssh -t %s %s@%s '%s'" %
+        (ssh_args(opts), opts.user, host, command), shell=True)
     except subprocess.CalledProcessError as e:
       if (tries > 2):
         raise e
@@ -704,6 +2138,109 @@ def ssh(host, opts, command):
       time.sleep(30)
       tries = tries + 1
 
+
+# Run a command on a host through ssh and return its standard output,
+# throwing an exception if ssh fails
+@timeline.traced("ssh", host=0)
+def ssh_read(host, opts, command):
+  if node_backend is not None:
+    (status, out) = node_backend.run(host, command)
+  else:
+    proc = subprocess.Popen("ssh %s %s@%s %s" %
+                            (ssh_args(opts), opts.user, host,
+                             pipes.quote(command)),
+                            shell=True, stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    status = proc.returncode
+  if status != 0:
+    raise subprocess.CalledProcessError(status, command)
+  return out
+
+
+# Run a command on a host through ssh with the given string as its
+# standard input, throwing an exception if ssh fails
+@timeline.traced("ssh", host=0)
+def ssh_pipe(host, opts, command, data):
+  if node_backend is not None:
+    status = node_backend.run(host, command, data)[0]
+  else:
+    proc = subprocess.Popen("ssh %s %s@%s %s" %
+                            (ssh_args(opts), opts.user, host,
+                             pipes.quote(command)),
+                            shell=True, stdin=subprocess.PIPE)
+    proc.communicate(data)
+    status = proc.returncode
+  if status != 0:
+    raise subprocess.CalledProcessError(status, command)
+
+
+# Run a sequence of remote steps on a host as a single script over one ssh
+# session. Each step is a (name, shell command) pair; commands are sent on
+# stdin, so they need no extra quoting. Execution stops at the first failing
+# step unless stop_on_error is False.
+# Returns a list of (name, exit status, seconds) tuples for the steps that
+# ran, and raises CalledProcessError if any of them failed.
+@timeline.traced("ssh", host=0)
+def ssh_script(host, opts, steps, stop_on_error=True):
+  if node_backend is not None:
+    results = node_backend.run_script(host, steps, stop_on_error)
+    if [r for r in results if r[1] != 0] != []:
+      for (name, status, secs) in results:
+        print >> stderr, "  %-40s exit %d in %.1fs" % (name, status, secs)
+      raise subprocess.CalledProcessError(1, "remote script on " + host)
+    return results
+  marker = "__spark_ec2_step_%08x" % random.getrandbits(32)
+  lines = []
+  for (i, (name, command)) in enumerate(steps):
+    lines.append("__start=$(date +%s%N)")
+    lines.append("(\n" + command + "\n) < /dev/null")
+    lines.append("__status=$?")
+    # The marker starts on a new line even if the step's output didn't end
+    # with one; the extra empty line is dropped when reading
+    lines.append('echo; echo "%s %d $__status $(( ($(date +%%s%%N) - __start) / 1000000 ))"'
+                 % (marker, i))
+    if stop_on_error:
+      lines.append("[ $__status -eq 0 ] || exit $__status")
+  script = "\n".join(lines) + "\n"
+
+  tries = 0
+  while True:
+    proc = subprocess.Popen(
+        "ssh %s %s@%s 'bash -s'" % (ssh_args(opts), opts.user, host),
+        shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(script)
+    proc.stdin.close()
+    results = []
+    held_newline = False
+    for line in iter(proc.stdout.readline, ""):
+      if held_newline and not line.startswith(marker + " "):
+        sys.stdout.write("\n")
+      held_newline = line == "\n"
+      if held_newline:
+        continue
+      if line.startswith(marker + " "):
+        (i, status, millis) = [int(x) for x in line.split()[1:]]
+        results.append((steps[i][0], status, millis / 1000.0))
+        now = time.time()
+        timeline.record(steps[i][0], "step", now - millis / 1000.0, now,
+                        {"host": host, "status": status,
+                         "outcome": "ok" if status == 0 else "failed"})
+      else:
+        sys.stdout.write(line)
+    ret = proc.wait()
+    # Only retry if ssh itself failed before any step started
+    if ret == 255 and results == [] and tries <= 2:
+      print "Error connecting to host %s, sleeping 30" % host
+      time.sleep(30)
+      tries = tries + 1
+      continue
+    failed = [r for r in results if r[1] != 0]
+    if failed != [] or (ret != 0 and len(results) < len(steps)):
+      for (name, status, secs) in results:
+        print >> stderr, "  %-40s exit %d in %.1fs" % (name, status, secs)
+      raise subprocess.CalledProcessError(ret, "remote script on " + host)
+    return results
+
 # Gets a list of zones to launch instances in
 def get_zones(conn, opts):
   if opts.zone == 'all':
@@ -720,117 +2257,449 @@ def get_partition(total, num_partitions, current_partitions):
     num_slaves_this_zone += 1
   return num_slaves_this_zone
 
-def wait_for_spark_cluster(master_nodes, opts):
-  err = check_spark_cluster(master_nodes, opts)
+# Wait for the Spark workers of all slaves to register with the master.
+# While the number of registered workers keeps rising we only poll, backing
+# off up to 15 seconds between polls. Once it has stopped rising for
+# settle_secs we restart just the workers that are missing or dead (each at
+# most max_restarts times), or start the cluster again if the master itself
+# doesn't answer. Gives up after opts.spark_timeout seconds.
+# Returns 0 if the master reports the expected number of cores, -1 otherwise.
+@timeline.traced("phase")
+def wait_for_spark_cluster(master_nodes, slave_nodes, opts, settle_secs=20,
+                           max_restarts=3):
   master = master_nodes[0].public_dns_name
-  count = 0
-  while err != 0 and count < 10:
-    # try to restart spark
-    ssh(master, opts, '/root/spark/bin/stop-all.sh')
-    ssh(master, opts, '/root/spark/bin/start-all.sh')
-    time.sleep(5)
-    err = check_spark_cluster(master_nodes, opts)
-    count = count + 1
-  return err
+  deadline = time.time() + opts.spark_timeout
+  interval = 2
+  last_registered = -1
+  last_progress = time.time()
+  restarts = {}
+  master_restarted = False
+  while True:
+    spark_json = get_spark_json(master)
+    status = None
+    if spark_json is not None:
+      try:
+        status = json.loads(spark_json)
+      except ValueError as e:
+        print "Could not parse the Spark master's status page: %s" % e
+
+    if status is not None:
+      (registered, missing) = get_worker_status(status, slave_nodes)
+      alive = len([w for w in status.get("workers", [])
+                   if w.get("state", "ALIVE") == "ALIVE"])
+      if missing == [] or alive >= len(slave_nodes):
+        return check_spark_json(spark_json, opts, slave_nodes)
+      if len(registered) > last_registered:
+        print "%d of %d Spark workers registered" % (len(registered),
+                                                     len(slave_nodes))
+        last_registered = len(registered)
+        last_progress = time.time()
+        interval = 2
+      elif time.time() - last_progress >= settle_secs:
+        to_restart = [i for i in missing if restarts.get(i.id, 0) < max_restarts]
+        if to_restart != []:
+          restart_spark_workers(to_restart, status.get("url") or
+                                "spark://%s:7077" % master, opts)
+          for i in to_restart:
+            restarts[i.id] = restarts.get(i.id, 0) + 1
+        last_progress = time.time()
+    elif not master_restarted and time.time() - last_progress >= settle_secs:
+      print "Spark master is not answering, starting the cluster again..."
+      try:
+        ssh_script(master, opts, [
+          ("start-all.sh", "/root/spark/bin/start-all.sh")])
+      except subprocess.CalledProcessError:
+        print >> stderr, "WARNING: Could not start Spark on " + master
+      master_restarted = True
+      last_progress = time.time()
+
+    if time.time() + interval > deadline:
+      break
+    time.sleep(interval)
+    interval = min(interval * 2, 15)
+
+  if status is None:
+    print >> stderr, "ERROR: Spark master %s did not answer within %d seconds" % (
+        master, opts.spark_timeout)
+    return -1
+  print >> stderr, ("WARNING: No Spark worker registered for %d slaves " +
+                    "after %d seconds: %s") % (len(missing), opts.spark_timeout,
+      " ".join([i.public_dns_name for i in missing]))
+  return check_spark_json(spark_json, opts, slave_nodes)
+
+# Launch a cluster (or with --resume, set up an existing one again), wait
+# for Spark to come up and optionally copy the AMP Camp data into HDFS.
+# Returns a dict with the cluster name, whether it succeeded, the master's
+# hostname, an error message, per-dataset copy times and total seconds.
+@timeline.traced("cluster", cluster=2)
+def launch_and_setup(conn, opts, cluster_name, groups=None, image=None):
+  start = time.time()
+  result = {"cluster": cluster_name, "success": False, "master": None,
+            "error": None, "copy_timings": {}}
+  if opts.resume:
+    (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
+        conn, opts, cluster_name)
+    setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, True)
+  elif opts.pipeline:
+    (master_nodes, slave_nodes, zoo_nodes) = launch_cluster(
+        conn, opts, cluster_name, groups, image)
+    ec2_inventory.invalidate(opts.region)
+    slave_nodes = pipelined_setup(conn, opts, master_nodes, slave_nodes,
+                                  zoo_nodes)
+  else:
+    (master_nodes, slave_nodes, zoo_nodes) = launch_cluster(
+        conn, opts, cluster_name, groups, image)
+    ec2_inventory.invalidate(opts.region)
+    slave_nodes = wait_for_cluster(conn, opts, master_nodes, slave_nodes,
+                                   zoo_nodes)
+    setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, True)
+  result["master"] = master_nodes[0].public_dns_name
+  print "Waiting for cluster to start..."
+  err = wait_for_spark_cluster(master_nodes, slave_nodes, opts)
+  if err != 0:
+    result["error"] = "Cluster health check failed"
+    diagnose_cluster(master_nodes, slave_nodes, opts)
+  else:
+    if opts.copy:
+      result["copy_timings"] = copy_ampcamp_data_from_ebs(master_nodes, opts)
+    result["success"] = True
+  result["seconds"] = time.time() - start
+  return result
+
+
+# Stream wrapper that prefixes every line written by a thread with the name
+# of the cluster that thread works on (see set_cluster), so that the output
+# of clusters launched side by side can be told apart. Threads without a
+# cluster write through unchanged.
+class ClusterOutput(object):
+  def __init__(self, stream):
+    self.stream = stream
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  # Prefix what the calling thread writes from now on with cluster_name, or
+  # stop prefixing it for None
+  def set_cluster(self, cluster_name):
+    self.flush_line()
+    self.local.cluster = cluster_name
+    self.local.partial = ""
+
+  def write(self, text):
+    cluster = getattr(self.local, "cluster", None)
+    if cluster is None:
+      with self.lock:
+        self.stream.write(text)
+      return
+    lines = (self.local.partial + text).split("\n")
+    # Hold back an unfinished line until the rest of it is written
+    self.local.partial = lines.pop()
+    if lines != []:
+      with self.lock:
+        self.stream.write("".join(["[%s] %s\n" % (cluster, line)
+                                   for line in lines]))
+
+  # Write out the calling thread's unfinished line, if any
+  def flush_line(self):
+    if getattr(self.local, "partial", "") != "":
+      self.write("\n")
+
+  def flush(self):
+    self.stream.flush()
+
+
+# Launch several clusters inside this process, keeping at most `parallel`
+# launches in flight and starting at most one every `stagger` seconds. All
+# launches share one EC2 connection, one AMI lookup and one set of security
+# groups. No new launches are started once one has failed. Every line a
+# launch prints is prefixed with its cluster's name.
+# Returns a list of result dicts (see launch_and_setup) in the order of
+# cluster_names.
+def launch_fleet(conn, opts, cluster_names, parallel=1, stagger=0):
+  global stderr
+  instance_catalog.load_catalog(opts.instance_catalog)
+  groups = setup_security_groups(conn, opts)
+  image = resolve_ami(conn, opts)
+  zones = [z.name for z in conn.get_all_zones()]
+  lock = threading.Lock()
+  state = {"last_start": 0, "failed": False}
+  (real_stdout, real_stderr) = (sys.stdout, stderr)
+  outputs = [ClusterOutput(real_stdout), ClusterOutput(real_stderr)]
+
+  def launch_one(cluster_name):
+    with lock:
+      if state["failed"]:
+        return {"cluster": cluster_name, "success": False, "master": None,
+                "error": "Skipped after an earlier launch failed",
+                "copy_timings": {}, "seconds": 0}
+      delay = state["last_start"] + stagger - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      state["last_start"] = time.time()
+
+    # Launches modify their options (AMI, zone, S3 buckets), so each one
+    # gets its own copy
+    cluster_opts = copy.copy(opts)
+    if cluster_opts.zone == "":
+      cluster_opts.zone = random.choice(zones)
+    start = time.time()
+    try:
+      result = launch_and_setup(conn, cluster_opts, cluster_name, groups,
+                                image)
+    except (Exception, SystemExit) as e:
+      result = {"cluster": cluster_name, "success": False, "master": None,
+                "error": "%s: %s" % (e.__class__.__name__, e),
+                "copy_timings": {}, "seconds": time.time() - start}
+    if not result["success"]:
+      with lock:
+        state["failed"] = True
+    return result
+
+  def launch_prefixed(cluster_name):
+    for output in outputs:
+      output.set_cluster(cluster_name)
+    try:
+      return launch_one(cluster_name)
+    finally:
+      for output in outputs:
+        output.set_cluster(None)
+
+  (sys.stdout, sys.stderr) = outputs
+  stderr = outputs[1]
+  pool = ThreadPool(max(1, parallel))
+  try:
+    return pool.map(launch_prefixed, cluster_names, chunksize=1)
+  finally:
+    pool.close()
+    (sys.stdout, sys.stderr) = (real_stdout, real_stderr)
+    stderr = real_stderr
+
+
+# Stop clusters found with find_clusters with one batched StopInstances call
+# per role and wait (at most timeout seconds) until EC2 reports every
+# instance stopped.
+# Returns the instances that did not stop in time.
+@timeline.traced("phase")
+def stop_clusters(conn, opts, clusters, timeout=600):
+  instances = sum(clusters.values(), [])
+  for (role, label) in [("master", "master"), ("slave", "slaves"),
+                        ("zoo", "zoo")]:
+    nodes = [i for i in instances if i.tags.get('type') == role and
+             i.state in ['pending', 'running']]
+    if nodes != []:
+      print "Stopping %d %s..." % (len(nodes), label)
+      call_in_batches(conn.stop_instances, nodes)
+  ec2_inventory.invalidate(opts.region)
+  print "Waiting for instances to stop..."
+  return wait_for_instances(conn, instances, ['pending', 'running', 'stopping'],
+                            timeout=timeout)
+
+
+# Start the stopped instances of clusters found with find_clusters with
+# batched StartInstances calls per role. A batch that fails is retried one
+# cluster at a time, so that a cluster that can't start (e.g. for lack of
+# capacity for its instance type) doesn't keep the others in the batch from
+# starting; the master of a cluster whose slaves failed is not started.
+# Returns a dict of cluster name -> error for the clusters that failed.
+def start_cluster_instances(conn, clusters):
+  cluster_of = dict([(i.id, name) for name in clusters
+                     for i in clusters[name]])
+  instances = sum(clusters.values(), [])
+  errors = {}
+  for (role, label) in [("slave", "slaves"), ("master", "master"),
+                        ("zoo", "zoo")]:
+    ids = [i.id for i in instances if i.tags.get('type') == role and
+           i.state == 'stopped' and cluster_of[i.id] not in errors]
+    if ids != []:
+      print "Starting %d %s..." % (len(ids), label)
+    for start in range(0, len(ids), INSTANCE_BATCH_SIZE):
+      batch = ids[start:start + INSTANCE_BATCH_SIZE]
+      try:
+        conn.start_instances(batch)
+        continue
+      except boto.exception.EC2ResponseError as e:
+        print >> stderr, ("WARNING: Could not start a batch of %d %s (%s), " +
+                          "retrying one cluster at a time") % (
+                          len(batch), label, e.error_code)
+      for name in sorted(set([cluster_of[i] for i in batch])):
+        try:
+          conn.start_instances([i for i in batch if cluster_of[i] == name])
+        except boto.exception.EC2ResponseError as e:
+          errors[name] = "Could not start the %s: %s: %s" % (
+              label, e.error_code, e.error_message)
+          print >> stderr, "ERROR: %s: %s" % (name, errors[name])
+  return errors
+
+
+# Start clusters found with find_clusters (see start_cluster_instances),
+# wait (at most timeout seconds) until EC2 reports the started instances
+# running, then bring up the clusters, up to `parallel` at a time (see
+# restart_cluster). Instances that EC2 still reports stopped START_GRACE
+# seconds after starting them are not waited for.
+# Returns a list of result dicts (see launch_and_setup), one per cluster.
+@timeline.traced("phase")
+def start_clusters(conn, opts, clusters, parallel=16, timeout=600):
+  instances = sum(clusters.values(), [])
+  # Instances can only be started again once they have stopped
+  if [i for i in instances if i.state == 'stopping'] != []:
+    print "Waiting for instances that are still stopping..."
+    wait_for_instances(conn, instances, ['stopping'], timeout=timeout)
+  errors = start_cluster_instances(conn, clusters)
+  ec2_inventory.invalidate(opts.region)
+  started = sum([clusters[name] for name in clusters if name not in errors],
+                [])
+  if started != []:
+    print "Waiting for instances to start up..."
+    start = time.time()
+    not_started = wait_for_instances(conn, started, ['stopped'],
+                                     timeout=min(START_GRACE, timeout))
+    if not_started != []:
+      print >> stderr, "WARNING: %d instances did not start: %s" % (
+          len(not_started), " ".join([i.id for i in not_started]))
+    wait_for_instances(conn, started, ['pending'],
+                       timeout=max(0, timeout - (time.time() - start)))
+
+  def start_one(cluster_name):
+    if cluster_name in errors:
+      return {"cluster": cluster_name, "success": False, "master": None,
+              "error": errors[cluster_name], "copy_timings": {},
+              "seconds": 0}
+    start = time.time()
+    try:
+      return restart_cluster(conn, copy.copy(opts), cluster_name,
+                             clusters[cluster_name])
+    except (Exception, SystemExit) as e:
+      return {"cluster": cluster_name, "success": False, "master": None,
+              "error": "%s: %s" % (e.__class__.__name__, e),
+              "copy_timings": {}, "seconds": time.time() - start}
+
+  pool = ThreadPool(max(1, min(parallel, len(clusters))))
+  try:
+    return pool.map(start_one, sorted(clusters), chunksize=1)
+  finally:
+    pool.close()
+
+
+# Bring up a cluster whose instances were just started again. If setup.sh
+# already completed on the master with the current setup scripts (see
+# is_setup_done), only the services are restarted; otherwise, or with
+# --full-setup, the complete setup runs again. Slaves that don't come back
+# are left out. opts is modified.
+# Returns a result dict (see launch_and_setup).
+@timeline.traced("cluster", cluster=2)
+def restart_cluster(conn, opts, cluster_name, instances):
+  start = time.time()
+  result = {"cluster": cluster_name, "success": False, "master": None,
+            "error": None, "copy_timings": {}}
+  running = [i for i in instances if i.state == 'running']
+  master_nodes = [i for i in running if i.tags.get('type') == 'master']
+  slave_nodes = [i for i in running if i.tags.get('type') == 'slave']
+  zoo_nodes = [i for i in running if i.tags.get('type') == 'zoo']
+  if master_nodes == [] or slave_nodes == []:
+    result["error"] = "Master or slaves are not running"
+    result["seconds"] = time.time() - start
+    return result
+  # The health check expects the size and type of the running cluster,
+  # not the command-line defaults
+  opts.instance_type = slave_nodes[0].instance_type
+  master = master_nodes[0].public_dns_name
+  result["master"] = master
+
+  print "Waiting up to %d seconds for SSH on %s..." % (opts.wait, cluster_name)
+  ready = wait_for_ssh(opts, opts.wait, [master],
+                       [i.public_dns_name for i in slave_nodes + zoo_nodes],
+                       opts.ssh_quorum)
+  if master not in ready:
+    raise Exception("Master %s does not accept SSH" % master)
+  slave_nodes = [i for i in slave_nodes if i.public_dns_name in ready]
+  modules = get_modules(opts)
+  unrestartable = get_unrestartable_modules(modules)
+  if unrestartable != [] and not opts.full_setup:
+    print "No fast restart for %s, running the full setup" % \
+        ", ".join(unrestartable)
+  if not opts.full_setup and unrestartable == [] and \
+      is_setup_done(master, opts, modules):
+    print "Setup of %s is already done, restarting services only" % \
+        cluster_name
+    slave_nodes = fast_restart_cluster(conn, opts, master_nodes, slave_nodes,
+                                       zoo_nodes, modules)
+  else:
+    setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, False)
+  opts.slaves = len(slave_nodes)
+
+  print "Waiting for cluster to start..."
+  err = wait_for_spark_cluster(master_nodes, slave_nodes, opts)
+  if err != 0:
+    result["error"] = "Cluster health check failed"
+    diagnose_cluster(master_nodes, slave_nodes, opts)
+  else:
+    if opts.copy:
+      result["copy_timings"] = copy_ampcamp_data_from_ebs(master_nodes, opts)
+    result["success"] = True
+  result["seconds"] = time.time() - start
+  return result
+
 
 def main():
   (opts, action, cluster_name) = parse_args()
+  if opts.trace_file is not None:
+    timeline.enable()
+    atexit.register(timeline.finish, opts.trace_file)
+  if opts.api_stats is not None:
+    ec2_client.dump_stats_at_exit(opts.api_stats)
   try:
-    conn = ec2.connect_to_region(opts.region)
+    conn = ec2_client.connect(opts.region)
   except Exception as e:
     print >> stderr, (e)
     sys.exit(1)
 
+  instance_catalog.load_catalog(opts.instance_catalog)
+  timeline.trace_connection(conn)
+
   # Select an AZ at random if it was not specified.
   if opts.zone == "":
     opts.zone = random.choice(conn.get_all_zones()).name
 
   if action == "launch":
-    if opts.resume:
-      (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-          conn, opts, cluster_name)
-    else:
-      (master_nodes, slave_nodes, zoo_nodes) = launch_cluster(
-          conn, opts, cluster_name)
-      wait_for_cluster(conn, opts.wait, master_nodes, slave_nodes, zoo_nodes)
-    setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, True)
-    print "Waiting for cluster to start..."
-    err = wait_for_spark_cluster(master_nodes, opts)
-    if err != 0:
+    result = launch_and_setup(conn, opts, cluster_name)
+    if not result["success"]:
       print >> stderr, "ERROR: Cluster health check failed for spark_ec2"
       sys.exit(1)
-    if opts.copy:
-      copy_ampcamp_data_from_ebs(master_nodes, opts)
+    print_copy_timings(result["copy_timings"])
     print >>stderr, "SUCCESS: Cluster successfully launched! " + \
-      "You can login to the master at " + master_nodes[0].public_dns_name
+      "You can login to the master at " + result["master"]
 
   elif action == "destroy":
+    # Several clusters can be given separated by commas, or with --prefix
+    # every cluster whose name starts with one of them
+    cluster_names = cluster_name.split(",")
+    clusters = find_clusters(conn, cluster_names, opts.prefix)
+    if not opts.prefix:
+      for name in cluster_names:
+        clusters.setdefault(name, [])
+    if clusters == {}:
+      print "No clusters found starting with " + cluster_name
+      sys.exit(0)
+    for name in sorted(clusters):
+      print "Found %d instances in cluster %s" % (len(clusters[name]), name)
     if not opts.destroy_noprompt:
-      response = raw_input("Are you sure you want to destroy the cluster " +
-          cluster_name + "?\nALL DATA ON ALL NODES WILL BE LOST!!\n" +
-          "Destroy cluster " + cluster_name + " (y/N): ")
+      response = raw_input("Are you sure you want to destroy " +
+          "%d cluster(s)?\nALL DATA ON ALL NODES WILL BE LOST!!\n" %
+          len(clusters) +
+          "Destroy cluster(s) " + ", ".join(sorted(clusters)) + " (y/N): ")
     else:
       response = "y"
 
     if response == "y":
-      (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-          conn, opts, cluster_name, die_on_error=False)
-      print "Terminating master..."
-      for inst in master_nodes:
-        inst.terminate()
-      print "Terminating slaves..."
-      for inst in slave_nodes:
-        inst.terminate()
-      if zoo_nodes != []:
-        print "Terminating zoo..."
-        for inst in zoo_nodes:
-          inst.terminate()
-
-      # Delete security groups as well
-      if opts.delete_groups:
-        print "Deleting security groups (this will take some time)..."
-        group_names = [cluster_name + "-master", cluster_name + "-slaves", cluster_name + "-zoo"]
-
-        attempt = 1;
-        while attempt <= 3:
-          print "Attempt %d" % attempt
-          groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
-          success = True
-          # Delete individual rules in all groups before deleting groups to
-          # remove dependencies between them
-          for group in groups:
-            print "Deleting rules in security group " + group.name
-            for rule in group.rules:
-              for grant in rule.grants:
-                  success &= group.revoke(ip_protocol=rule.ip_protocol,
-                           from_port=rule.from_port,
-                           to_port=rule.to_port,
-                           src_group=grant)
-
-          # Sleep for AWS eventual-consistency to catch up, and for instances
-          # to terminate
-          time.sleep(30)  # Yes, it does have to be this long :-(
-          for group in groups:
-            try:
-              conn.delete_security_group(group.name)
-              print "Deleted security group " + group.name
-            except boto.exception.EC2ResponseError:
-              success = False;
-              print "Failed to delete security group " + group.name
-
-          # Unfortunately, group.revoke() returns True even if a rule was not
-          # deleted, so this needs to be rerun if something fails
-          if success: break;
-
-          attempt += 1
-
-        if not success:
-          print "Failed to delete all security groups after 3 tries."
-          print "Try re-running in a few minutes."
+      results = destroy_clusters(conn, opts, clusters, opts.delete_groups)
+      failed = sorted([name for name in results if not results[name]])
+      if failed != []:
+        print "Failed to delete all security groups of " + ", ".join(failed)
+        print "Try re-running in a few minutes."
+        sys.exit(1)
 
   elif action == "login":
     (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-        conn, opts, cluster_name)
+        conn, opts, cluster_name, cached=True)
     master = master_nodes[0].public_dns_name
     print "Logging into master " + master + "..."
     proxy_opt = ""
@@ -840,70 +2709,64 @@ def main():
         (opts.identity_file, proxy_opt, opts.user, master), shell=True)
 
   elif action == "get-master":
-    (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(conn, opts, cluster_name)
+    (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
+        conn, opts, cluster_name, cached=True)
     print master_nodes[0].public_dns_name
 
   elif action == "copy-data":
     (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(conn, opts, cluster_name)
     print "Waiting for cluster to start..."
-    err = wait_for_spark_cluster(master_nodes, opts)
+    err = wait_for_spark_cluster(master_nodes, slave_nodes, opts)
     if err != 0:
       print >> stderr, "ERROR: Cluster health check failed for spark_ec2"
       sys.exit(1)
-    copy_ampcamp_data_from_ebs(master_nodes, opts)
+    copy_timings = copy_ampcamp_data_from_ebs(master_nodes, opts)
+    print_copy_timings(copy_timings)
     print >>stderr, "SUCCESS: Data copied successfully! " + \
         "You can login to the master at " + master_nodes[0].public_dns_name
 
+  elif action == "diagnose":
+    (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
+        conn, opts, cluster_name)
+    flagged = diagnose_cluster(master_nodes, slave_nodes, opts, opts.probe)
+    if flagged != 0:
+      sys.exit(1)
+
   elif action == "stop":
-    response = raw_input("Are you sure you want to stop the cluster " +
-        cluster_name + "?\nDATA ON EPHEMERAL DISKS WILL BE LOST, " +
+    clusters = find_clusters(conn, cluster_name.split(","), opts.prefix)
+    if clusters == {}:
+      print >> stderr, "ERROR: Could not find any existing cluster"
+      sys.exit(1)
+    response = raw_input("Are you sure you want to stop the cluster(s) " +
+        ", ".join(sorted(clusters)) + "?\nDATA ON EPHEMERAL DISKS WILL BE LOST, " +
         "BUT THE CLUSTER WILL KEEP USING SPACE ON\n" +
         "AMAZON EBS IF IT IS EBS-BACKED!!\n" +
-        "Stop cluster " + cluster_name + " (y/N): ")
+        "Stop %d cluster(s) (y/N): " % len(clusters))
     if response == "y":
-      (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-          conn, opts, cluster_name, die_on_error=False)
-      print "Stopping master..."
-      for inst in master_nodes:
-        if inst.state not in ["shutting-down", "terminated"]:
-          inst.stop()
-      print "Stopping slaves..."
-      for inst in slave_nodes:
-        if inst.state not in ["shutting-down", "terminated"]:
-          inst.stop()
-      if zoo_nodes != []:
-        print "Stopping zoo..."
-        for inst in zoo_nodes:
-          if inst.state not in ["shutting-down", "terminated"]:
-            inst.stop()
+      not_stopped = stop_clusters(conn, opts, clusters)
+      if not_stopped != []:
+        print >> stderr, "WARNING: %d instances have not stopped yet" % \
+            len(not_stopped)
 
   elif action == "start":
-    (master_nodes, slave_nodes, zoo_nodes) = get_existing_cluster(
-        conn, opts, cluster_name)
-    print "Starting slaves..."
-    for inst in slave_nodes:
-      if inst.state not in ["shutting-down", "terminated"]:
-        inst.start()
-    print "Starting master..."
-    for inst in master_nodes:
-      if inst.state not in ["shutting-down", "terminated"]:
-        inst.start()
-    if zoo_nodes != []:
-      print "Starting zoo..."
-      for inst in zoo_nodes:
-        if inst.state not in ["shutting-down", "terminated"]:
-          inst.start()
-    wait_for_cluster(conn, opts.wait, master_nodes, slave_nodes, zoo_nodes)
-    setup_cluster(conn, master_nodes, slave_nodes, zoo_nodes, opts, False)
-    print "Waiting for cluster to start..."
-    err = wait_for_spark_cluster(master_nodes, opts)
-    if err != 0:
-      print >> stderr, "ERROR: Cluster health check failed for spark_ec2"
+    clusters = find_clusters(conn, cluster_name.split(","), opts.prefix)
+    if clusters == {}:
+      print >> stderr, "ERROR: Could not find any existing cluster"
+      sys.exit(1)
+    results = start_clusters(conn, opts, clusters)
+    num_failed = 0
+    for result in results:
+      if result["success"]:
+        print_copy_timings(result["copy_timings"])
+        print >> stderr, ("SUCCESS: Cluster %s successfully started in " +
+            "%.0fs! You can login to the master at %s") % (
+            result["cluster"], result["seconds"], result["master"])
+      else:
+        num_failed += 1
+        print >> stderr, "ERROR: Cluster %s: %s" % (result["cluster"],
+                                                    result["error"])
+    if num_failed != 0:
       sys.exit(1)
-    if opts.copy:
-      copy_ampcamp_data_from_ebs(master_nodes, opts)
-    print >>stderr, "SUCCESS: Cluster successfully launched! " + \
-        "You can login to the master at " + master_nodes[0].public_dns_name
 
   else:
     print >> stderr, "Invalid action: %s" % action
@@ -912,4 +2775,7 @@ def main():
 
 if __name__ == "__main__":
   logging.basicConfig()
-  main()
+  try:
+    main()
+  finally:
+    close_ssh_connections()
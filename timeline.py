@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Timeline of what a spark_ec2 run spent its time on.
+#
+# Launch phases and every ssh / scp / EC2 API call are recorded as spans
+# with a start, an end, the thread they ran on, the host they talked to and
+# whether they succeeded. Nothing is recorded until enable() is called.
+# The spans can be written as a Chrome trace-event JSON file (open it in
+# chrome://tracing or https://ui.perfetto.dev) and summarised as a table of
+# total time per phase and call.
+
+from __future__ import with_statement
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+_start = time.time()
+
+
+def enable():
+  global _enabled, _start
+  with _lock:
+    _enabled = True
+    _start = time.time()
+    del _events[:]
+
+
+def is_enabled():
+  return _enabled
+
+
+# Record a span that has already finished, e.g. one a remote host timed
+def record(name, category, start, end, args=None):
+  if not _enabled:
+    return
+  thread = threading.current_thread()
+  with _lock:
+    _events.append({"name": name, "cat": category, "start": start,
+                    "end": end, "thread": thread.name,
+                    "tid": thread.ident, "args": args or {}})
+
+
+# Context manager that records the enclosed block as a span. The outcome
+# ("ok" or the name of the exception that escaped) is added to its args.
+class span(object):
+  def __init__(self, name, category, **args):
+    self.name = name
+    self.category = category
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if _enabled:
+      args = dict(self.args)
+      if exc_type is None:
+        args["outcome"] = "ok"
+      else:
+        args["outcome"] = exc_type.__name__
+      record(self.name, self.category, self.start, time.time(), args)
+    return False
+
+
+# Decorator recording every call of a function as a span named after it.
+# Keyword arguments name positional arguments to record in the span, e.g.
+# traced("ssh", host=0) records the first argument as the host.
+def traced(category, **arg_positions):
+  def decorate(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return fn(*args, **kwargs)
+      span_args = {}
+      for (name, pos) in arg_positions.items():
+        if len(args) > pos:
+          span_args[name] = str(args[pos])
+      with span(fn.__name__, category, **span_args):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorate
+
+
+# Record every EC2 API request made through a boto connection as an "ec2"
+# span named after the API action
+def trace_connection(conn):
+  make_request = conn.make_request
+
+  def traced_make_request(action, *args, **kwargs):
+    if not _enabled:
+      return make_request(action, *args, **kwargs)
+    with span(action, "ec2", region=conn.region.name) as s:
+      response = make_request(action, *args, **kwargs)
+      s.args["status"] = response.status
+      return response
+  conn.make_request = traced_make_request
+  return conn
+
+
+# Write the recorded spans as a Chrome trace-event JSON file
+def write_trace(path):
+  with _lock:
+    events = list(_events)
+  pid = os.getpid()
+  trace = []
+  thread_names = {}
+  for e in events:
+    thread_names[e["tid"]] = e["thread"]
+    trace.append({"name": e["name"], "cat": e["cat"], "ph": "X",
+                  "ts": int((e["start"] - _start) * 1e6),
+                  "dur": int((e["end"] - e["start"]) * 1e6),
+                  "pid": pid, "tid": e["tid"], "args": e["args"]})
+  for (tid, name) in thread_names.items():
+    trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                  "args": {"name": name}})
+  with open(path, "w") as f:
+    json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+# Print the total, maximum and count of the recorded spans per category and
+# name, longest total first
+def print_summary(out=sys.stdout):
+  with _lock:
+    events = list(_events)
+  totals = {}
+  for e in events:
+    key = (e["cat"], e["name"])
+    (count, total, longest, failed) = totals.get(key, (0, 0.0, 0.0, 0))
+    secs = e["end"] - e["start"]
+    failed += e["args"].get("outcome", "ok") != "ok"
+    totals[key] = (count + 1, total + secs, max(longest, secs), failed)
+  print >> out, ""
+  print >> out, "%-10s %-35s %6s %10s %10s %7s" % ("CATEGORY", "NAME", "COUNT",
+                                                   "TOTAL", "MAX", "FAILED")
+  for (key, (count, total, longest, failed)) in sorted(
+      totals.items(), key=lambda kv: -kv[1][1]):
+    print >> out, "%-10s %-35s %6d %9.1fs %9.1fs %7d" % (
+        key[0], key[1][:35], count, total, longest, failed)
+  print >> out, "Wall clock: %.1fs" % (time.time() - _start)
+
+
+# Write the trace to path and print the summary table
+def finish(path):
+  write_trace(path)
+  print_summary()
+  print "Wrote launch trace to %s" % path